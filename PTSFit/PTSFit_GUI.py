@@ -6,15 +6,16 @@
 
 import wx
 import os
+import multiprocessing
 import xrayutilities.materials as materials
-import xrayutilities.simpack as simpack
 from xrayutilities.materials.spacegrouplattice import sgrp_name
-import numpy as np
-from threading import Thread
-from scipy.optimize import least_squares, Bounds
 
 import EoS_dictionaries as EoS
 from PVT import BM
+from crystallography import peak_positions, reflection_list
+from fitting import window_model
+from patterns import as_pattern, DatasetCatalog, FileSeries, FolderWatcher, FrameStack, HDF5Stack, list_hdf5_stacks, load_series, pack_frame_stack, scan_patterns
+from refiner import poni2wave, RefinerThread, result_row, SequentialRefiner, window_points, write_results
 import matplotlib
 
 from matplotlib.backends.backend_wxagg import FigureCanvasWxAgg as FigureCanvas
@@ -26,109 +27,31 @@ import matplotlib.pyplot as plt
 FUNCTION BLOCK
 """
 
-def poni2wave(poni):#read a wavelength in angstroms from a .poni calibration file
-    with open(poni) as file:
-        wavelength = [i.split()[1] for i in file if i.split()[0] == "Wavelength:"]
-    return float(wavelength[0])*10000000000
-
-def open_dat(filename):#read file with x,y values per line
-    with open(filename) as dat:
-        temp = [i.split(" ") for i in dat]
-        for i in temp:
-            i[0] = float(i[0])
-            i[1] = float(i[1])
-        out = [i for i in temp]
-    return out
-
-def data2slices(data_2theta, theta_peak_guess, theta_variance): #creates a data slice about each peak position
-    sliced_data = []
-    for i in theta_peak_guess:
-        # we can assume a peak will never lie on a datum, so we take the point directly above and below the peak, add theta_variance peaks on either side
-        nearest_below = [xy for xy in data_2theta if xy[0] < i][-1]
-        nearest_above = [xy for xy in data_2theta if xy[0] > i][0]
-        lower_half_slice = data_2theta[data_2theta.index(nearest_below)-theta_variance:data_2theta.index(nearest_below)]
-        upper_half_slice = data_2theta[data_2theta.index(nearest_above):data_2theta.index(nearest_above)+theta_variance]
-        data_slice = lower_half_slice + upper_half_slice
-        sliced_data.append(data_slice)
-    return sliced_data
-
-def gauss(x, amp, cen, sigma, shift):#basic gaussian function
-    return amp * np.exp(-(x-cen)**2 / (2.*sigma**2)) + shift
-
-def split_model(i, region, gaussian_params, peaks):#takes a data slice and draws a gaussian over the slice 
-    amps = gaussian_params[0:len(peaks)]
-    sigmas = gaussian_params[len(peaks):(2*len(peaks))]
-    shifts = gaussian_params[2*len(peaks):]
-    peak_pos = peaks[i]
-    amp = amps[i]
-    sigma = sigmas[i]
-    shift = shifts[i]
-
-    x_values = [xy[0] for xy in region]
-    y_obs = [xy[1] for xy in region]
-    y_calc = gauss(x_values, amp, peak_pos, sigma, shift)
-    y_diff = [abs(a - b) for a,b in zip(y_obs, y_calc)]
-    return x_values, y_calc, y_diff
-
-def fit_function(parameters, SG_num, ttheta_max, wavelength, data_file, theta_variance, num_peaks):
-    #fitting function for use in LS, requires a 1D array of residuals to be output
-    #get the data into list of [x,y]s
-    data_2theta = open_dat(data_file)
-    
-    #seperate parameters list into gaussian params and lattice params
-    gaussian_params = parameters[0:3*num_peaks]
-    lattice_params = parameters[len(gaussian_params):]
-    
-    #generate peaks in 2theta:
-    material = materials.Crystal("material", materials.SGLattice(int(SG_num), *[float(i) for i in lattice_params]))
-    indexing_info = simpack.PowderDiffraction(material, tt_cutoff = ttheta_max+5, enable_simulation = False, wl = wavelength).data
-    peak_list = []
-    for key in indexing_info.keys():
-        peak_pos = indexing_info[key]["ang"]*2
-        peak_list.append(peak_pos)
-    peak_list = peak_list[:num_peaks]
-        
-    #cut data into regions about peaks:
-    regions = data2slices(data_2theta, peak_list, theta_variance)
+WATCH_INTERVAL = 250 #ms between checks of a watched folder
+PROGRESS_INTERVAL = 200 #ms between GUI updates from a running sequential fit
 
-    #do gaussian model and get difference between y_obs and y_calc for each region
-    residual_total = []
+PROFILE_MODE_CHOICES = ["peaks", "projected", "caglioti"] #fitting.PROFILE_MODES in the order of the "Peak profile" radio box
 
-    for i, region in enumerate(regions):
-        x_values, y_calc, y_diff = split_model(i, region, gaussian_params, peak_list)
-        residual_total.extend(y_diff)
-    
-    return np.array(residual_total)
-    
 def plot_fit_function(parameters, SG_num, ttheta_max, wavelength, data_file, theta_variance, num_peaks):
     #similar to above function but generates a matplotlib figure of a fit
-    #get the data into list of [x,y]s
-    data_2theta = open_dat(data_file)
+    #get the data as x, y arrays
+    x_data, y_data = as_pattern(data_file)
     #seperate parameters list into gaussian params and lattice params
     gaussian_params = parameters[0:3*num_peaks]
     lattice_params = parameters[len(gaussian_params):]
     #generate peaks in 2theta:
-    material = materials.Crystal("material", materials.SGLattice(int(SG_num), *[float(i) for i in lattice_params]))
-    indexing_info = simpack.PowderDiffraction(material, tt_cutoff = ttheta_max+5, enable_simulation = False, wl = wavelength).data
-    
-    peak_list = []
-    for key in indexing_info.keys():
-        peak_pos = indexing_info[key]["ang"]*2
-        peak_list.append(peak_pos)
-    peak_list = peak_list[:num_peaks]
-    #cut data into regions about peaks:
-    regions = data2slices(data_2theta, peak_list, theta_variance)
-
+    reflections = reflection_list(SG_num, lattice_params, ttheta_max+5, wavelength)
+    peak_list = peak_positions(SG_num, lattice_params, reflections["hkl"][:num_peaks], wavelength)
     #do gaussian model and get difference between y_obs and y_calc for each region
+    workspace, mask = window_model(x_data, y_data, gaussian_params, peak_list, theta_variance)
     
     fig, ax = plt.subplots(dpi = 100)
-    for region in regions:
-        i = regions.index(region)
-        x_values, y_calc, y_diff = split_model(i, region, gaussian_params, peak_list)
-        ax.scatter([i[0] for i in data_2theta], [i[1] for i in data_2theta], s = 2, color = "k")
-        max_int = max([i[1] for i in data_2theta])
-        ax.plot(x_values, y_calc, color = "r", label = "fit")
-        ax.plot(x_values, [y-(0.1*max_int) for y in y_diff], color = "b", label = "difference")
+    ax.scatter(x_data, y_data, s = 2, color = "k")
+    max_int = y_data.max()
+    for i, valid in enumerate(mask):
+        #boolean indexing copies, so the plotted lines do not change when the workspace is reused
+        ax.plot(workspace["x"][i][valid], workspace["y_calc"][i][valid], color = "r", label = "fit")
+        ax.plot(workspace["x"][i][valid], workspace["y_diff"][i][valid] - 0.1*max_int, color = "b", label = "difference")
         if i == 0:
             ax.legend()
         else:
@@ -174,38 +97,6 @@ def SG_lattice_object_read(SGLattice_object):
         lattice_params = [SGLattice_object.a, SGLattice_object.b, SGLattice_object.c, SGLattice_object.alpha, SGLattice_object.beta, SGLattice_object.gamma]
     return SG_num, lattice_params
 
-def lattice2volume(SG_num, lattice_params):
-    if SG_num <= 230 and SG_num > 194:#cubic
-        volume = lattice_params[0]**3
-    if SG_num < 195 and SG_num > 142:#hexagonal,trigonal
-        volume = np.sin(60*(np.pi/180))*lattice_params[1]*lattice_params[0]**2
-    if SG_num < 143 and SG_num > 74:#tetragonal
-        volume = lattice_params[1]*lattice_params[0]**2
-    if SG_num < 75 and SG_num > 15:#ortho
-        volume = lattice_params[0]*lattice_params[1]*lattice_params[2]
-    if SG_num < 16 and SG_num > 2:#mono
-        volume = lattice_params[0]*lattice_params[1]*lattice_params[2] * np.sin(lattice_params[3]*(np.pi/180))
-    if SG_num < 3:#triclinic
-        volume = lattice_params[0]*lattice_params[1]*lattice_params[2]*(1- np.cos(lattice_params[3]*(np.pi/180))**2 - np.cos(lattice_params[4]*(np.pi/180))**2 - np.cos(lattice_params[5]*(np.pi/180))**2) + 2*(np.cos(lattice_params[3]*(np.pi/180))*np.cos(lattice_params[4]*(np.pi/180))*np.cos(lattice_params[5]*(np.pi/180)))**0.5
-    return volume
-
-def generate_LSparams(gauss_params, lattice_params):
-    initial_params = gauss_params + lattice_params
-    lower_bounds = [0 for i in initial_params]
-    upper_bounds = [np.inf for i in initial_params]
-    bounds = Bounds(lb = lower_bounds, ub = upper_bounds)
-    return initial_params, bounds,
-
-class thread_with_result(Thread):
-    def run(self):
-        try:
-            if self._target is not None:
-                self.result = self._target(*self._args, **self._kwargs)
-        finally:
-            # Avoid a refcycle if the thread is running a function with
-            # an argument that has a member that points to the thread.
-            del self._target, self._args, self._kwargs
-
 """
 GUI BLOCK
 generated from wxGlade
@@ -259,10 +150,17 @@ class Main_window(wx.Frame):
         label_20 = wx.StaticText(self.panel_1, wx.ID_ANY, "Sequential fit proceeds in above order")
         sizer_36.Add(label_20, 0, 0, 0)
         
+        sizer_48 = wx.BoxSizer(wx.HORIZONTAL)
+        sizer_36.Add(sizer_48, 0, 0, 0)
+
         self.button_plot_datafile = wx.Button(self.panel_1, wx.ID_ANY, "Plot selected datafile", style=wx.BU_EXACTFIT)
-        sizer_36.Add(self.button_plot_datafile, 0, 0, 0)
+        sizer_48.Add(self.button_plot_datafile, 0, 0, 0)
         self.button_plot_datafile.Disable()
 
+        self.button_pack_stack = wx.Button(self.panel_1, wx.ID_ANY, "Pack datafiles to stack", style=wx.BU_EXACTFIT)
+        sizer_48.Add(self.button_pack_stack, 0, 0, 0)
+        self.button_pack_stack.Disable()
+
         sizer_31 = wx.StaticBoxSizer(wx.StaticBox(self.panel_1, wx.ID_ANY, "Crystal Parameters"), wx.VERTICAL)
         sizer_27.Add(sizer_31, 0, wx.EXPAND, 0)
 
@@ -402,9 +300,35 @@ class Main_window(wx.Frame):
         self.text_ctrl_final_file_num = wx.TextCtrl(self.panel_1, wx.ID_ANY, "")
         sizer_47.Add(self.text_ctrl_final_file_num, 0, 0, 0)
 
+        label_processes = wx.StaticText(self.panel_1, wx.ID_ANY, "  Processes:")
+        sizer_47.Add(label_processes, 0, wx.ALIGN_CENTER_VERTICAL, 0)
+
+        self.text_ctrl_processes = wx.TextCtrl(self.panel_1, wx.ID_ANY, "1")
+        sizer_47.Add(self.text_ctrl_processes, 0, 0, 0)
+
+        self.checkbox_resume = wx.CheckBox(self.panel_1, wx.ID_ANY, "Resume from journal")
+        sizer_47.Add(self.checkbox_resume, 0, wx.ALIGN_CENTER_VERTICAL | wx.LEFT, 10)
+
+        self.radio_box_profile = wx.RadioBox(self.panel_1, wx.ID_ANY, "Peak profile", choices = ["Scale, sigma and shift per peak", "As above, scales and shifts solved in closed form", "Scale per peak, Caglioti widths and a polynomial background"], majorDimension = 1, style = wx.RA_SPECIFY_COLS)
+        sizer_33.Add(self.radio_box_profile, 0, wx.EXPAND, 0)
+
         self.button_do_seq_fit = wx.Button(self.panel_1, wx.ID_ANY, "Do sequential fit(s)")
         sizer_33.Add(self.button_do_seq_fit, 0,  wx.EXPAND, 0)
 
+        sizer_fit_control = wx.BoxSizer(wx.HORIZONTAL)
+        sizer_33.Add(sizer_fit_control, 0, wx.EXPAND, 0)
+
+        self.button_pause = wx.ToggleButton(self.panel_1, wx.ID_ANY, "Pause")
+        sizer_fit_control.Add(self.button_pause, 1, wx.EXPAND, 0)
+        self.button_pause.Disable()
+
+        self.button_cancel = wx.Button(self.panel_1, wx.ID_ANY, "Cancel")
+        sizer_fit_control.Add(self.button_cancel, 1, wx.EXPAND, 0)
+        self.button_cancel.Disable()
+
+        self.button_watch = wx.ToggleButton(self.panel_1, wx.ID_ANY, "Watch folder for new datafiles")
+        sizer_33.Add(self.button_watch, 0,  wx.EXPAND, 0)
+
         self.gauge_1 = wx.Gauge(self.panel_1, wx.ID_ANY, 100)
         sizer_27.Add(self.gauge_1, 0, wx.EXPAND, 0)
 
@@ -457,6 +381,7 @@ class Main_window(wx.Frame):
         self.Bind(wx.EVT_BUTTON, self.open_calibration, self.button_open_calib)
         self.Bind(wx.EVT_LISTBOX, self.file_highlight, self.list_box_1)
         self.Bind(wx.EVT_BUTTON, self.datafile_plot, self.button_plot_datafile)
+        self.Bind(wx.EVT_BUTTON, self.pack_stack, self.button_pack_stack)
         self.Bind(wx.EVT_BUTTON, self.open_cif, self.button_open_cif)
 
         self.Bind(wx.EVT_TEXT, self.SG_input, self.text_ctrl_SG_num)
@@ -473,8 +398,14 @@ class Main_window(wx.Frame):
         self.Bind(wx.EVT_TEXT, self.theta_variance2datapoints, self.text_ctrl_variance)
         self.Bind(wx.EVT_TEXT, self.input_max_ttheta, self.text_ctrl_max_2theta)
         self.Bind(wx.EVT_TEXT, self.fit_final_num_in, self.text_ctrl_final_file_num)
-        #self.Bind(wx.EVT_BUTTON, self.do_seq_fit, self.button_do_seq_fit) <-- if not using threading
         self.Bind(wx.EVT_BUTTON, self.do_seq_fit, self.button_do_seq_fit)
+        self.Bind(wx.EVT_TOGGLEBUTTON, self.pause_toggle, self.button_pause)
+        self.Bind(wx.EVT_BUTTON, self.cancel_seq_fit, self.button_cancel)
+        self.fit_timer = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, self.fit_poll, self.fit_timer)
+        self.Bind(wx.EVT_TOGGLEBUTTON, self.watch_toggle, self.button_watch)
+        self.watch_timer = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, self.watch_poll, self.watch_timer)
         self.Bind(wx.EVT_TEXT, self.wavelength_input, self.text_ctrl_wavelength)
         self.Bind(wx.EVT_COMBOBOX, self.calibrant_load, self.CB_select_EoS_params)
         self.Bind(wx.EVT_BUTTON, self.do_PVT, self.btn_do_PVT)
@@ -489,13 +420,19 @@ class Main_window(wx.Frame):
         self.gaussian_params = [0,0,0]
         self.SG_num = None
         self.lattice_params = ["","","","","",""]
-        self.loaded_datafiles = []
-        self.selected_datafile = None
+        self.frame_source = None #FileSeries, FrameStack or HDF5Stack, see patterns.py
+        self.catalog = None #DatasetCatalog of the loaded x,y files, None for stacks
+        self.selected_frame = None
         self.max_2theta = None
         self.max_dataframe = None
         self.wavelength = None
         self.refined_datasets = []
         self.fit_window_size = int(0)
+        self.selected_EoS_dict = None
+        self.seq_refiner = None #SequentialRefiner of the last sequential fit, a watched folder continues from it
+        self.fit_thread = None #RefinerThread of the running sequential fit
+        self.watcher = None
+        self.watch_refiner = None
     
     def spawn_plot(self, fig, name):#general function to spawn a plot window
         frame = Plotframe(self, name, fig)
@@ -535,6 +472,8 @@ class Main_window(wx.Frame):
         
     def open_datafiles(self, event):  #opening datafiles
         wildcard = "Dioptas dat file (*.dat)|*.dat|"     \
+           "PTSFit frame stack (*.ptstack)|*.ptstack|"     \
+           "HDF5/NeXus integrated patterns (*.h5;*.hdf5;*.nxs)|*.h5;*.hdf5;*.nxs|"     \
            "Other space seperated xy files (*.*)|*.*"
 
         dlg = wx.FileDialog(
@@ -547,39 +486,128 @@ class Main_window(wx.Frame):
                   wx.FD_PREVIEW
             )
         if dlg.ShowModal() == wx.ID_OK:
-            names =[]
-            self.loaded_datafiles += dlg.GetPaths()
-            names = [os.path.split(path)[1] for path in self.loaded_datafiles]
-            self.log.WriteText('Imported %d file(s):\n' % len(names))
-            for name in names:
-                self.log.WriteText('           %s\n' % name)
-            self.list_box_1.AppendItems(names)
-            self.max_dataframe = len(self.loaded_datafiles)
+            paths = dlg.GetPaths()
+            stacks = [path for path in paths if os.path.splitext(path)[1].lower() in (".ptstack", ".h5", ".hdf5", ".nxs")]
+            if stacks != []:
+                #a frame stack replaces whatever was loaded before
+                try:
+                    stack = self.open_stack(stacks[0])
+                except (OSError, ValueError, KeyError, ImportError) as error:
+                    self.log.WriteText("Could not open frame stack: "+str(error)+"\n")
+                    stack = None
+                if stack is None:
+                    dlg.Destroy()
+                    return None
+                if self.frame_source is not None:
+                    self.frame_source.close()
+                self.frame_source = stack
+                self.catalog = None
+                self.list_box_1.Clear()
+                names = self.frame_source.names
+                self.log.WriteText('Opened frame stack %s with %d frame(s)\n' % (stacks[0], len(names)))
+                self.list_box_1.AppendItems(names)
+            else:
+                names = self.add_datafiles(paths)
+                self.log.WriteText('Imported %d file(s):\n' % len(names))
+                for name in names:
+                    self.log.WriteText('           %s\n' % name)
+                for warning in self.catalog.validate():
+                    self.log.WriteText("Warning: "+warning+"\n")
+            if self.frame_source is None or len(self.frame_source) == 0:
+                self.log.WriteText("No readable datafiles loaded\n")
+                dlg.Destroy()
+                return None
+            self.button_pack_stack.Enable(self.frame_source.extendable)
+            if self.frame_source.x is not None:
+                self.log.WriteText("Frames share a 2theta grid of %d points\n" % self.frame_source.x.size)
+            else:
+                self.log.WriteText("Frames are on different 2theta grids, reading them one at a time\n")
+            self.max_dataframe = len(self.frame_source)
             self.text_ctrl_final_file_num.SetValue(str(self.max_dataframe))
-            last_dataset = open_dat(self.loaded_datafiles[-1])
-            max_2theta = float(max([i[0] for i in last_dataset]))
+            #get an estimate for max 2theta, the highest 2theta reached by every loaded file, or the end of a stack's axis:
+            if self.catalog is not None:
+                max_2theta = self.catalog.max_2theta()
+            else:
+                max_2theta = float(self.frame_source.x.max())
             self.text_ctrl_max_2theta.SetValue(str(max_2theta))
         
         dlg.Destroy()
-        #get an estimate for max 2theta by taking the maximum x value of the last dataset:
-        
+
+    def add_datafiles(self, paths):#add x,y files to the loaded frames (or start a new series if a stack is loaded), returns the names added
+        #every file is read once, in parallel, for the catalog, the parsed data then goes straight into the frame source
+        scanned = scan_patterns(paths)
+        for entry, x, y in scanned:
+            if not entry["valid"]:
+                self.log.WriteText("Skipped unreadable datafile "+entry["name"]+": "+str(entry["error"])+"\n")
+        scanned = [i for i in scanned if i[0]["valid"]]
+        entries = [entry for entry, x, y in scanned]
+        paths = [entry["path"] for entry in entries]
+        patterns = [(x, y) for entry, x, y in scanned]
+        if self.frame_source is not None and self.frame_source.extendable and self.catalog is not None:
+            try:
+                self.frame_source.extend(paths, patterns)
+            except ValueError:#new files are on a different 2theta grid
+                self.frame_source = FileSeries(self.frame_source.paths + paths)
+            self.catalog.add(entries)
+        else:
+            if self.frame_source is not None:
+                self.frame_source.close()
+            self.list_box_1.Clear()
+            self.frame_source = load_series(paths, patterns)
+            self.catalog = DatasetCatalog(entries)
+        names = [entry["name"] for entry in entries]
+        self.list_box_1.AppendItems(names)
+        return names
+
+    def open_stack(self, path):#open a .ptstack or HDF5/NeXus file as a frame source, returns None if the user cancels
+        if path.endswith(".ptstack"):
+            return FrameStack.open(path)
+        datasets = list_hdf5_stacks(path)
+        if datasets == []:
+            raise ValueError("No (frames x points) datasets in "+str(path))
+        dataset = datasets[0]
+        if len(datasets) > 1:
+            dlg = wx.SingleChoiceDialog(self, "Select the integrated pattern dataset", "HDF5/NeXus dataset", datasets)
+            if dlg.ShowModal() != wx.ID_OK:
+                dlg.Destroy()
+                return None
+            dataset = dlg.GetStringSelection()
+            dlg.Destroy()
+        #frames are read lazily, the frame range fitted is set by "Maximum datafiles to fit"
+        return HDF5Stack(path, dataset)
+
+    def pack_stack(self, event):#convert the loaded datafiles into a single memory-mapped .ptstack file and fit from that
+        wildcard = "PTSFit frame stack (*.ptstack)|*.ptstack|"     \
+           "All files (*.*)|*.*"
+        dlg = wx.FileDialog(
+            self, message="Save frame stack as ...", defaultDir=os.getcwd(),
+            defaultFile="", wildcard=wildcard, style=wx.FD_SAVE | wx.FD_OVERWRITE_PROMPT
+            )
+        if dlg.ShowModal() == wx.ID_OK:
+            path = dlg.GetPath()
+            try:
+                stack = pack_frame_stack(self.frame_source.paths, path)
+            except (OSError, ValueError) as error:
+                self.log.WriteText("Could not pack datafiles: "+str(error)+"\n")
+            else:
+                self.frame_source = stack
+                self.catalog = None
+                self.log.WriteText("Packed %d frame(s) into %s\n" % (len(self.frame_source), path))
+                self.button_pack_stack.Disable()
+        dlg.Destroy()
 
 
     def file_highlight(self, event):  # need to know what files get selected
-        name_index = self.list_box_1.GetSelection()
-        self.selected_datafile = self.loaded_datafiles[name_index]
+        self.selected_frame = self.list_box_1.GetSelection()
         self.button_plot_datafile.Enable()
         
     def datafile_plot(self, event):#quick plot of raw data
-        filename = self.selected_datafile
-        loaded_data = open_dat(filename)#[[x,y],]
-        x = [i[0] for i in loaded_data]
-        y = [i[1] for i in loaded_data]
+        x, y = self.frame_source.frame(self.selected_frame)
         fig, ax = plt.subplots(dpi = 100)
         ax.plot(x,y)
         ax.set_ylabel("Counts (n)")
         ax.set_xlabel("2theta (°)")
-        name = os.path.split(filename)[1]
+        name = self.frame_source.names[self.selected_frame]
         self.spawn_plot(fig, name)
 
     def open_cif(self, event):  # opens a .cif
@@ -798,172 +826,202 @@ class Main_window(wx.Frame):
         except ValueError:
             self.log.WriteText("Fit window not specified\n")
             return None
-        data_frame = open_dat(self.loaded_datafiles[0])#load in 1st dataset [[x,y],[x,y]....]
-        x_values = [i[0] for i in data_frame]
-        data_start = x_values[0]#1st x-value
-        data_end = data_start + window_2theta#end point of the data window
-        data_window = [x for x in x_values if x < data_end]
-        window_datapoints = int(len(data_window)/2)
-        self.fit_window_size = window_datapoints
+        if self.frame_source is None or len(self.frame_source) == 0:
+            self.log.WriteText("No datafiles loaded\n")
+            return None
+        self.fit_window_size = window_points(self.frame_source, self.catalog, window_2theta)
          
-    def do_fit(self, fit_function, params, bounds, SG_num, ttheta_max, wavelength, initial_data_file, theta_variance, num_peaks):
-    #wrapper for convienience
-        SG_num = SG_num
-        ttheta_max = ttheta_max
-        wavelength = wavelength
-        initial_data_file = initial_data_file
-        theta_variance = theta_variance
-        num_peaks = num_peaks
-        out = least_squares(fit_function, params, bounds = bounds, args = (SG_num, ttheta_max, wavelength, initial_data_file, theta_variance, num_peaks))
-        return out
-
-    def do_seq_fit(self, event):  # the sequential fitting loop
+    def refiner_config(self):#the GUI inputs as a SequentialRefiner config
+        config = {}
+        config["SG_num"] = self.SG_num
+        config["lattice_params"] = self.lattice_params
+        config["wavelength"] = self.wavelength
+        try:
+            config["window"] = float(self.text_ctrl_variance.GetValue())
+        except ValueError:
+            config["window"] = None
+        config["window_points"] = self.fit_window_size
+        config["max_2theta"] = self.max_2theta
+        config["profile"] = self.gaussian_params
+        config["profile_mode"] = PROFILE_MODE_CHOICES[self.radio_box_profile.GetSelection()]
+        config["max_frames"] = self.max_dataframe
+        try:#more than 1 fits the series in parallel segments
+            config["processes"] = max(1, int(self.text_ctrl_processes.GetValue()))
+        except ValueError:
+            config["processes"] = 1
+        config["resume"] = self.checkbox_resume.GetValue()#skip the frames of the last run in seq_journal.jsonl
+        return config
+
+    def seq_fit_setup(self):#builds a SequentialRefiner on the loaded frames from the GUI inputs, returns None if something is missing
+        refiner = SequentialRefiner(self.refiner_config(), frame_source = self.frame_source, catalog = self.catalog, log = self.log.WriteText)
+        try:
+            refiner.setup()
+        except ValueError as error:
+            self.log.WriteText(str(error)+"\n")
+            return None
+        return refiner
+
+    def do_seq_fit(self, event):  # starts the sequential fit on a worker thread, fit_poll shows its progress
     
-    #list of datafiles:
-        framelist = self.loaded_datafiles
-        if framelist ==[]:
+    #frames to fit, read from the loaded frame source:
+        frame_source = self.frame_source
+        if frame_source is None or len(frame_source) == 0:
             self.log.WriteText("No datafiles loaded\n")
             return None
+        if self.fit_thread != None:
+            self.log.WriteText("A sequential fit is already running\n")
+            return None
+        frame_indices = range(len(frame_source))[:self.max_dataframe]
         
-        counter = int(0)
-    #do indexing in order to determine number of peaks which is needed to create list of gaussians:
-        #create local variable of lattice_params
-        lattice_params = self.lattice_params
-        if lattice_params == None or any(v == None or v == '' for v in lattice_params) or self.SG_num == False or self.SG_num == None:
-            self.log.WriteText("Missing crystallographic parameters\n")
+        refiner = self.seq_fit_setup()
+        if refiner == None:
             return None
-        #create material object from lattice params, SGLatiice object is not used here
-        material, SGLattice_object = SG_lattice_params2material(int(self.SG_num), lattice_params)
-        #indexing info is a dictionary of peaks, needs a material object
-        if self.wavelength == None:
-            self.log.WriteText("Missing wavelength\n")
+        self.seq_refiner = refiner
+        self.gauge_1.SetRange(len(frame_indices))
+        self.gauge_1.SetValue(0)
+        self.start_fit_thread(RefinerThread(refiner, frame_indices))
+
+    def start_fit_thread(self, thread):#runs a RefinerThread, fit_poll shows its progress
+        self.fit_thread = thread
+        #the frames are fitted on the worker thread, the buttons that would start another fit or change the loaded frames under it are disabled
+        self.enable_frame_controls(False)
+        self.button_pause.SetValue(False)
+        self.button_pause.SetLabel("Pause")
+        self.button_pause.Enable()
+        self.button_cancel.Enable()
+        thread.start()
+        self.fit_timer.Start(PROGRESS_INTERVAL)
+
+    def enable_frame_controls(self, enable):#buttons that start a fit or open, add or pack datafiles, disabled while a fit runs
+        self.button_do_seq_fit.Enable(enable)
+        self.button_watch.Enable(enable)
+        self.button_open_datafiles.Enable(enable)
+        self.button_pack_stack.Enable(enable and self.frame_source is not None and self.frame_source.extendable)
+
+    def fit_poll(self, event):#timer event, takes everything the worker thread has posted since the last tick and updates the GUI once
+        thread = self.fit_thread
+        if thread == None:
+            self.fit_timer.Stop()
             return None
-        #constrain max 2theta to be the GUI value - 1/2 of a data windows width (otherwise a data window may lie outside the data range, breaking the LS)
-        if self.fit_window_size == 0:
-            self.log.WriteText("Fit window not specified\n")
+        text = []
+        finished = False
+        while not thread.events.empty():
+            kind, value = thread.events.get()
+            if kind == "log":
+                text.append(value)
+            elif kind == "result":
+                if value["success"]:
+                    self.record_result(value)
+                    if thread.frame_source is not None:#a datafile of the watched folder
+                        self.live_PVT(self.PVT_table.GetItemCount()-1)
+            elif kind == "error":
+                text.append("==== ERROR ====\n"+str(value)+"\n")
+                finished = True
+            else:
+                finished = True
+        if text != []:
+            self.log.WriteText("".join(text))
+        self.gauge_1.SetValue(min(thread.refiner.state["counter"], self.gauge_1.GetRange()))
+        if finished:
+            self.fit_timer.Stop()
+            self.fit_thread = None
+            self.enable_frame_controls(True)
+            self.button_pause.SetValue(False)
+            self.button_pause.SetLabel("Pause")
+            self.button_pause.Disable()
+            self.button_cancel.Disable()
+
+    def pause_toggle(self, event):#pause and resume the running sequential fit between frames
+        if self.fit_thread == None:
             return None
-        tt_cutoff = self.max_2theta - (float(self.text_ctrl_variance.GetValue())/2)
-        indexing_info = simpack.PowderDiffraction(material, tt_cutoff = tt_cutoff, enable_simulation = False, wl = self.wavelength).data
-        num_peaks = len(indexing_info.keys())
-    #convert the self.gaussian_params object (which is just a list of scale, sigma, shift)
-    #into a list of [scale, scale,... sigma, sigma,...  shift, shift,... per number of peaks]
-        raw_gaussian_params = self.gaussian_params
-        if any(g == 0  for g in raw_gaussian_params):
-            self.log.WriteText("Missing, or zero value gaussian parameters\n")
+        if self.button_pause.GetValue():
+            self.fit_thread.pause()
+            self.button_pause.SetLabel("Resume")
+            self.log.WriteText("Pausing after the current frame\n")
+        else:
+            self.fit_thread.resume()
+            self.button_pause.SetLabel("Pause")
+            self.log.WriteText("Resumed\n")
+
+    def cancel_seq_fit(self, event):#stop the running sequential fit after the current frame, fitted frames are kept
+        if self.fit_thread == None:
             return None
-        
-        amps = [raw_gaussian_params[0]] * num_peaks
-        sigmas = [raw_gaussian_params[1]] * num_peaks
-        shifts = [raw_gaussian_params[2]] * num_peaks
-        gaussian_params = amps + sigmas + shifts
-        #make a backup file:
-        out_file = "seq_backup.csv"
-        self.log.WriteText("Created backup file: seq_backup.csv"+"\n")
-        with open(out_file, mode = "w") as file:
-            file.write("Filepath, Lattice parameters\n")
-            file.close()
-        #now the cyclic mode starts
-        #need to write as an individual function to maintain threading, lest GUI is unresponsive
-        self.log.WriteText("==== WARNING: ===="+"\n")
-        self.log.WriteText("==== GUI may become unresponsive if window is unfocused ===="+"\n")
-        self.log.WriteText("Program will print progress to python console"+"\n")
-        self.gauge_1.SetRange(len(framelist[:self.max_dataframe]))
-        for frame in framelist[:self.max_dataframe]:
-            LS_params = list(gaussian_params)
-            for i in lattice_params:
-                LS_params.append(i)
-            lower_bounds = [0 for i in LS_params]#hard coded bounds of 0 to +inf for all params
-            upper_bounds = [np.inf for i in LS_params]
-            bounds = Bounds(lb = lower_bounds, ub = upper_bounds)
-            #do the LS
-            try:
-                LS_out = self.do_fit_threaded(
-                                    [fit_function, 
-                                    LS_params, 
-                                    bounds, 
-                                    self.SG_num, 
-                                    self.max_2theta, 
-                                    self.wavelength, 
-                                    frame, 
-                                    int(self.fit_window_size), 
-                                    num_peaks]
-                                    )
-            except:
-                self.log.WriteText("==== ERROR IN LEAST SQUARES ====\nConsidering changing starting parameters, reducing maximum 2theta for indexing, or the fitting window\n")
-                break
-            #redefine LS_params for next fit, conviently assign gaussians and lattice:
-            if LS_params == list(LS_out.x):#LS minimiser has stopped working
-                #originally was a function here to add some random noise to the LS parameters
-                #this is likely not the best approach
-                #the original error was due to a peak position crossing the 2theta indexing limit
-                #the peak would then be ignored but the gaussian parameters would still be sent to the LS function
-                #the LS function was rewritten to constrain the number of gaussian parameters based on the number of peaks
-                self.log.WriteText("==== WARNING ====\n")
-                self.log.WriteText("Refinement returned input values\n")
-
-            LS_params = LS_out.x
-            out_gauss = LS_out.x[0:num_peaks*3]
-            out_lattice_params = LS_out.x[num_peaks*3:]
-            lattice_params = out_lattice_params
-            gaussian_params = out_gauss
-            #calculate volume
-            out_volume = lattice2volume(self.SG_num, out_lattice_params)
-            #write to log
-            self.log.WriteText("Fitted: "+str(frame)+"\n")
-            self.log.WriteText("With residual sum of: "+str(LS_out.cost)+"\n")
-            self.log.WriteText("Refined gaussian parameters: "+str(out_gauss)+"\n")
-            self.log.WriteText("Refined lattice parameters: "+str(out_lattice_params)+"\n")
-            self.log.WriteText("Volume = "+str(out_volume)+"\n")
-            #write data dictionary (used to be a custom class, but wasn't really necessary)
-            out_data_object = {}
-            out_data_object["filename"] = os.path.split(frame)[1]
-            out_data_object["filepath"] = frame
-            out_data_object["LS_gauss (scale sigma shift per peak"] = list(out_gauss)#need to reformat for file i/o
-            #converts list (which will not format correctly in .csv) to string of space seperated values
-            write_string = ""
-            for value in out_data_object["LS_gauss (scale sigma shift per peak"]:
-                write_string += str(value)
-                write_string += " "
-            out_data_object["LS_gauss (scale sigma shift per peak"] = write_string.strip("['")
-            out_data_object["LS_gauss (scale sigma shift per peak"] = write_string.strip("']")
-            #as above
-            out_data_object["LS_lattice (variable length depending on symmetry)"] = list(out_lattice_params)#need to reformat for file i/o
-            write_string = ""
-            for value in out_data_object["LS_lattice (variable length depending on symmetry)"]:
-                write_string += str(value)
-                write_string += " "
-            out_data_object["LS_lattice (variable length depending on symmetry)"] = write_string.strip("[")
-            out_data_object["LS_lattice (variable length depending on symmetry)"] = write_string.strip("]")
-            out_data_object["V (A^3)"] = out_volume
-            out_data_object["P (GPa)"] = None
-            out_data_object["T (K)"] = None
-            out_data_object["LS cost value"] = LS_out.cost
-            #add the dictionary to the main list
-            self.refined_datasets.append(out_data_object)
-            #write to backup file
-            with open(out_file, mode = "a") as file:
-                lattice_write = [i for i in LS_out.x[num_peaks*3:]]
-                file.write(str(frame)+",")
-                for i in lattice_write:
-                    file.write(str(i)+",")
-                    file.write("\n")
-                file.close()
-            PVT_table_list = [os.path.split(frame)[1], out_volume, "",""]
-            counter += 1
-            print("dataset "+str(counter)+" fit")
-            #update GUI
-            self.gauge_1.SetValue(counter)
-            self.PVT_table.Append(PVT_table_list)
-            self.Refresh()
-            self.Update()
-            #the GUI will be non responsive while this loops
-            
-    def do_fit_threaded(self,args):
-        #opens new thread to keep GUI updating... but GUI still goes non-responsive if window is unfocused
-        t = thread_with_result(target=self.do_fit, args = args)
-        t.run()
-        #t.join()
-        return t.result
+        self.fit_thread.cancel()
+        self.log.WriteText("Cancelling after the current frame\n")
+
+    def record_result(self, result):#add a fitted frame to the results and the PVT table
+        self.refined_datasets.append(result_row(result))
+        print("dataset "+str(len(self.refined_datasets))+" fit")
+        self.PVT_table.Append([result["filename"], result["volume"], "", ""])
+
+    def watch_toggle(self, event):#live mode: fit datafiles as they are written into a folder
+        if not self.button_watch.GetValue():
+            self.watch_timer.Stop()
+            self.watcher = None
+            self.watch_refiner.close_journal()
+            self.log.WriteText("Stopped watching folder\n")
+            return None
+        refiner = self.seq_fit_setup()
+        if refiner == None:
+            self.button_watch.SetValue(False)
+            return None
+        #warm start from the end of the last sequential fit if it indexed the same peaks
+        if self.seq_refiner != None and self.seq_refiner.state["num_peaks"] == refiner.state["num_peaks"]:
+            refiner.state["gaussian_params"] = self.seq_refiner.state["gaussian_params"]
+            refiner.state["lattice_params"] = self.seq_refiner.state["lattice_params"]
+            self.log.WriteText("Continuing from the last fitted frame\n")
+        dlg = wx.DirDialog(self, "Select folder to watch", defaultPath=os.getcwd())
+        if dlg.ShowModal() != wx.ID_OK:
+            dlg.Destroy()
+            self.button_watch.SetValue(False)
+            return None
+        directory = dlg.GetPath()
+        dlg.Destroy()
+        if self.frame_source is None or not self.frame_source.extendable or self.catalog is None:
+            if self.frame_source is not None:
+                self.frame_source.close()
+            self.frame_source = FileSeries([])
+            self.catalog = DatasetCatalog()
+            self.list_box_1.Clear()
+        #files that are already loaded are fitted with "Do sequential fit(s)", not here
+        self.watcher = FolderWatcher(directory, seen = self.frame_source.paths)
+        self.watch_refiner = refiner
+        self.seq_refiner = refiner
+        refiner.start_journal()
+        self.log.WriteText("Watching "+str(directory)+" for new datafiles\n")
+        self.watch_timer.Start(WATCH_INTERVAL)
+
+    def watch_poll(self, event):#timer event, fits any datafiles that have finished writing since the last check on a worker thread
+        if self.fit_thread != None:#new datafiles wait for the next check, the loaded frames are not changed under a running fit
+            return None
+        try:
+            paths = self.watcher.poll()
+        except OSError as error:
+            self.log.WriteText("Stopped watching folder: "+str(error)+"\n")
+            self.watch_timer.Stop()
+            self.watch_refiner.close_journal()
+            self.button_watch.SetValue(False)
+            return None
+        first = len(self.frame_source)
+        if paths != []:
+            self.add_datafiles(paths)
+        if len(self.frame_source) == first:
+            return None
+        self.max_dataframe = len(self.frame_source)
+        self.text_ctrl_final_file_num.ChangeValue(str(self.max_dataframe))
+        self.gauge_1.SetRange(self.watch_refiner.state["counter"] + len(self.frame_source) - first)
+        self.gauge_1.SetValue(self.watch_refiner.state["counter"])
+        #the frame source may have been replaced when adding the files, so it is passed to the thread
+        self.start_fit_thread(RefinerThread(self.watch_refiner, range(first, len(self.frame_source)), self.frame_source))
+
+    def live_PVT(self, row):#pressure for a freshly fitted row, at the last temperature set (or the EoS reference temperature)
+        if self.selected_EoS_dict == None:
+            return None
+        temperatures = [data["T (K)"] for data in self.refined_datasets if data["T (K)"] != None]
+        temperature = temperatures[-1] if temperatures != [] else self.selected_EoS_dict["T_0"]
+        self.refined_datasets[-1]["T (K)"] = temperature
+        self.PVT_table.SetItem(index = row, column = 3, label = str(temperature))
+        self.PVT_row(row)
 
     def calibrant_load(self, event): #which inbuilt material to pass to PVT
         self.loaded_calibrant = self.CB_select_EoS_params.GetValue()
@@ -1011,71 +1069,75 @@ class Main_window(wx.Frame):
     def do_PVT(self, event):#throw GUI values to PVT object, write output to data dictionary
         table_index = list(range(self.PVT_table.GetFirstSelected(), self.PVT_table.GetFirstSelected() + self.PVT_table.GetSelectedItemCount(), 1))
         for i in table_index:
-            #initialise PVT list
-            PVT_table = [None, None, None]
-            #read PVT from dict into PVT list
-            item = self.PVT_table.GetItem(i).GetText()
-            volume = [i["V (A^3)"] for i in self.refined_datasets if i["filename"] == item][0]
-            pressure = [i["P (GPa)"] for i in self.refined_datasets if i["filename"] == item][0]
-            temperature = [i["T (K)"] for i in self.refined_datasets if i["filename"] == item][0]
-            if pressure == None and temperature == None:
-                self.log.WriteText("Missing P or T for list object: "+str(item)+"\n")
-            if pressure != None and temperature != None:
-                self.log.WriteText("P or T already given for list object: "+str(item)+"\n")
-            if pressure != None:
-                PVT_table[0] = float(pressure)
-            if volume != None:
-                PVT_table[1] = float(volume)
-            if temperature != None:
-                PVT_table[2] = float(temperature)
-            #Do PVT calc
-            if PVT_table.count(None) == 1:
-                PVT_object_out = BM(self.selected_EoS_dict, PVT_table)
-            else:
-                self.log.WriteText("Incomplete variables for PVT determination\n")
+            if not self.PVT_row(i):
                 break
-            #update GUI
-            P_out = PVT_object_out.P
-            T_out = PVT_object_out.T
-            self.log.WriteText("For datafile: "+str(item)+" P,T of "+str(P_out)+" GPa, "+str(T_out)+" K\n")
-            self.PVT_table.SetItem(index =  i, column = 2, label = str(P_out))
-            self.PVT_table.SetItem(index =  i, column = 3, label = str(T_out))
-            #write PT values to dictionary: (Vs already set from LS)
-            #this is kinda gross, if a differnt EoS equation is used it would need to be hard coded
-            #ideally this would be dynamically generated from the dictionary keys
-            #which in turn would be dynamically generated from the PVT object
-            for dictionary in self.refined_datasets:
-                if dictionary["filename"] == item:
-                    dictionary["P (GPa)"] = P_out
-                    dictionary["T (K)"] = T_out
-            #adding thermodynamic parameters to data dictionary:
-                    dictionary["Potential real pressure (bar)"] = PVT_object_out.p_x
-                    dictionary["Thermal pressure (bar)"] = PVT_object_out.p_thermal
-                    dictionary["Pressure(bar)"] = PVT_object_out.p_real
-                    
-                    dictionary["Internal energy (Jmol-1)"] = PVT_object_out.in_energy
-                    dictionary["Gibbs energy (Jmol-1)"] = PVT_object_out.gibbs_energy
-                    dictionary["Enthalpy (Jmol-1)"] = PVT_object_out.enthalpy
-                    dictionary["Entropy (Jmol-1)"] = PVT_object_out.entropy
-                    
-                    dictionary["Helmholtz free energy (Jmol-1)"] = PVT_object_out.free_energy
-                    dictionary["Potential Helmholtz free energy E298 (Jmol-1)"] = PVT_object_out.Ex
-                    
-                    dictionary["Isothermal bulk modulus (bar)"] = PVT_object_out.k_t
-                    dictionary["Thermal isothermal bulk modulus (bar)"] = PVT_object_out.K_T_thermal
-                    dictionary["Potential isothermal bulk modulus (bar)"] = PVT_object_out.KTx
-                    dictionary["Adiabatic bulk modulus (bar)"] = PVT_object_out.Ks
-                    
-                    dictionary["Isochoric heat capacity (Jmol-1 K-1)"] = PVT_object_out.Cv
-                    dictionary["Isobaric heat capacity (Jmol-1 K-1)"] = PVT_object_out.Cp
-                    
-                    dictionary["Compression"] = PVT_object_out.x
-                    dictionary["Derivative dP/dT (bar K-1)"] = PVT_object_out.dPdT
-                    dictionary["Volume cofficent of thermal expansivity (K-1 / 10-5 K-1)"] = PVT_object_out.alpha
-                    dictionary["Einstein temperature multiplier"] = PVT_object_out.exp
-                    dictionary["Thermodynamic Grunesisen"] = PVT_object_out.gamma
-            
-    
+
+    def PVT_row(self, i):#P,T for one row of the PVT table, returns False if there are not enough variables
+        #initialise PVT list
+        PVT_table = [None, None, None]
+        #read PVT from dict into PVT list
+        item = self.PVT_table.GetItem(i).GetText()
+        volume = [i["V (A^3)"] for i in self.refined_datasets if i["filename"] == item][0]
+        pressure = [i["P (GPa)"] for i in self.refined_datasets if i["filename"] == item][0]
+        temperature = [i["T (K)"] for i in self.refined_datasets if i["filename"] == item][0]
+        if pressure == None and temperature == None:
+            self.log.WriteText("Missing P or T for list object: "+str(item)+"\n")
+        if pressure != None and temperature != None:
+            self.log.WriteText("P or T already given for list object: "+str(item)+"\n")
+        if pressure != None:
+            PVT_table[0] = float(pressure)
+        if volume != None:
+            PVT_table[1] = float(volume)
+        if temperature != None:
+            PVT_table[2] = float(temperature)
+        #Do PVT calc
+        if PVT_table.count(None) == 1:
+            PVT_object_out = BM(self.selected_EoS_dict, PVT_table)
+        else:
+            self.log.WriteText("Incomplete variables for PVT determination\n")
+            return False
+        #update GUI
+        P_out = PVT_object_out.P
+        T_out = PVT_object_out.T
+        self.log.WriteText("For datafile: "+str(item)+" P,T of "+str(P_out)+" GPa, "+str(T_out)+" K\n")
+        self.PVT_table.SetItem(index =  i, column = 2, label = str(P_out))
+        self.PVT_table.SetItem(index =  i, column = 3, label = str(T_out))
+        #write PT values to dictionary: (Vs already set from LS)
+        #this is kinda gross, if a differnt EoS equation is used it would need to be hard coded
+        #ideally this would be dynamically generated from the dictionary keys
+        #which in turn would be dynamically generated from the PVT object
+        for dictionary in self.refined_datasets:
+            if dictionary["filename"] == item:
+                dictionary["P (GPa)"] = P_out
+                dictionary["T (K)"] = T_out
+        #adding thermodynamic parameters to data dictionary:
+                dictionary["Potential real pressure (bar)"] = PVT_object_out.p_x
+                dictionary["Thermal pressure (bar)"] = PVT_object_out.p_thermal
+                dictionary["Pressure(bar)"] = PVT_object_out.p_real
+                
+                dictionary["Internal energy (Jmol-1)"] = PVT_object_out.in_energy
+                dictionary["Gibbs energy (Jmol-1)"] = PVT_object_out.gibbs_energy
+                dictionary["Enthalpy (Jmol-1)"] = PVT_object_out.enthalpy
+                dictionary["Entropy (Jmol-1)"] = PVT_object_out.entropy
+                
+                dictionary["Helmholtz free energy (Jmol-1)"] = PVT_object_out.free_energy
+                dictionary["Potential Helmholtz free energy E298 (Jmol-1)"] = PVT_object_out.Ex
+                
+                dictionary["Isothermal bulk modulus (bar)"] = PVT_object_out.k_t
+                dictionary["Thermal isothermal bulk modulus (bar)"] = PVT_object_out.K_T_thermal
+                dictionary["Potential isothermal bulk modulus (bar)"] = PVT_object_out.KTx
+                dictionary["Adiabatic bulk modulus (bar)"] = PVT_object_out.Ks
+                
+                dictionary["Isochoric heat capacity (Jmol-1 K-1)"] = PVT_object_out.Cv
+                dictionary["Isobaric heat capacity (Jmol-1 K-1)"] = PVT_object_out.Cp
+                
+                dictionary["Compression"] = PVT_object_out.x
+                dictionary["Derivative dP/dT (bar K-1)"] = PVT_object_out.dPdT
+                dictionary["Volume cofficent of thermal expansivity (K-1 / 10-5 K-1)"] = PVT_object_out.alpha
+                dictionary["Einstein temperature multiplier"] = PVT_object_out.exp
+                dictionary["Thermodynamic Grunesisen"] = PVT_object_out.gamma
+        return True
+
     def plot_PVT(self, event):#plot PVT
         #generate x and y datas
         x = list(range(len(self.refined_datasets)))
@@ -1121,15 +1183,7 @@ class Main_window(wx.Frame):
             )
         if dlg.ShowModal() == wx.ID_OK:
             path = dlg.GetPath()
-            with open(path, mode = "w") as file:
-                for i in list(self.refined_datasets[0].keys()):#creates a header from data dictionary
-                    file.write(str(i)+",")
-                file.write("\n")#new line after header
-                for dictionary in self.refined_datasets:
-                    for value in list(dictionary.values()):
-                        file.write(str(value)+",")
-                    file.write("\n")
-                file.close()
+            write_results(path, self.refined_datasets)
             self.log.WriteText("Saved file: "+str(path))
         dlg.Destroy()
         
@@ -1182,6 +1236,9 @@ class PopMenu(wx.Menu):
         for dictionary in self.parent.refined_datasets:
             if dictionary["filename"] == item:
                 data_path = dictionary["filepath"]
+                frame_source = self.parent.frame_source
+                if frame_source is not None and item in frame_source.names:#read the frame from the loaded source (also covers frame stacks)
+                    data_path = frame_source.frame(frame_source.names.index(item))
                 gauss_params = dictionary["LS_gauss (scale sigma shift per peak"]
                 gauss_params = gauss_params.split(" ")
                 gauss_params = [float(x) for x in gauss_params if x != ""]
@@ -1190,9 +1247,7 @@ class PopMenu(wx.Menu):
                 crystal_params = [float(x) for x in crystal_params if x != ""]
         parameters = gauss_params + crystal_params
         tt_cutoff = self.parent.max_2theta - (float(self.parent.text_ctrl_variance.GetValue())/2)
-        material = materials.Crystal("material", materials.SGLattice(int(self.parent.SG_num), *[float(i) for i in crystal_params]))
-        indexing_info = simpack.PowderDiffraction(material, tt_cutoff = tt_cutoff, enable_simulation = False, wl = self.parent.wavelength).data
-        num_peaks = len(indexing_info.keys())
+        num_peaks = len(reflection_list(self.parent.SG_num, crystal_params, tt_cutoff, self.parent.wavelength)["hkl"])
         fig = plot_fit_function(parameters, self.parent.SG_num, self.parent.max_2theta, self.parent.wavelength, data_path, int(self.parent.fit_window_size),num_peaks)
         self.parent.spawn_plot(fig, name = str("Fit for "+item))
         
@@ -1634,5 +1689,6 @@ class MyApp(wx.App):
 # end of class MyApp
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()#parallel fits spawn worker processes, needed for the frozen .exe
     app = MyApp(0)
     app.MainLoop()
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+"""
+Indexing helpers for PTSFit
+
+General use:
+
+Lattice parameters are passed around as the variable length lists used by the GUI and xrayutilities:
+cubic [a], hexagonal/trigonal [a, c], tetragonal [a, c], orthorhombic [a, b, c], monoclinic [a, b, c, beta], triclinic [a, b, c, alpha, beta, gamma]
+full_lattice(SG_num, lattice_params) expands such a list to (a, b, c, alpha, beta, gamma), angles in degrees
+lattice_size(SG_num) is the length of the list for a space group
+
+reflection_list(SG_num, lattice_params, tt_cutoff, wavelength) returns the reflections below tt_cutoff, ordered by 2theta, as a dictionary of
+    "hkl" : (n x 3) integer array, one representative hkl per reflection
+    "multiplicity" : number of symmetry equivalent hkls of each reflection
+    "two_theta" : 2theta (degrees) of each reflection for the lattice the list was made from
+The list comes from xrayutilities once per space group, cutoff and wavelength, small changes in the lattice (as during a refinement) reuse it
+Lists are also kept on disk in REFLECTION_CACHE_DIR so later runs do not have to index again
+
+peak_positions(SG_num, lattice_params, hkl, wavelength) gives the 2theta (degrees) of each hkl from Bragg's law
+1/d^2 = h.G*.h where G* is the reciprocal metric tensor of the lattice, this replaces building a Crystal and PowderDiffraction per call
+
+lattice_kernel(SG_num, lattice_params, hkl, wavelength) does the same for many frames at once, lattice_params is (frames x params)
+(one row per frame, in the GUI layout above) and the return is a dictionary of
+    "cell" : (frames x 6) a, b, c, alpha, beta, gamma
+    "reciprocal_metric" : (frames x 3 x 3) G*
+    "d_spacing" : (frames x reflections)
+    "two_theta" : (frames x reflections) in degrees, nan where the reflection is beyond the wavelength's reach
+    "volume" : (frames) cell volume, sqrt(det G)
+hkl and wavelength may be None when only the cell, G* and volume are wanted
+With gradient = True it also gives
+    "two_theta_gradient" : (frames x reflections x params) derivative of each 2theta (degrees) with respect to each GUI lattice parameter
+from d(1/d^2)/dp = -h.G*.(dG/dp).G*.h and Bragg's law, for analytic jacobians
+"""
+
+import os
+import json
+import hashlib
+
+import numpy as np
+
+REFLECTION_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".ptsfit", "reflections")
+LATTICE_REUSE_TOLERANCE = 0.05 #relative change of any lattice parameter up to which a reflection list is reused
+
+_reflection_memo = {}#(SG_num, cutoff, wavelength): list of reflection lists made for different lattices
+
+#where a, b, c, alpha, beta, gamma come from for each crystal system, an int is a column of the GUI lattice parameter list, a float is fixed
+LATTICE_LAYOUT = {
+    "cubic" : (0, 0, 0, 90., 90., 90.),
+    "hexagonal" : (0, 0, 1, 90., 90., 120.),
+    "tetragonal" : (0, 0, 1, 90., 90., 90.),
+    "orthorhombic" : (0, 1, 2, 90., 90., 90.),
+    "monoclinic" : (0, 1, 2, 90., 3, 90.),
+    "triclinic" : (0, 1, 2, 3, 4, 5),
+    }
+
+def crystal_system(SG_num):#space group number to a LATTICE_LAYOUT key, trigonal groups use the hexagonal setting
+    SG_num = int(SG_num)
+    if SG_num > 194:
+        return "cubic"
+    if SG_num > 142:
+        return "hexagonal"
+    if SG_num > 74:
+        return "tetragonal"
+    if SG_num > 15:
+        return "orthorhombic"
+    if SG_num > 2:
+        return "monoclinic"
+    return "triclinic"
+
+def lattice_size(SG_num):#number of GUI lattice parameters of a space group
+    return len(set(i for i in LATTICE_LAYOUT[crystal_system(SG_num)] if isinstance(i, int)))
+
+def full_lattices(SG_num, lattice_params):#(frames x params) GUI lattice parameters to (frames x 6) a, b, c, alpha, beta, gamma
+    lattice_params = np.asarray(lattice_params, dtype = np.float64)
+    cells = np.empty((lattice_params.shape[0], 6))
+    for column, source in enumerate(LATTICE_LAYOUT[crystal_system(SG_num)]):
+        if isinstance(source, int):
+            cells[:, column] = lattice_params[:, source]
+        else:
+            cells[:, column] = source
+    return cells
+
+def full_lattice(SG_num, lattice_params):#expand one GUI lattice parameter list to a, b, c, alpha, beta, gamma
+    return tuple(full_lattices(SG_num, [lattice_params])[0])
+
+def metric_tensors(cells):#(frames x 6) cells to (frames x 3 x 3) direct metric tensors, angles in degrees
+    cells = np.asarray(cells, dtype = np.float64)
+    a, b, c = cells[:, 0], cells[:, 1], cells[:, 2]
+    ca, cb, cg = np.cos(np.radians(cells[:, 3:6])).T
+    metric = np.empty((cells.shape[0], 3, 3))
+    metric[:, 0, 0] = a*a
+    metric[:, 1, 1] = b*b
+    metric[:, 2, 2] = c*c
+    metric[:, 0, 1] = metric[:, 1, 0] = a*b*cg
+    metric[:, 0, 2] = metric[:, 2, 0] = a*c*cb
+    metric[:, 1, 2] = metric[:, 2, 1] = b*c*ca
+    return metric
+
+def metric_tensor(a, b, c, alpha, beta, gamma):#direct metric tensor of one cell, angles in degrees
+    return metric_tensors([[a, b, c, alpha, beta, gamma]])[0]
+
+def cell_volumes(cells):#(frames x 6) cells to volumes, sqrt(det G) written out so right angles stay exact
+    cells = np.asarray(cells, dtype = np.float64)
+    ca, cb, cg = np.cos(np.radians(cells[:, 3:6])).T
+    return cells[:, 0]*cells[:, 1]*cells[:, 2]*np.sqrt(1 - ca**2 - cb**2 - cg**2 + 2*ca*cb*cg)
+
+def metric_tensor_gradients(cells):#(frames x 6 x 3 x 3) derivative of G with respect to a, b, c, alpha, beta, gamma (angles in degrees)
+    cells = np.asarray(cells, dtype = np.float64)
+    a, b, c = cells[:, 0], cells[:, 1], cells[:, 2]
+    ca, cb, cg = np.cos(np.radians(cells[:, 3:6])).T
+    sa, sb, sg = np.sin(np.radians(cells[:, 3:6])).T*(np.pi/180)
+    gradient = np.zeros((cells.shape[0], 6, 3, 3))
+    gradient[:, 0, 0, 0] = 2*a
+    gradient[:, 0, 0, 1] = gradient[:, 0, 1, 0] = b*cg
+    gradient[:, 0, 0, 2] = gradient[:, 0, 2, 0] = c*cb
+    gradient[:, 1, 1, 1] = 2*b
+    gradient[:, 1, 0, 1] = gradient[:, 1, 1, 0] = a*cg
+    gradient[:, 1, 1, 2] = gradient[:, 1, 2, 1] = c*ca
+    gradient[:, 2, 2, 2] = 2*c
+    gradient[:, 2, 0, 2] = gradient[:, 2, 2, 0] = a*cb
+    gradient[:, 2, 1, 2] = gradient[:, 2, 2, 1] = b*ca
+    gradient[:, 3, 1, 2] = gradient[:, 3, 2, 1] = -b*c*sa
+    gradient[:, 4, 0, 2] = gradient[:, 4, 2, 0] = -a*c*sb
+    gradient[:, 5, 0, 1] = gradient[:, 5, 1, 0] = -a*b*sg
+    return gradient
+
+def lattice_kernel(SG_num, lattice_params, hkl = None, wavelength = None, gradient = False):#batched G*, d-spacings, 2theta and volumes, see module docstring
+    lattice_params = np.asarray(lattice_params, dtype = np.float64)
+    cells = full_lattices(SG_num, lattice_params)
+    metric = metric_tensors(cells)
+    result = {
+        "cell" : cells,
+        "reciprocal_metric" : np.linalg.inv(metric),
+        "volume" : cell_volumes(cells),
+        }
+    if hkl is not None:
+        hkl = np.asarray(hkl, dtype = np.float64).reshape(-1, 3)
+        inv_d2 = np.einsum("rj,fjk,rk->fr", hkl, result["reciprocal_metric"], hkl)
+        result["d_spacing"] = 1/np.sqrt(inv_d2)
+        if wavelength is not None:
+            with np.errstate(invalid = "ignore"):
+                result["two_theta"] = 2*np.degrees(np.arcsin(wavelength*np.sqrt(inv_d2)/2))
+        if gradient:
+            #fold the cell gradients onto the GUI parameters they come from, then d(1/d^2)/dp = -(G*h).(dG/dp).(G*h)
+            cell_gradient = metric_tensor_gradients(cells)
+            param_gradient = np.zeros((cells.shape[0], lattice_params.shape[1], 3, 3))
+            for column, source in enumerate(LATTICE_LAYOUT[crystal_system(SG_num)]):
+                if isinstance(source, int):
+                    param_gradient[:, source] += cell_gradient[:, column]
+            reciprocal_h = np.einsum("fjk,rk->frj", result["reciprocal_metric"], hkl)
+            inv_d2_gradient = -np.einsum("frj,fpjk,frk->frp", reciprocal_h, param_gradient, reciprocal_h)
+            #2theta = 2 asin(lambda sqrt(1/d^2)/2), so d2theta/d(1/d^2) = lambda/(2 sqrt(1/d^2) cos(theta)), in degrees
+            with np.errstate(invalid = "ignore", divide = "ignore"):
+                sin_theta = wavelength*np.sqrt(inv_d2)/2
+                scale = np.degrees(wavelength/(2*np.sqrt(inv_d2)*np.sqrt(1 - sin_theta**2)))
+            result["two_theta_gradient"] = inv_d2_gradient*scale[:, :, None]
+    return result
+
+def peak_positions(SG_num, lattice_params, hkl, wavelength):#2theta (degrees) of each hkl for one lattice
+    return lattice_kernel(SG_num, [lattice_params], hkl, wavelength)["two_theta"][0]
+
+def cell_volume(SG_num, lattice_params):#volume of one lattice
+    return float(lattice_kernel(SG_num, [lattice_params])["volume"][0])
+
+def _close_lattice(reference, lattice_params):
+    reference = np.asarray(reference)
+    lattice_params = np.asarray(lattice_params, dtype = np.float64)
+    if reference.shape != lattice_params.shape:
+        return False
+    return np.all(np.abs(lattice_params/reference - 1) <= LATTICE_REUSE_TOLERANCE)
+
+def _cache_path(key, lattice_params):
+    name = repr((key, [round(float(i), 2) for i in lattice_params]))
+    return os.path.join(REFLECTION_CACHE_DIR, hashlib.sha1(name.encode("utf-8")).hexdigest() + ".json")
+
+def _index_reflections(SG_num, lattice_params, tt_cutoff, wavelength):#the expensive part, only done on a cache miss
+    import xrayutilities.materials as materials
+    import xrayutilities.simpack as simpack
+    material = materials.Crystal("material", materials.SGLattice(int(SG_num), *[float(i) for i in lattice_params]))
+    indexing_info = simpack.PowderDiffraction(material, tt_cutoff = tt_cutoff, enable_simulation = False, wl = wavelength).data
+    hkl = [list(key) for key in indexing_info.keys()]
+    multiplicity = [len(material.lattice.equivalent_hkls(tuple(i))) for i in hkl]
+    two_theta = [float(indexing_info[key]["ang"]*2) for key in indexing_info.keys()]
+    return {"hkl" : hkl, "multiplicity" : multiplicity, "two_theta" : two_theta}
+
+def reflection_list(SG_num, lattice_params, tt_cutoff, wavelength):#reflections below tt_cutoff ordered by 2theta, see module docstring
+    key = (int(SG_num), round(float(tt_cutoff), 3), round(float(wavelength), 6))
+    for reflections in _reflection_memo.get(key, []):
+        if _close_lattice(reflections["lattice"], lattice_params):
+            return reflections
+    lattice_params = [float(i) for i in lattice_params]
+    path = _cache_path(key, lattice_params)
+    try:
+        with open(path) as file:
+            stored = json.load(file)
+    except (OSError, ValueError):
+        stored = _index_reflections(SG_num, lattice_params, tt_cutoff, wavelength)
+        try:
+            os.makedirs(REFLECTION_CACHE_DIR, exist_ok = True)
+            temp_path = path + ".%d.part" % os.getpid()
+            with open(temp_path, mode = "w") as file:
+                json.dump(stored, file)
+            os.replace(temp_path, path)
+        except OSError:#the on-disk cache is optional
+            pass
+    reflections = {
+        "hkl" : np.array(stored["hkl"], dtype = np.int64).reshape(-1, 3),
+        "multiplicity" : np.array(stored["multiplicity"], dtype = np.int64),
+        "two_theta" : np.array(stored["two_theta"], dtype = np.float64),
+        "lattice" : np.array(lattice_params),
+        }
+    _reflection_memo.setdefault(key, []).append(reflections)
+    return reflections
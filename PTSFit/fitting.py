@@ -0,0 +1,558 @@
+# -*- coding: utf-8 -*-
+"""
+Peak fitting functions for PTSFit
+
+General use:
+
+A pattern is fitted in windows of theta_variance data points either side of each indexed peak, each window holds one gaussian
+The residual functions share the signature (parameters, SG_num, ttheta_max, wavelength, data_file, theta_variance, num_peaks) used by least_squares args
+data_file is a path or an (x, y) pair, see patterns.as_pattern, and the peak positions come from the lattice parameters via crystallography
+
+Profile modes (PROFILE_MODES, name: residual function, jacobian, expand function):
+    "peaks" : parameters are [scale, scale,... sigma, sigma,... shift, shift,... lattice params], fit_function/fit_jacobian
+    "projected" : [sigma, sigma,... lattice params], scales and shifts are solved in closed form inside each call (variable projection),
+                  kept >= 0 as the bounds of the "peaks" mode keep them
+    "caglioti" : [scale, scale,... U, V, W, b_0,... b_BACKGROUND_ORDER, lattice params], widths from FWHM^2 = U tan^2(theta) + V tan(theta) + W
+                 and one polynomial background across the pattern
+The expand functions turn the result of a reduced mode back into the "peaks" layout so results are reported the same way
+multiphase_fit_function/multiphase_jacobian fit several phases to one pattern with the "peaks" profile, see the multi-phase section
+joint_fit_function/joint_jacobian fit a block of frames together, with smoothness_penalty tying neighbouring frames' lattices, see the joint section
+Jacobians are analytic and returned as sparse matrices, the residuals of a window only depend on that peak's parameters and the lattice
+
+do_fit(function, params, bounds, args, jac, x_scale) runs least_squares with the lsmr trust region solver used for these sparse jacobians
+Its budget for one frame is set by tolerance (ftol and xtol), max_nfev and max_seconds, a fit stopped by the wall clock returns the best
+point evaluated so far with status TIMED_OUT
+"""
+
+import time
+from threading import local
+
+import numpy as np
+from scipy.optimize import least_squares, Bounds, OptimizeResult
+from scipy.sparse import block_diag, csr_matrix, diags, vstack
+from scipy.sparse.linalg import lsmr
+
+from crystallography import cell_volume, lattice_kernel, lattice_size, peak_positions, reflection_list
+from patterns import as_pattern
+
+BACKGROUND_ORDER = 2 #order of the shared polynomial background of the Caglioti profile mode
+FWHM_TO_SIGMA = 1/(2*np.sqrt(2*np.log(2)))
+TIMED_OUT = -2 #status of a fit stopped by its wall clock budget (least_squares uses -1 to 4)
+
+_fit_state = local() #window memo and residual workspace, one per thread so fits running side by side do not share buffers
+
+def window_bounds(x, theta_peak_guess, theta_variance): #start, stop index arrays of the data window about each peak, x must be sorted
+    #the windows only change when a peak moves past a datum, so the last set is kept and reused until the bracketing points change
+    memo = getattr(_fit_state, "windows", None)
+    peaks = np.asarray(theta_peak_guess, dtype = np.float64)
+    # take the point directly below and above each peak, and theta_variance-1 more points on either side
+    nearest_below = np.searchsorted(x, peaks, side = "left") - 1
+    nearest_above = np.searchsorted(x, peaks, side = "right")
+    if memo is not None and memo["x"] is x and memo["theta_variance"] == theta_variance and np.array_equal(memo["nearest_below"], nearest_below) and np.array_equal(memo["nearest_above"], nearest_above):
+        return memo["start"], memo["stop"]
+    start = np.maximum(nearest_below + 1 - theta_variance, 0)
+    stop = np.minimum(nearest_above + theta_variance, x.size)
+    _fit_state.windows = {"x" : x, "theta_variance" : theta_variance, "nearest_below" : nearest_below, "nearest_above" : nearest_above, "start" : start, "stop" : stop}
+    return start, stop
+
+def window_tensor(x, theta_peak_guess, theta_variance): #padded (peaks x width) index array into x and the mask of which entries are real data
+    start, stop = window_bounds(x, theta_peak_guess, theta_variance)
+    memo = _fit_state.windows
+    if "index" not in memo:
+        lengths = stop - start
+        offsets = np.arange(lengths.max(initial = 0))
+        memo["index"] = np.minimum(start[:, None] + offsets, x.size - 1)
+        memo["mask"] = offsets < lengths[:, None]
+    return memo["index"], memo["mask"]
+
+def window_overlaps(x, theta_peak_guess, theta_variance): #(window, peak, holds) pairs of the windows that overlap and the (peaks x width) mask of points counted
+    #window[n] and peak[n] are the window and the peak of pair n, holds[n] which points of that window the peak's window also holds, every
+    #window is paired with itself and with the windows overlapping it, so the pairs grow with the peaks and not their square
+    #a point held by several windows is counted in the first of them only, so overlapping windows act as one region, kept with the window memo
+    index, mask = window_tensor(x, theta_peak_guess, theta_variance)
+    memo = _fit_state.windows
+    if "pairs" not in memo:
+        start, stop = memo["start"], memo["stop"]
+        #the windows that start within the longest window length before a window and before its end, sorted by start
+        order = np.argsort(start, kind = "stable")
+        first = np.searchsorted(start[order], start - (stop - start).max(initial = 0), side = "left")
+        counts = np.searchsorted(start[order], stop, side = "left") - first
+        window = np.repeat(np.arange(len(start)), counts)
+        peak = order[np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts - first, counts)]
+        overlap = stop[peak] > start[window]
+        window, peak = window[overlap], peak[overlap]
+        holds = (start[peak][:, None] <= index[window]) & (index[window] < stop[peak][:, None]) & mask[window]
+        hidden = np.zeros(mask.shape, dtype = bool)#held by an earlier window
+        earlier = peak < window
+        np.logical_or.at(hidden, window[earlier], holds[earlier])
+        memo["pairs"] = (window, peak, holds)
+        memo["counted"] = mask & ~hidden
+    return memo["pairs"], memo["counted"]
+
+def fit_workspace(shape): #preallocated (peaks x width) buffers for the window model, reused while the window shape stays the same
+    workspace = getattr(_fit_state, "workspace", None)
+    if workspace is None or workspace["x"].shape != shape:
+        workspace = {name : np.empty(shape) for name in ("x", "y_obs", "profile", "y_calc", "y_diff")}
+        _fit_state.workspace = workspace
+    return workspace
+
+def data2slices(x, y, theta_peak_guess, theta_variance): #creates a data slice about each peak position
+    start, stop = window_bounds(x, theta_peak_guess, theta_variance)
+    return [(x[i:j], y[i:j]) for i, j in zip(start, stop)]
+
+def gauss(x, amp, cen, sigma, shift):#basic gaussian function
+    return amp * np.exp(-(x-cen)**2 / (2.*sigma**2)) + shift
+
+def window_profile(x, y, sigmas, peaks, theta_variance):#gathers the windows and draws a unit height gaussian of every peak over its window in one go
+    #every array here is (peaks x width), padding past the end of a short window is masked out and gives a zero difference
+    index, mask = window_tensor(x, peaks, theta_variance)
+    workspace = fit_workspace(index.shape)
+    profile = workspace["profile"]
+    np.take(x, index, out = workspace["x"])
+    np.take(y, index, out = workspace["y_obs"])
+    np.subtract(workspace["x"], np.asarray(peaks)[:, None], out = profile)
+    np.square(profile, out = profile)
+    np.divide(profile, -2.*np.asarray(sigmas)[:, None]**2, out = profile)
+    np.exp(profile, out = profile)
+    return workspace, mask
+
+def window_difference(workspace, mask, amps, shifts):#scales the profiles to y_calc = amp*profile + shift and takes the signed difference to y_obs
+    #signed, abs() would put a kink in the cost at every datum the model crosses
+    #shifts is one value per window, or a (peaks x width) background
+    y_calc = workspace["y_calc"]
+    y_diff = workspace["y_diff"]
+    shifts = np.asarray(shifts)
+    np.multiply(workspace["profile"], np.asarray(amps)[:, None], out = y_calc)
+    np.add(y_calc, shifts[:, None] if shifts.ndim == 1 else shifts, out = y_calc)
+    np.subtract(workspace["y_obs"], y_calc, out = y_diff)
+    np.multiply(y_diff, mask, out = y_diff)
+
+def window_model(x, y, gaussian_params, peaks, theta_variance):#draws the gaussian of every peak over its window, returns the workspace and the window mask
+    num = len(peaks)
+    workspace, mask = window_profile(x, y, gaussian_params[num:2*num], peaks, theta_variance)
+    window_difference(workspace, mask, gaussian_params[0:num], gaussian_params[2*num:3*num])
+    return workspace, mask
+
+def linear_params(workspace, mask):#closed form amp and shift of every window, the least squares fit of y_obs to amp*profile + shift with amp, shift >= 0
+    #amps and shifts are bounded at 0 as in the "peaks" mode, a window whose unconstrained fit breaks a bound takes the better of
+    #the best fits with the amp at 0 (a flat window, fitted by its mean) and with the shift at 0, the bounded optimum is one of these
+    profile = workspace["profile"]*mask
+    y_obs = workspace["y_obs"]*mask
+    n = mask.sum(axis = 1)
+    s_p = profile.sum(axis = 1)
+    s_pp = np.einsum("ij,ij->i", profile, profile)
+    s_y = y_obs.sum(axis = 1)
+    s_py = np.einsum("ij,ij->i", profile, y_obs)
+    s_yy = np.einsum("ij,ij->i", y_obs, y_obs)
+    cost = lambda amps, shifts: s_yy - 2*amps*s_py - 2*shifts*s_y + amps**2*s_pp + 2*amps*shifts*s_p + shifts**2*n
+    with np.errstate(invalid = "ignore", divide = "ignore"):
+        amps = (n*s_py - s_p*s_y)/(n*s_pp - s_p**2)
+        shifts = (s_y - amps*s_p)/np.maximum(n, 1)
+        free = np.isfinite(amps) & (amps >= 0) & (shifts >= 0)
+        amp_only = np.where(s_pp > 0, np.maximum(s_py/s_pp, 0.), 0.)
+        shift_only = np.maximum(s_y/np.maximum(n, 1), 0.)
+        candidates = np.array([[np.where(free, amps, 0.), amp_only, np.zeros_like(amps)], [np.where(free, shifts, 0.), np.zeros_like(amps), shift_only]])
+        costs = np.array([np.where(free, cost(candidates[0, 0], candidates[1, 0]), np.inf), cost(amp_only, 0.), cost(0., shift_only)])
+    best = np.argmin(costs, axis = 0)
+    window = np.arange(len(best))
+    return candidates[0, best, window], candidates[1, best, window]
+
+def project_out_linear(workspace, mask, columns, amps, shifts):#the part of each (peaks x width x k) column not explained by the window's free linear params
+    #the profile and the constant of a window are projected out only where its amp and shift (from linear_params) are off their bound
+    #at 0, a linear param held at its bound does not follow the other parameters
+    profile = workspace["profile"]*mask
+    columns = columns*mask[:, :, None]
+    n = mask.sum(axis = 1)[:, None]
+    s_p = profile.sum(axis = 1)[:, None]
+    s_pp = np.einsum("ij,ij->i", profile, profile)[:, None]
+    s_c = columns.sum(axis = 1)
+    s_pc = np.einsum("ij,ijk->ik", profile, columns)
+    free_amp, free_shift = (np.asarray(amps) > 0)[:, None], (np.asarray(shifts) > 0)[:, None]
+    with np.errstate(invalid = "ignore", divide = "ignore"):
+        a = np.where(free_shift, (n*s_pc - s_p*s_c)/(n*s_pp - s_p**2), s_pc/s_pp)
+        a = np.where(np.isfinite(a) & free_amp, a, 0.)
+        b = np.where(free_shift, (s_c - a*s_p)/np.maximum(n, 1), 0.)
+    return columns - (profile[:, :, None]*a[:, None, :] + b[:, None, :])*mask[:, :, None]
+
+def fit_function(parameters, SG_num, ttheta_max, wavelength, data_file, theta_variance, num_peaks):
+    #fitting function for use in LS, requires a 1D array of residuals to be output
+    #get the data as x, y arrays, data_file is a path (cached, so repeated calls during a fit do not re-read the file) or an (x, y) frame
+    x_data, y_data = as_pattern(data_file)
+    
+    #seperate parameters list into gaussian params and lattice params
+    gaussian_params = parameters[0:3*num_peaks]
+    lattice_params = parameters[len(gaussian_params):]
+    
+    #generate peaks in 2theta, the hkl list is indexed once and the positions follow from the lattice parameters:
+    reflections = reflection_list(SG_num, lattice_params, ttheta_max+5, wavelength)
+    peak_list = peak_positions(SG_num, lattice_params, reflections["hkl"][:num_peaks], wavelength)
+        
+    #do gaussian model over the windows about each peak and get difference between y_obs and y_calc
+    workspace, mask = window_model(x_data, y_data, gaussian_params, peak_list, theta_variance)
+
+    #LS keeps earlier residual vectors, so hand back a copy rather than the workspace
+    return workspace["y_diff"].ravel().copy()
+
+def jacobian_structure(num_peaks, width, num_params, per_peak = 3): #csr index arrays of the jacobian, the residuals of window i only depend on peak i's parameters and the lattice
+    #per_peak is the number of parameter blocks of length num_peaks ahead of the lattice parameters (amps, sigmas, shifts for fit_function)
+    structure = getattr(_fit_state, "jacobian_structure", None)
+    if structure is None or structure["shape"] != (num_peaks, width, num_params, per_peak):
+        peak = np.repeat(np.arange(num_peaks), width)
+        columns = np.column_stack(tuple(block*num_peaks + peak for block in range(per_peak)) + tuple(np.full(peak.size, i) for i in range(per_peak*num_peaks, num_params)))
+        row_length = columns.shape[1]
+        indptr = np.arange(0, (peak.size + 1)*row_length, row_length)
+        structure = {"shape" : (num_peaks, width, num_params, per_peak), "indices" : columns.ravel(), "indptr" : indptr}
+        _fit_state.jacobian_structure = structure
+    return structure
+
+def fit_sparsity(function, parameters, SG_num, ttheta_max, wavelength, data_file, theta_variance, num_peaks):
+    #sparsity pattern of the jacobian of a profile mode's residual function at the starting parameters, for LS jac_sparsity when the
+    #jacobian is estimated by finite differences, the layout of the parameters follows the mode (see SPARSITY_BLOCKS)
+    if function not in SPARSITY_BLOCKS:
+        raise ValueError("No jacobian sparsity pattern for "+function.__name__+", fit it with its analytic jacobian")
+    x_data, y_data = as_pattern(data_file)
+    lattice_params = parameters[len(parameters)-lattice_size(SG_num):]
+    reflections = reflection_list(SG_num, lattice_params, ttheta_max+5, wavelength)
+    peak_list = peak_positions(SG_num, lattice_params, reflections["hkl"][:num_peaks], wavelength)
+    index, mask = window_tensor(x_data, peak_list, theta_variance)
+    structure = jacobian_structure(num_peaks, index.shape[1], len(parameters), per_peak = SPARSITY_BLOCKS[function])
+    return csr_matrix((np.ones(structure["indices"].size), structure["indices"], structure["indptr"]), shape = (index.size, len(parameters)))
+
+def fit_jacobian(parameters, SG_num, ttheta_max, wavelength, data_file, theta_variance, num_peaks):
+    #analytic jacobian of fit_function, same arguments, sparse (residuals x parameters), see jacobian_structure
+    #residual = y_obs - (amp*g + shift) with g = exp(-(x-cen)^2/(2 sigma^2)), the lattice parameters act through cen = 2theta(d(lattice))
+    x_data, y_data = as_pattern(data_file)
+    gaussian_params = parameters[0:3*num_peaks]
+    lattice_params = parameters[len(gaussian_params):]
+    reflections = reflection_list(SG_num, lattice_params, ttheta_max+5, wavelength)
+    kernel = lattice_kernel(SG_num, [lattice_params], reflections["hkl"][:num_peaks], wavelength, gradient = True)
+    peak_list = kernel["two_theta"][0]
+    workspace, mask = window_model(x_data, y_data, gaussian_params, peak_list, theta_variance)
+    amps = np.asarray(gaussian_params[0:num_peaks])[:, None]
+    sigmas = np.asarray(gaussian_params[num_peaks:2*num_peaks])[:, None]
+    profile = workspace["profile"]*mask
+    offset = workspace["x"] - peak_list[:, None]
+    d_cen = amps*profile*offset/sigmas**2#d y_calc / d cen
+    
+    #the nonzero values of each row in the column order of jacobian_structure: amp, sigma, shift, lattice params
+    peaks, width = mask.shape
+    num_params = len(parameters)
+    values = np.empty((peaks, width, 3 + num_params - 3*num_peaks))
+    values[:, :, 0] = -profile
+    values[:, :, 1] = -d_cen*offset/sigmas
+    values[:, :, 2] = -1.*mask
+    values[:, :, 3:] = -d_cen[:, :, None]*kernel["two_theta_gradient"][0][:, None, :]
+    structure = jacobian_structure(num_peaks, width, num_params)
+    return csr_matrix((values.ravel(), structure["indices"], structure["indptr"]), shape = (peaks*width, num_params))
+
+#variable projection: the amplitudes and shifts enter the model linearly, so they are solved in closed form inside every residual call
+#and LS only iterates over the sigmas and lattice parameters, parameters here are [sigma, sigma,... lattice params]
+
+def projected_fit_function(parameters, SG_num, ttheta_max, wavelength, data_file, theta_variance, num_peaks):
+    x_data, y_data = as_pattern(data_file)
+    lattice_params = parameters[num_peaks:]
+    reflections = reflection_list(SG_num, lattice_params, ttheta_max+5, wavelength)
+    peak_list = peak_positions(SG_num, lattice_params, reflections["hkl"][:num_peaks], wavelength)
+    workspace, mask = window_profile(x_data, y_data, parameters[0:num_peaks], peak_list, theta_variance)
+    amps, shifts = linear_params(workspace, mask)
+    window_difference(workspace, mask, amps, shifts)
+    return workspace["y_diff"].ravel().copy()
+
+def projected_jacobian(parameters, SG_num, ttheta_max, wavelength, data_file, theta_variance, num_peaks):
+    #Kaufman's approximation, the full model derivative with the linear directions (profile and constant of each window) projected out
+    x_data, y_data = as_pattern(data_file)
+    sigmas = np.asarray(parameters[0:num_peaks])[:, None]
+    lattice_params = parameters[num_peaks:]
+    reflections = reflection_list(SG_num, lattice_params, ttheta_max+5, wavelength)
+    kernel = lattice_kernel(SG_num, [lattice_params], reflections["hkl"][:num_peaks], wavelength, gradient = True)
+    peak_list = kernel["two_theta"][0]
+    workspace, mask = window_profile(x_data, y_data, parameters[0:num_peaks], peak_list, theta_variance)
+    amps, shifts = linear_params(workspace, mask)
+    offset = workspace["x"] - peak_list[:, None]
+    d_cen = amps[:, None]*workspace["profile"]*offset/sigmas**2#d y_calc / d cen
+    
+    peaks, width = mask.shape
+    num_params = len(parameters)
+    values = np.empty((peaks, width, 1 + num_params - num_peaks))
+    values[:, :, 0] = d_cen*offset/sigmas
+    values[:, :, 1:] = d_cen[:, :, None]*kernel["two_theta_gradient"][0][:, None, :]
+    values = -project_out_linear(workspace, mask, values, amps, shifts)
+    structure = jacobian_structure(num_peaks, width, num_params, per_peak = 1)
+    return csr_matrix((values.ravel(), structure["indices"], structure["indptr"]), shape = (peaks*width, num_params))
+
+def expand_projected(parameters, SG_num, ttheta_max, wavelength, data_file, theta_variance, num_peaks):
+    #full [amps, sigmas, shifts, lattice params] vector of fit_function for a projected fit result
+    x_data, y_data = as_pattern(data_file)
+    sigmas = parameters[0:num_peaks]
+    lattice_params = parameters[num_peaks:]
+    reflections = reflection_list(SG_num, lattice_params, ttheta_max+5, wavelength)
+    peak_list = peak_positions(SG_num, lattice_params, reflections["hkl"][:num_peaks], wavelength)
+    workspace, mask = window_profile(x_data, y_data, sigmas, peak_list, theta_variance)
+    amps, shifts = linear_params(workspace, mask)
+    return np.concatenate((amps, sigmas, shifts, lattice_params))
+
+#Caglioti profile: one amplitude per peak, the width of every peak from FWHM^2 = U tan^2(theta) + V tan(theta) + W
+#and a single polynomial background across the pattern, parameters here are [amp, amp,... U, V, W, b_0,... b_BACKGROUND_ORDER, lattice params]
+#the background is a polynomial in t = (2theta - centre)/half range of the pattern, which keeps the coefficients of similar size
+
+def caglioti_sigmas(U, V, W, peaks):#gaussian sigma of each peak and d sigma/d(U, V, W, 2theta)
+    tan_theta = np.tan(np.radians(np.asarray(peaks)/2))
+    fwhm2 = np.maximum(U*tan_theta**2 + V*tan_theta + W, 1e-12)
+    sigmas = FWHM_TO_SIGMA*np.sqrt(fwhm2)
+    d_fwhm2 = sigmas/(2*fwhm2)#d sigma/d FWHM^2
+    d_peak = d_fwhm2*(2*U*tan_theta + V)*(1 + tan_theta**2)*np.pi/360
+    return sigmas, np.column_stack((d_fwhm2*tan_theta**2, d_fwhm2*tan_theta, d_fwhm2)), d_peak
+
+def background_basis(workspace, x_data):#(peaks x width x BACKGROUND_ORDER+1) powers of the scaled 2theta of every window point
+    centre = (x_data[0] + x_data[-1])/2
+    half_range = max((x_data[-1] - x_data[0])/2, 1e-12)
+    t = (workspace["x"] - centre)/half_range
+    return t[:, :, None]**np.arange(BACKGROUND_ORDER + 1)
+
+def caglioti_model(parameters, SG_num, ttheta_max, wavelength, data_file, theta_variance, num_peaks, gradient = False):
+    x_data, y_data = as_pattern(data_file)
+    num_background = BACKGROUND_ORDER + 1
+    amps = np.asarray(parameters[0:num_peaks])
+    U, V, W = parameters[num_peaks:num_peaks+3]
+    background = np.asarray(parameters[num_peaks+3:num_peaks+3+num_background])
+    lattice_params = parameters[num_peaks+3+num_background:]
+    reflections = reflection_list(SG_num, lattice_params, ttheta_max+5, wavelength)
+    kernel = lattice_kernel(SG_num, [lattice_params], reflections["hkl"][:num_peaks], wavelength, gradient = gradient)
+    peak_list = kernel["two_theta"][0]
+    sigmas, d_sigma, d_sigma_peak = caglioti_sigmas(U, V, W, peak_list)
+    workspace, mask = window_profile(x_data, y_data, sigmas, peak_list, theta_variance)
+    basis = background_basis(workspace, x_data)
+    window_difference(workspace, mask, amps, basis @ background)
+    return workspace, mask, kernel, sigmas, d_sigma, d_sigma_peak, basis
+
+def caglioti_fit_function(parameters, SG_num, ttheta_max, wavelength, data_file, theta_variance, num_peaks):
+    workspace = caglioti_model(parameters, SG_num, ttheta_max, wavelength, data_file, theta_variance, num_peaks)[0]
+    return workspace["y_diff"].ravel().copy()
+
+def caglioti_jacobian(parameters, SG_num, ttheta_max, wavelength, data_file, theta_variance, num_peaks):
+    #as fit_jacobian, the peak centres now also move the widths through tan(theta)
+    workspace, mask, kernel, sigmas, d_sigma, d_sigma_peak, basis = caglioti_model(parameters, SG_num, ttheta_max, wavelength, data_file, theta_variance, num_peaks, gradient = True)
+    amps = np.asarray(parameters[0:num_peaks])[:, None]
+    sigmas = sigmas[:, None]
+    profile = workspace["profile"]*mask
+    offset = workspace["x"] - kernel["two_theta"][0][:, None]
+    d_width = amps*profile*offset**2/sigmas**3#d y_calc / d sigma
+    d_cen = amps*profile*offset/sigmas**2 + d_width*d_sigma_peak[:, None]#d y_calc / d cen, directly and through the width
+    
+    peaks, width = mask.shape
+    num_params = len(parameters)
+    values = np.empty((peaks, width, 1 + num_params - num_peaks))
+    values[:, :, 0] = profile
+    values[:, :, 1:4] = d_width[:, :, None]*d_sigma[:, None, :]
+    values[:, :, 4:4+basis.shape[2]] = basis*mask[:, :, None]
+    values[:, :, 4+basis.shape[2]:] = d_cen[:, :, None]*kernel["two_theta_gradient"][0][:, None, :]
+    structure = jacobian_structure(num_peaks, width, num_params, per_peak = 1)
+    return csr_matrix((-values.ravel(), structure["indices"], structure["indptr"]), shape = (peaks*width, num_params))
+
+def caglioti_start(gaussian_params, num_peaks):#[amps, U, V, W, background] from [amps, sigmas, shifts], constant width and flat background
+    amps = list(gaussian_params[0:num_peaks])
+    fwhm = np.mean(gaussian_params[num_peaks:2*num_peaks])/FWHM_TO_SIGMA
+    background = [float(np.mean(gaussian_params[2*num_peaks:3*num_peaks]))] + [0.]*BACKGROUND_ORDER
+    return amps + [0., 0., float(fwhm**2)] + background
+
+def caglioti_bounds(num_peaks, num_lattice):#amplitudes, W and the lattice are kept positive as in the full fit, U, V and the background are free
+    lower = [0.]*num_peaks + [-np.inf, -np.inf, 0.] + [-np.inf]*(BACKGROUND_ORDER + 1) + [0.]*num_lattice
+    return Bounds(lb = lower, ub = [np.inf for i in lower])
+
+def expand_caglioti(parameters, SG_num, ttheta_max, wavelength, data_file, theta_variance, num_peaks):
+    #full [amps, sigmas, shifts, lattice params] vector of fit_function for a Caglioti fit result, the shift is the background under each peak
+    x_data, y_data = as_pattern(data_file)
+    num_background = BACKGROUND_ORDER + 1
+    amps = np.asarray(parameters[0:num_peaks])
+    U, V, W = parameters[num_peaks:num_peaks+3]
+    background = np.asarray(parameters[num_peaks+3:num_peaks+3+num_background])
+    lattice_params = np.asarray(parameters[num_peaks+3+num_background:])
+    reflections = reflection_list(SG_num, lattice_params, ttheta_max+5, wavelength)
+    peak_list = peak_positions(SG_num, lattice_params, reflections["hkl"][:num_peaks], wavelength)
+    sigmas = caglioti_sigmas(U, V, W, peak_list)[0]
+    centre = (x_data[0] + x_data[-1])/2
+    half_range = max((x_data[-1] - x_data[0])/2, 1e-12)
+    shifts = np.polynomial.polynomial.polyval((peak_list - centre)/half_range, background)
+    return np.concatenate((amps, sigmas, shifts, lattice_params))
+
+#multi-phase: several phases fitted to one pattern as one problem, SG_num and num_peaks are tuples with one entry per phase
+#parameters are [scale... sigma... shift... of the peaks of every phase in phase order, lattice params of the first phase, of the second...]
+#the windows of all phases are cut from one data load in one window_tensor, a point held by several windows (overlapping peaks, of the
+#same or different phases) is counted once and the model there is the sum of the gaussians of every window holding it plus the shift
+#of the window it is counted in, so overlapping windows merge into one region, see window_overlaps
+
+def split_phases(parameters, SG_nums, num_peaks):#per phase [amps, sigmas, shifts] and lattice params lists of a multi-phase parameter vector
+    total = sum(num_peaks)
+    edges = np.cumsum((0,) + tuple(num_peaks))
+    gaussian_params = [[float(parameters[block*total + i]) for block in range(3) for i in range(first, last)] for first, last in zip(edges[:-1], edges[1:])]
+    lattice_params = []
+    position = 3*total
+    for SG_num in SG_nums:
+        lattice_params.append([float(i) for i in parameters[position:position+lattice_size(SG_num)]])
+        position += lattice_size(SG_num)
+    return gaussian_params, lattice_params
+
+def join_phases(gaussian_params, lattice_params):#multi-phase parameter vector from per phase [amps, sigmas, shifts] and lattice params lists
+    blocks = [[], [], []]
+    for params in gaussian_params:
+        num = len(params)//3
+        for block in range(3):
+            blocks[block] += list(params[block*num:(block+1)*num])
+    return blocks[0] + blocks[1] + blocks[2] + [i for params in lattice_params for i in params]
+
+def multiphase_model(parameters, SG_nums, ttheta_max, wavelength, data_file, theta_variance, num_peaks, gradient = False):
+    x_data, y_data = as_pattern(data_file)
+    total = sum(num_peaks)
+    amps, sigmas, shifts = (np.asarray(parameters[block*total:(block+1)*total]) for block in range(3))
+    peaks = []
+    peak_gradient = np.zeros((total, len(parameters) - 3*total))#d 2theta / d lattice params, each peak only moves with its own phase
+    first, position = 0, 3*total
+    for SG_num, num in zip(SG_nums, num_peaks):
+        lattice_params = parameters[position:position+lattice_size(SG_num)]
+        reflections = reflection_list(SG_num, lattice_params, ttheta_max+5, wavelength)
+        kernel = lattice_kernel(SG_num, [lattice_params], reflections["hkl"][:num], wavelength, gradient = gradient)
+        peaks.append(kernel["two_theta"][0])
+        if gradient:
+            peak_gradient[first:first+num, position-3*total:position-3*total+len(lattice_params)] = kernel["two_theta_gradient"][0]
+        first, position = first + num, position + len(lattice_params)
+    peak_list = np.concatenate(peaks)
+    pairs, counted = window_overlaps(x_data, peak_list, theta_variance)
+    window, peak, holds = pairs
+    index = _fit_state.windows["index"]
+    #(pairs x width) gaussian of the pair's peak over the points of the pair's window that the peak's window holds
+    offset = x_data[index[window]] - peak_list[peak][:, None]
+    profile = np.exp(-offset**2/(2.*sigmas[peak][:, None]**2))*holds
+    y_calc = np.repeat(shifts[:, None], counted.shape[1], axis = 1)
+    np.add.at(y_calc, window, amps[peak][:, None]*profile)
+    y_diff = (y_data[index] - y_calc)*counted
+    return y_diff, counted, pairs, profile, offset, peak_gradient
+
+def multiphase_fit_function(parameters, SG_nums, ttheta_max, wavelength, data_file, theta_variance, num_peaks):
+    return multiphase_model(parameters, SG_nums, ttheta_max, wavelength, data_file, theta_variance, num_peaks)[0].ravel()
+
+def multiphase_jacobian(parameters, SG_nums, ttheta_max, wavelength, data_file, theta_variance, num_peaks):
+    #as fit_jacobian, a residual now depends on every peak whose window holds its point, and on the lattice of each of their phases
+    #built from the (window, peak) pairs of window_overlaps, a row holds the amp and sigma of each peak whose window holds its point,
+    #the shift of the window it is counted in and the lattice params of the phases of those peaks, entries of a row in the same column are summed
+    y_diff, counted, pairs, profile, offset, peak_gradient = multiphase_model(parameters, SG_nums, ttheta_max, wavelength, data_file, theta_variance, num_peaks, gradient = True)
+    window, peak, holds = pairs
+    total = sum(num_peaks)
+    windows, width = counted.shape
+    amps = np.asarray(parameters[0:total])[peak][:, None]
+    sigmas = np.asarray(parameters[total:2*total])[peak][:, None]
+    d_cen = amps*profile*offset/sigmas**2#d y_calc / d cen
+    entries = holds & counted[window]#points counted in the pair's window that the pair's peak reaches
+    row = (window[:, None]*width + np.arange(width))[entries]
+    peaks = np.broadcast_to(peak[:, None], entries.shape)[entries]
+    counted_rows = np.flatnonzero(counted)
+    rows = [row, row, counted_rows]
+    columns = [peaks, total + peaks, 2*total + counted_rows//width]
+    values = [profile[entries], (d_cen*offset/sigmas)[entries], np.ones(counted_rows.size)]
+    d_cen = d_cen[entries]
+    for column, gradient in enumerate(peak_gradient.T, 3*total):#each peak only moves with the lattice params of its own phase
+        gradient = gradient[peaks]
+        moves = gradient != 0
+        rows.append(row[moves])
+        columns.append(np.full(moves.sum(), column))
+        values.append(d_cen[moves]*gradient[moves])
+    return csr_matrix((-np.concatenate(values), (np.concatenate(rows), np.concatenate(columns))), shape = (windows*width, len(parameters)))
+
+#joint fits: the frames of a block fitted as one problem, parameters are the fit parameters of every frame one after the other
+#frame_problems is a tuple of (residual function, jacobian, args) of each frame, edges the start of each frame's parameters and the end
+#penalty is None or the (matrix, offset) of smoothness_penalty, its residuals follow those of the frames
+#the jacobian is block diagonal with the penalty rows under it, so the lsmr solver's cost grows with the number of frames and not its square
+
+def smoothness_penalty(lattice_index, fixed, scale, weight):#sparse matrix and offset of the smoothness residuals matrix @ parameters + offset
+    #lattice_index is the (frames x lattice params) position of each frame's lattice parameters in the joint parameters, fixed holds the
+    #lattice parameters of frames fitted before the block (oldest first), which are not refitted but carry the smoothness over its start
+    #each residual is weight*(l[f-1] - 2*l[f] + l[f+1])/scale of one lattice parameter l over three neighbouring frames, so a steady ramp costs nothing
+    lattice_index = np.asarray(lattice_index)
+    fixed = np.asarray(fixed, dtype = np.float64).reshape(-1, lattice_index.shape[1])
+    rows, columns, values, offset = [], [], [], []
+    for centre in range(max(1, len(fixed) - 1), len(fixed) + len(lattice_index) - 1):
+        for param in range(lattice_index.shape[1]):
+            row = len(offset)
+            offset.append(0.)
+            for frame, coefficient in zip((centre - 1, centre, centre + 1), (1., -2., 1.)):
+                coefficient = weight*coefficient/scale[param]
+                if frame < len(fixed):
+                    offset[row] += coefficient*fixed[frame, param]
+                else:
+                    rows.append(row)
+                    columns.append(lattice_index[frame - len(fixed), param])
+                    values.append(coefficient)
+    matrix = csr_matrix((values, (rows, columns)), shape = (len(offset), int(lattice_index.max()) + 1))
+    return matrix, np.asarray(offset)
+
+def joint_fit_function(parameters, frame_problems, edges, penalty):
+    residuals = [function(parameters[first:last], *args) for (function, jacobian, args), first, last in zip(frame_problems, edges[:-1], edges[1:])]
+    if penalty is not None:
+        residuals.append(penalty[0] @ parameters + penalty[1])
+    return np.concatenate(residuals)
+
+def joint_jacobian(parameters, frame_problems, edges, penalty):
+    blocks = [csr_matrix(jacobian(parameters[first:last], *args)) for (function, jacobian, args), first, last in zip(frame_problems, edges[:-1], edges[1:])]
+    if penalty is not None:
+        return vstack((block_diag(blocks), penalty[0]), format = "csr")
+    return block_diag(blocks, format = "csr")
+
+def lattice2volume(SG_num, lattice_params):
+    return cell_volume(SG_num, lattice_params)
+
+def generate_LSparams(gauss_params, lattice_params):
+    initial_params = gauss_params + lattice_params
+    lower_bounds = [0 for i in initial_params]
+    upper_bounds = [np.inf for i in initial_params]
+    bounds = Bounds(lb = lower_bounds, ub = upper_bounds)
+    return initial_params, bounds,
+
+PROFILE_MODES = {
+    "peaks" : (fit_function, fit_jacobian, None),
+    "projected" : (projected_fit_function, projected_jacobian, expand_projected),
+    "caglioti" : (caglioti_fit_function, caglioti_jacobian, expand_caglioti),
+    }
+
+SPARSITY_BLOCKS = { #blocks of num_peaks per peak parameters ahead of the shared ones of each profile mode's residual function, see jacobian_structure
+    fit_function : 3,
+    projected_fit_function : 1,
+    caglioti_fit_function : 1,
+    }
+
+class _OutOfTime(Exception):
+    pass
+
+def do_fit(function, params, bounds, args, jac = "2-point", x_scale = 1.0, tolerance = 1e-8, max_nfev = None, max_seconds = None):#least_squares on one frame, jac is the jacobian matching function (see PROFILE_MODES)
+    #the jacobian is block sparse (each peak's parameters only reach its own window) so the lsmr trust region solver is used
+    #finite difference jacobians are given the same sparsity pattern, so they cost a handful of evaluations rather than one per parameter
+    jac_sparsity = None if callable(jac) else fit_sparsity(function, params, *args)
+    options = {"jac_sparsity" : jac_sparsity, "tr_solver" : "lsmr", "x_scale" : x_scale, "ftol" : tolerance, "xtol" : tolerance, "max_nfev" : max_nfev, "args" : args}
+    if max_seconds is None:
+        return least_squares(function, params, jac = jac, bounds = bounds, **options)
+    #least_squares has no time limit, so the residual function stops it by raising once the time is up, keeping the best point so far
+    deadline = time.perf_counter() + max_seconds
+    best = {"x" : np.array(params, dtype = np.float64), "cost" : np.inf, "nfev" : 0, "njev" : 0}
+    def timed_function(x, *args):
+        if time.perf_counter() > deadline:
+            raise _OutOfTime()
+        residuals = function(x, *args)
+        best["nfev"] += 1
+        cost = 0.5*np.dot(residuals, residuals)
+        if cost < best["cost"]:
+            best.update({"x" : np.array(x), "cost" : cost})
+        return residuals
+    def timed_jacobian(x, *args):
+        best["njev"] += 1
+        return jac(x, *args)
+    try:
+        return least_squares(timed_function, params, jac = timed_jacobian if callable(jac) else jac, bounds = bounds, **options)
+    except _OutOfTime:
+        return OptimizeResult(x = best["x"], cost = best["cost"], nfev = best["nfev"], njev = best["njev"], status = TIMED_OUT, success = False,
+            message = "Stopped after the wall clock budget of "+str(max_seconds)+" s")
+
+def newton_step(fit):#Gauss-Newton step from a least_squares result towards the minimum of its linearised problem, an estimate of the distance left by the tolerance
+    jacobian = csr_matrix(fit.jac)
+    #columns scaled to unit norm, scales, widths and lattice parameters differ by orders of magnitude,
+    #parameters held at a bound are left out (zero columns), the fit can not go further that way
+    norms = np.sqrt(np.asarray(jacobian.multiply(jacobian).sum(axis = 0))).ravel()
+    norms[(norms == 0) | (fit.active_mask != 0)] = np.inf
+    return -lsmr(jacobian @ diags(1/norms), fit.fun, atol = 1e-12, btol = 1e-12)[0]/norms
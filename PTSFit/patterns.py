@@ -0,0 +1,464 @@
+# -*- coding: utf-8 -*-
+"""
+Diffraction pattern loading for PTSFit
+
+General use:
+
+load_pattern(path) reads a space seperated x,y file (eg. a Dioptas .dat export) into two contiguous float64 numpy arrays, x (2theta) and y (intensity)
+get_pattern(path) returns the same arrays through a shared least recently used cache (pattern_cache)
+Cache entries are keyed by absolute path, modification time and file size, so a file that is rewritten on disk is re-read rather than served stale
+The cache is bounded to PATTERN_CACHE_SIZE patterns, the least recently used pattern is dropped when it is full
+
+Arrays handed out by the cache are shared between callers and are therefore read-only
+
+Frame sources:
+
+A sequential fit walks a "frame source", an object with a list of frame names, len() and frame(index) returning (x, y) arrays
+FileSeries wraps a list of x,y files (one file per frame, read through the cache)
+FrameStack holds a shared 2theta axis and an (frames x points) intensity block, frame(index) returns zero-copy slices
+pack_frame_stack(paths, out_path) converts a list of x,y files on a common 2theta axis into a single .ptstack file
+FrameStack.open(path) memory-maps a .ptstack file so frames are only read from disk when they are used
+HDF5Stack(path, dataset) reads frames from a (frames x points) dataset in an HDF5/NeXus file (needs h5py)
+Frames are read lazily, one block of rows (the dataset's chunk height) at a time, so the stack is never loaded whole
+Every frame source has close(), call it before dropping a source that holds a file open
+frame_source_spec(source) describes a source as a small picklable tuple and open_frame_source(spec) opens an equivalent source,
+so worker processes can read frames themselves rather than being sent the data
+Sources with extendable = True accept more files through extend(paths)
+
+load_series(paths) is the frame source to use for a list of x,y files
+If every file is on the same 2theta grid the x values are stored once and the intensities are held in a single (frames x points) FrameStack
+Otherwise the files are read one by one through a FileSeries
+
+.ptstack layout (little endian):
+    64 byte preamble: magic, version, frames, points, axis offset, data offset, frame table offset, frame table length
+    2theta axis, float64[points]
+    intensities, float64[frames, points], one row per frame
+    frame table, utf-8 JSON list of {"name", "path", "offset"} per frame, offset is the byte offset of the frame's row
+
+Dataset catalog:
+
+scan_patterns(paths) reads, hashes and summarises x,y files in a thread pool (file reads dominate on network filesystems)
+Each file is read once, the parsed arrays go into the pattern cache and are returned so they can be stacked without another read
+DatasetCatalog collects the summaries (2theta range, points, step, max intensity, sha1 of the file) of the loaded files
+It answers max 2theta, fit window size and consistency questions without touching the files again
+
+Live data:
+
+FolderWatcher(directory) reports pattern files that appear in a directory during a run, for fitting as they land
+poll() returns new files (oldest first) once their size and modification time have stopped changing for settle_time seconds
+Files are only ever reported once, files already handed out (or passed in as seen) are skipped without being stat'ed again
+"""
+
+import os
+import io
+import json
+import hashlib
+import struct
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+import numpy as np
+
+PATTERN_CACHE_SIZE = 128
+
+def load_pattern(filename):#read file with x,y values per line, returns contiguous float64 x and y arrays
+    data = np.loadtxt(filename, usecols = (0, 1), comments = "#", dtype = np.float64, ndmin = 2)
+    x = np.ascontiguousarray(data[:, 0])
+    y = np.ascontiguousarray(data[:, 1])
+    return x, y
+
+class PatternCache: #bounded LRU cache of parsed patterns, safe to share between threads
+    def __init__(self, max_size = PATTERN_CACHE_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def key(self, filename, stat = None):#path, mtime and size identify a particular version of a file
+        if stat is None:
+            stat = os.stat(filename)
+        return (os.path.abspath(filename), stat.st_mtime_ns, stat.st_size)
+
+    def get(self, filename):
+        key = self.key(filename)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            self.misses += 1
+        x, y = load_pattern(filename)
+        self.put(key, x, y)
+        return x, y
+
+    def put(self, key, x, y):
+        x.flags.writeable = False
+        y.flags.writeable = False
+        with self._lock:
+            self._entries[key] = (x, y)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last = False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+pattern_cache = PatternCache()
+
+def get_pattern(filename):#cached version of load_pattern, use this for anything called repeatedly
+    return pattern_cache.get(filename)
+
+def as_pattern(data):#accepts a path or an (x, y) pair, returns (x, y) arrays
+    if isinstance(data, (str, os.PathLike)):
+        return get_pattern(data)
+    x, y = data
+    return x, y
+
+def same_grid(x, x_axis):#True if two 2theta axes are identical
+    return x is x_axis or (x.size == x_axis.size and np.array_equal(x, x_axis))
+
+class FileSeries: #frame source of one x,y file per frame
+    def __init__(self, paths):
+        self.paths = list(paths)
+        self.names = [os.path.split(path)[1] for path in self.paths]
+        self.x = None #no shared 2theta axis
+        self.extendable = True
+
+    def __len__(self):
+        return len(self.paths)
+
+    def frame(self, index):
+        return get_pattern(self.paths[index])
+
+    def label(self, index):#where the frame came from, written to results
+        return self.paths[index]
+
+    def extend(self, paths, patterns = None):#patterns is accepted for symmetry with FrameStack, files are read when used
+        paths = list(paths)
+        self.paths += paths
+        self.names += [os.path.split(path)[1] for path in paths]
+
+    def close(self):
+        pass
+
+STACK_MAGIC = b"PTSSTACK"
+STACK_VERSION = 1
+STACK_PREAMBLE = struct.Struct("<8sQQQQQQQ")#magic, version, frames, points, axis offset, data offset, table offset, table length
+STACK_ALIGN = 64
+
+def _align(offset):
+    return -(-offset // STACK_ALIGN) * STACK_ALIGN
+
+class FrameStack: #frame source of a shared 2theta axis and an (frames x points) intensity block, in memory or memory-mapped
+    def __init__(self, x, intensities, names, paths = None, source = None):
+        self.x = x
+        self.intensities = intensities
+        self.names = list(names)
+        self.paths = list(paths) if paths is not None else list(self.names)
+        self.source = source #file the stack was mapped from, if any
+        self.offsets = None
+        self.extendable = source is None #a mapped stack is read-only
+        self._buffer = None #spare rows, so adding frames one at a time does not copy the whole block each time
+
+    def __len__(self):
+        return self.intensities.shape[0]
+
+    def frame(self, index):
+        return self.x, self.intensities[index]
+
+    def label(self, index):
+        if self.source is None:
+            return self.paths[index]
+        return self.source + "::" + self.names[index]
+
+    def extend(self, paths, patterns = None):#add x,y files on the stack's 2theta grid, raises ValueError (adding nothing) if one is on a different grid
+        #patterns may hold the already parsed (x, y) of each path
+        if not self.extendable:
+            raise ValueError("Frames cannot be added to a mapped frame stack")
+        paths = list(paths)
+        if patterns is None:
+            patterns = (get_pattern(path) for path in paths)
+        n_frames = len(self)
+        n_needed = n_frames + len(paths)
+        if self._buffer is None or self._buffer.shape[0] < n_needed:
+            buffer = np.empty((max(n_needed, 2*n_frames), self.x.size), dtype = np.float64)
+            buffer[:n_frames] = self.intensities
+            self._buffer = buffer
+        for i, (path, (x, y)) in enumerate(zip(paths, patterns)):
+            if not same_grid(x, self.x):
+                raise ValueError(os.path.split(path)[1] + " is not on the 2theta grid of the loaded frames")
+            self._buffer[n_frames + i] = y
+        self.intensities = self._buffer[:n_needed]
+        self.names += [os.path.split(path)[1] for path in paths]
+        self.paths += paths
+
+    def close(self):
+        pass
+
+    @classmethod
+    def open(cls, path):#memory-map a .ptstack file, nothing but the header and frame table is read here
+        with open(path, mode = "rb") as file:
+            magic, version, n_frames, n_points, axis_offset, data_offset, table_offset, table_length = STACK_PREAMBLE.unpack(file.read(STACK_PREAMBLE.size))
+            if magic != STACK_MAGIC:
+                raise ValueError(str(path) + " is not a PTSFit frame stack")
+            if version != STACK_VERSION:
+                raise ValueError("Unsupported frame stack version " + str(version))
+            file.seek(table_offset)
+            table = json.loads(file.read(table_length).decode("utf-8"))
+        x = np.memmap(path, dtype = "<f8", mode = "r", offset = axis_offset, shape = (n_points,))
+        intensities = np.memmap(path, dtype = "<f8", mode = "r", offset = data_offset, shape = (n_frames, n_points))
+        stack = cls(x, intensities, [i["name"] for i in table], [i["path"] for i in table], source = os.path.abspath(path))
+        stack.offsets = [i["offset"] for i in table]
+        return stack
+
+def load_series(paths, patterns = None):#frame source for x,y files, a FrameStack if they share one 2theta grid, otherwise a FileSeries
+    paths = list(paths)
+    if paths == []:
+        return FileSeries(paths)
+    x_axis = patterns[0][0] if patterns is not None else get_pattern(paths[0])[0]
+    stack = FrameStack(x_axis, np.empty((0, x_axis.size), dtype = np.float64), [])
+    try:
+        stack.extend(paths, patterns)
+    except ValueError:#heterogeneous grids, read frame by frame
+        return FileSeries(paths)
+    return stack
+
+def pack_frame_stack(paths, out_path):#write x,y files sharing one 2theta axis into a single .ptstack file, returns the opened stack
+    paths = list(paths)
+    if paths == []:
+        raise ValueError("No datafiles to pack")
+    x_axis = get_pattern(paths[0])[0]
+    n_frames = len(paths)
+    n_points = x_axis.size
+    axis_offset = _align(STACK_PREAMBLE.size)
+    data_offset = _align(axis_offset + 8*n_points)
+    row_bytes = 8*n_points
+    table_offset = data_offset + n_frames*row_bytes
+    table = []
+    temp_path = out_path + ".part"
+    #written to a temporary file and moved into place so a half written stack is never left at out_path
+    with open(temp_path, mode = "wb") as file:
+        file.write(b"\0"*axis_offset)
+        file.write(x_axis.astype("<f8").tobytes())
+        file.write(b"\0"*(data_offset - axis_offset - row_bytes))
+        for i, path in enumerate(paths):
+            x, y = get_pattern(path)
+            if not same_grid(x, x_axis):
+                file.close()
+                os.remove(temp_path)
+                raise ValueError(os.path.split(path)[1] + " does not share the 2theta axis of " + os.path.split(paths[0])[1])
+            file.write(y.astype("<f8").tobytes())
+            table.append({"name" : os.path.split(path)[1], "path" : os.path.abspath(path), "offset" : data_offset + i*row_bytes})
+        table_bytes = json.dumps(table).encode("utf-8")
+        file.write(table_bytes)
+        file.seek(0)
+        file.write(STACK_PREAMBLE.pack(STACK_MAGIC, STACK_VERSION, n_frames, n_points, axis_offset, data_offset, table_offset, len(table_bytes)))
+    os.replace(temp_path, out_path)
+    return FrameStack.open(out_path)
+
+HDF5_BLOCK_BYTES = 8*1024*1024 #rows read at once from an unchunked dataset are limited to about this many bytes
+
+def list_hdf5_stacks(path):#names of all 2D datasets in an HDF5/NeXus file, candidates for HDF5Stack
+    import h5py
+    found = []
+    def visit(name, item):
+        if isinstance(item, h5py.Dataset) and item.ndim == 2:
+            found.append(name)
+    with h5py.File(path, mode = "r") as file:
+        file.visititems(visit)
+    return found
+
+def find_hdf5_axis(data):#find the 2theta axis belonging to a (frames x points) dataset
+    import h5py
+    n_points = data.shape[1]
+    group = data.parent
+    #NXdata groups name their axes, the last entry belongs to the last dimension
+    axes = group.attrs.get("axes")
+    if axes is not None:
+        if isinstance(axes, (str, bytes)):
+            axes = [axes]
+        name = axes[-1].decode() if isinstance(axes[-1], bytes) else str(axes[-1])
+        if name in group and group[name].shape == (n_points,):
+            return group[name]
+    #otherwise any 1D dataset of the right length next to the data
+    for name, item in group.items():
+        if isinstance(item, h5py.Dataset) and item.shape == (n_points,):
+            return item
+    raise ValueError("No 2theta axis of length " + str(n_points) + " found next to " + data.name)
+
+class HDF5Stack: #frame source over a (frames x points) dataset in an HDF5/NeXus file, read lazily block by block
+    def __init__(self, path, dataset, axis = None, frame_range = None):
+        import h5py
+        self.file = h5py.File(path, mode = "r")
+        self.data = self.file[dataset]
+        if self.data.ndim != 2:
+            self.file.close()
+            raise ValueError(dataset + " is not a (frames x points) dataset")
+        axis_dataset = self.file[axis] if axis is not None else find_hdf5_axis(self.data)
+        self.x = np.ascontiguousarray(axis_dataset[()], dtype = np.float64)
+        self.x.flags.writeable = False
+        self.source = os.path.abspath(path)
+        self.dataset = dataset
+        self.axis = axis
+        self.start, self.stop = frame_range if frame_range is not None else (0, self.data.shape[0])
+        if self.data.chunks is not None:
+            self.block_size = self.data.chunks[0]
+        else:
+            self.block_size = max(1, HDF5_BLOCK_BYTES // (8*self.data.shape[1]))
+        base_name = os.path.split(path)[1]
+        self.names = ["%s[%d]" % (base_name, i) for i in range(self.start, self.stop)]
+        self._block = None
+        self._block_start = None
+        self._lock = Lock()
+        self.extendable = False
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def frame(self, index):
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError("frame index out of range")
+        row = self.start + index
+        with self._lock:
+            #keep one block of rows in memory, sequential fits then touch each chunk once
+            if self._block is None or not (self._block_start <= row < self._block_start + self._block.shape[0]):
+                self._block_start = row - row % self.block_size
+                self._block = np.ascontiguousarray(self.data[self._block_start:min(self._block_start + self.block_size, self.data.shape[0])], dtype = np.float64)
+                self._block.flags.writeable = False
+            return self.x, self._block[row - self._block_start]
+
+    def label(self, index):
+        return self.source + "::" + self.dataset + "[" + str(self.start + index) + "]"
+
+    def close(self):
+        self._block = None
+        self.file.close()
+
+def frame_source_spec(frame_source):#picklable description of a frame source, see open_frame_source
+    if isinstance(frame_source, HDF5Stack):
+        return ("hdf5", frame_source.source, frame_source.dataset, frame_source.axis, (frame_source.start, frame_source.stop))
+    if isinstance(frame_source, FrameStack) and frame_source.source is not None:
+        return ("ptstack", frame_source.source)
+    #x,y files, an in-memory stack is read back file by file (names and labels are the same)
+    return ("files", list(frame_source.paths))
+
+def open_frame_source(spec):#open the frame source described by frame_source_spec
+    if spec[0] == "hdf5":
+        return HDF5Stack(spec[1], spec[2], axis = spec[3], frame_range = spec[4])
+    if spec[0] == "ptstack":
+        return FrameStack.open(spec[1])
+    return FileSeries(spec[1])
+
+def scan_pattern(path):#read, hash and summarise one x,y file, returns (entry, x, y), x and y are None if it could not be read
+    entry = {"path" : os.path.abspath(path), "name" : os.path.split(path)[1], "valid" : False, "error" : None}
+    try:
+        with open(path, mode = "rb") as file:
+            raw = file.read()
+            stat = os.fstat(file.fileno())
+        entry["hash"] = hashlib.sha1(raw).hexdigest()
+        data = np.loadtxt(io.BytesIO(raw), usecols = (0, 1), comments = "#", dtype = np.float64, ndmin = 2)
+    except (OSError, ValueError) as error:
+        entry["error"] = str(error)
+        return entry, None, None
+    if data.shape[0] < 2:
+        entry["error"] = "fewer than two data points"
+        return entry, None, None
+    x = np.ascontiguousarray(data[:, 0])
+    y = np.ascontiguousarray(data[:, 1])
+    pattern_cache.put(pattern_cache.key(path, stat), x, y)
+    entry["valid"] = True
+    entry["tt_min"] = float(x.min())
+    entry["tt_max"] = float(x.max())
+    entry["points"] = int(x.size)
+    entry["step"] = float(np.median(np.diff(x)))
+    entry["max_intensity"] = float(y.max())
+    return entry, x, y
+
+def scan_patterns(paths, max_workers = None):#scan_pattern over many files in a thread pool, results are in the order of paths
+    paths = list(paths)
+    if len(paths) < 2:
+        return [scan_pattern(path) for path in paths]
+    with ThreadPoolExecutor(max_workers = max_workers) as pool:
+        return list(pool.map(scan_pattern, paths))
+
+class DatasetCatalog: #summaries of the loaded x,y files, in frame order, see scan_pattern for the entries
+    def __init__(self, entries = ()):
+        self.entries = list(entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, entries):
+        self.entries += list(entries)
+
+    @property
+    def names(self):
+        return [entry["name"] for entry in self.entries]
+
+    def max_2theta(self):#highest 2theta reached by every frame
+        return min(entry["tt_max"] for entry in self.entries)
+
+    def window_points(self, window_2theta):#data points either side of a peak that make up a fit window of window_2theta degrees
+        entry = self.entries[0]
+        points = int(np.ceil(window_2theta/entry["step"] - 1e-6))#points of the first frame within window_2theta of its start
+        return int(points/2)
+
+    def validate(self):#list of warnings about frames that do not look like the first one
+        warnings = []
+        first = self.entries[0] if self.entries != [] else None
+        hashes = {}
+        for entry in self.entries:
+            if entry["hash"] in hashes:
+                warnings.append(entry["name"] + " is identical to " + hashes[entry["hash"]])
+            else:
+                hashes[entry["hash"]] = entry["name"]
+            if entry["points"] != first["points"] or not np.isclose(entry["step"], first["step"]):
+                warnings.append(entry["name"] + " has %d points at a %.5g degree step, %s has %d at %.5g" % (entry["points"], entry["step"], first["name"], first["points"], first["step"]))
+            elif not (np.isclose(entry["tt_min"], first["tt_min"]) and np.isclose(entry["tt_max"], first["tt_max"])):
+                warnings.append(entry["name"] + " covers 2theta %.4g-%.4g, %s covers %.4g-%.4g" % (entry["tt_min"], entry["tt_max"], first["name"], first["tt_min"], first["tt_max"]))
+        return warnings
+
+WATCH_EXTENSIONS = (".dat", ".xy", ".xye", ".chi")
+
+class FolderWatcher: #reports new, fully written pattern files in a directory
+    def __init__(self, directory, seen = (), extensions = WATCH_EXTENSIONS, settle_time = 0.5):
+        self.directory = directory
+        self.extensions = tuple(extensions)
+        self.settle_time = settle_time
+        self.seen = set(os.path.abspath(path) for path in seen)
+        self._pending = {}#path: ((size, mtime), time the signature was first seen)
+
+    def poll(self):#returns a list of files that are ready to fit, oldest first
+        now = time.monotonic()
+        ready = []
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                path = os.path.abspath(entry.path)
+                if path in self.seen or not entry.name.lower().endswith(self.extensions):
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:#removed between listing and stat
+                    continue
+                signature = (stat.st_size, stat.st_mtime_ns)
+                pending = self._pending.get(path)
+                if pending is None or pending[0] != signature:#new, or still being written
+                    self._pending[path] = (signature, now)
+                    continue
+                if signature[0] > 0 and now - pending[1] >= self.settle_time:
+                    ready.append((stat.st_mtime_ns, path))
+        ready.sort()
+        for mtime, path in ready:
+            self.seen.add(path)
+            del self._pending[path]
+        return [path for mtime, path in ready]
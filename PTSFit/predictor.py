@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+Frame to frame parameter predictor for sequential fits
+
+General use:
+
+KalmanPredictor() follows a vector of fitted parameters through a series with a constant velocity Kalman filter, one independent filter per parameter
+predictor.predict() returns the forecast (mean, standard deviation) of the next frame's parameters, or None until a frame has been observed,
+predictor.predict(steps) that of the frame steps frames on
+predictor.update(params, gated, steps) takes the fitted parameters of the frame steps frames after the last one observed (the next by default,
+more if frames were skipped) and returns the normalised innovation of each parameter
+(the difference between the fit and the forecast, in forecast standard deviations) and whether the frame is an outlier
+A frame is an outlier when the innovation of any of the gated parameters (an index or mask, all of them by default) is larger than
+outlier_sigma, it is not used to update the filter, so one bad fit does not drag the forecasts of the following frames, while the
+growing forecast uncertainty lets a genuine jump be taken up after a few frames
+The first WARMUP_FRAMES frames are never outliers, while the measurement noise estimate settles
+
+The noise levels are relative to the size of each parameter, so scales, widths and lattice parameters share the same settings
+The measurement noise adapts to the scatter of the innovations, noisy parameters get a wide forecast (and a loose trust region scaling
+when the standard deviation is used as least_squares x_scale) while smooth ones, such as the lattice through a ramp, get a tight one
+"""
+
+import numpy as np
+
+PROCESS_NOISE = 1e-4 #relative change in the rate of change of a parameter per frame
+MEASUREMENT_NOISE = 1e-4 #relative scatter of a fitted parameter, the starting value of the adaptive estimate
+RATE_UNCERTAINTY = 1e-2 #relative uncertainty of the rate of change per frame before a second frame has been seen
+NOISE_ADAPTATION = 0.3 #weight of the latest innovation in the running measurement noise estimate
+OUTLIER_SIGMA = 5.0 #normalised innovation above which a frame is an outlier
+WARMUP_FRAMES = 3 #frames observed before outliers are held back from the filter
+
+class KalmanPredictor: #constant velocity Kalman filter on a parameter vector, see module docstring
+    def __init__(self, process_noise = PROCESS_NOISE, measurement_noise = MEASUREMENT_NOISE, outlier_sigma = OUTLIER_SIGMA):
+        self.process_noise = process_noise
+        self.measurement_noise = measurement_noise
+        self.outlier_sigma = outlier_sigma
+        self.reset()
+
+    def reset(self):
+        self.value = None #filtered value and rate of change per frame of each parameter
+        self.rate = None
+        self.covariance = None #(params x 2 x 2) covariance of value and rate
+        self.noise = None #running measurement variance of each parameter
+        self.frames = 0
+
+    def _scale(self, params):#size of each parameter the relative noise levels refer to, zero parameters use the mean size
+        scale = np.abs(params)
+        floor = scale.mean() if scale.any() else 1.0
+        return np.where(scale > 0, scale, floor)
+
+    def _forecast(self, steps = 1):#propagated value, rate and covariance steps frames on
+        q = (self.process_noise*self._scale(self.value))**2
+        covariance = self.covariance
+        for step in range(steps):
+            p = covariance
+            covariance = np.empty_like(p)
+            #F P F^T + Q for F = [[1, 1], [0, 1]] with white noise acceleration Q = q [[1/4, 1/2], [1/2, 1]]
+            covariance[:, 0, 0] = p[:, 0, 0] + 2*p[:, 0, 1] + p[:, 1, 1] + q/4
+            covariance[:, 0, 1] = p[:, 0, 1] + p[:, 1, 1] + q/2
+            covariance[:, 1, 0] = covariance[:, 0, 1]
+            covariance[:, 1, 1] = p[:, 1, 1] + q
+        return self.value + steps*self.rate, self.rate, covariance
+
+    def predict(self, steps = 1):#forecast (mean, standard deviation) of the parameters steps frames after the last one observed
+        if self.frames == 0:
+            return None
+        mean, rate, covariance = self._forecast(steps)
+        return mean, np.sqrt(covariance[:, 0, 0] + self.noise)
+
+    def update(self, params, gated = None, steps = 1):#observe a frame's fitted parameters, returns the normalised innovations (zeros for the first frame) and the outlier flag
+        params = np.asarray(params, dtype = np.float64)
+        if self.frames == 0 or self.value.shape != params.shape:#(re)start from this frame, the rate is unknown
+            self.reset()
+            self.noise = (self.measurement_noise*self._scale(params))**2
+            self.value = params.copy()
+            self.rate = np.zeros_like(params)
+            self.covariance = np.zeros((params.size, 2, 2))
+            self.covariance[:, 0, 0] = self.noise
+            self.covariance[:, 1, 1] = (RATE_UNCERTAINTY*self._scale(params))**2
+            self.frames = 1
+            return np.zeros_like(params), False
+        mean, rate, covariance = self._forecast(steps)
+        innovation = params - mean
+        variance = covariance[:, 0, 0] + self.noise
+        normalised = innovation/np.sqrt(variance)
+        gated = slice(None) if gated is None else gated
+        outlier = self.frames >= WARMUP_FRAMES and bool(np.max(np.abs(normalised[gated])) > self.outlier_sigma)
+        #innovation based estimate of the measurement noise, the forecast part of the innovation variance is taken off
+        #so persistent scatter or a shift widens the forecast but a single bad fit barely does
+        measured = np.maximum(np.minimum(innovation**2, self.outlier_sigma**2*variance) - covariance[:, 0, 0], (1e-3*self.measurement_noise*self._scale(params))**2)
+        #a forecast that misses by more than its standard deviation means the value and rate are less certain than the filter holds,
+        #their covariance is scaled up to match (at most outlier_sigma^2 times a frame), so a filter that settled on a wrong rate
+        #while the noise estimate was still small takes up the following frames again
+        if not outlier:
+            covariance = covariance*np.clip(normalised**2, 1, self.outlier_sigma**2)[:, None, None]
+            variance = covariance[:, 0, 0] + self.noise
+        #an outlier only takes the time step (zero gain) so the forecast uncertainty grows
+        gain_value = covariance[:, 0, 0]/variance*(not outlier)
+        gain_rate = covariance[:, 1, 0]/variance*(not outlier)
+        #innovations count at most outlier_sigma, a parameter that jumps in a frame that is not an outlier is followed but not overshot
+        limit = self.outlier_sigma*np.sqrt(variance)
+        innovation = np.clip(innovation, -limit, limit)
+        self.value = mean + gain_value*innovation
+        self.rate = rate + gain_rate*innovation
+        p = covariance.copy()
+        p[:, 0, 0] = (1 - gain_value)*covariance[:, 0, 0]
+        p[:, 0, 1] = (1 - gain_value)*covariance[:, 0, 1]
+        p[:, 1, 0] = p[:, 0, 1]
+        p[:, 1, 1] = covariance[:, 1, 1] - gain_rate*covariance[:, 0, 1]
+        self.covariance = p
+        self.noise = (1 - NOISE_ADAPTATION)*self.noise + NOISE_ADAPTATION*measured
+        self.frames += 1
+        return normalised, outlier
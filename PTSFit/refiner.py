@@ -0,0 +1,1189 @@
+# -*- coding: utf-8 -*-
+"""
+Sequential refinement engine for PTSFit
+
+General use:
+
+SequentialRefiner(config) runs a sequential fit of a diffraction series without the GUI, each frame is seeded from the result of the last
+config is a dictionary, missing keys take the values in DEFAULT_CONFIG:
+    "files" : list of x,y datafiles (or a glob pattern), or a single .ptstack / HDF5 file
+    "dataset" : the (frames x points) dataset of an HDF5 file, defaults to the first one found
+    "SG_num" : space group number
+    "lattice_params" : starting lattice parameters, the variable length list described in crystallography.py
+    "wavelength" : in angstroms, or "poni" : path to a .poni calibration file to read it from
+    "window" : width of the data window about each peak in 2theta (degrees)
+    "max_2theta" : maximum 2theta for indexing, defaults to the lowest maximum 2theta of the loaded files
+    "profile" : starting [scale, sigma, shift] of every peak
+    "profile_mode" : "peaks", "projected" or "caglioti", see fitting.py
+    "phases" : further phases fitted to each pattern together with the first ("peaks" mode, config only, the GUI fits one phase),
+               a list of {"SG_num", "lattice_params", "profile"}, profile defaults to the first phase's
+    "max_frames" : only fit the first max_frames frames
+    "processes" : worker processes, more than 1 fits the series in parallel segments whose boundaries are reconciled
+    "coarse_step" : k > 1 fits every k-th frame first and then fills in the frames between them, None fits frame by frame
+    "joint_frames" : n > 1 fits blocks of n consecutive frames as one problem, more than the number of frames fits the series at once
+    "smoothness" : weight of the penalty on the curvature of the lattice parameters through a joint fit, None for no penalty
+    "max_nfev" : most residual evaluations of one frame's fit, None for no limit
+    "max_seconds" : wall clock limit of one frame's fit, None for no limit
+    "tolerance" : least_squares ftol and xtol, the starting value when tolerances adapt to volume_precision
+    "volume_precision" : target precision of the volumes (A^3) the tolerance is adapted to, None keeps tolerance fixed
+    "retries" : strategies a failed fit is tried again with, in order, from RETRY_STRATEGIES, [] to not retry
+    "on_failure" : "quarantine" to set aside a frame that fails every retry and carry on, "stop" to end the run there
+    "quarantine_file" : .jsonl quarantined frames are appended to, with their diagnostics
+    "predictor" : "kalman" to start each fit from a forecast of the series (predictor.py), None (the default) to start from the previous frame's result
+    "journal_file" : checkpoint journal every fitted frame is appended to as soon as it is fitted
+    "resume" : True to continue the last run in the journal with the same settings rather than starting over
+    "results_file" : .csv the command line writes the results to
+
+refiner.open() loads the frame source (unless one was passed in), refiner.setup() indexes and builds the starting state
+setup raises ValueError naming the missing or invalid input
+refiner.run() is a generator yielding one result dictionary per frame, it stops after the first frame whose fit fails and is not quarantined
+A result holds index, filename, filepath, success, message and for a successful fit gaussian_params, lattice_params, volume, cost, nfev,
+njev, status, elapsed, tolerance and converged (False for a fit stopped by its budget), with a predictor innovation and outlier,
+with phases the fitted parameters and volume of each further phase, and the attempts and retry of a frame that needed retries
+result_row(result) formats a result as a row of the results .csv (the columns the GUI saves), write_results(path, rows) writes the file
+read_journal(path) returns the header and frame lines of a journal, retry_statistics(results) counts the retries of a run
+
+RefinerThread(refiner, frame_indices) runs refiner.run() on a worker thread, thread.events is a queue of ("log", text), ("result", result)
+and finally ("done", None) or ("error", message), thread.pause(), thread.resume() and thread.cancel() act between frames
+The GUI builds a SequentialRefiner from its inputs and the loaded frame source, so both run the same fitting code
+
+Command line:
+
+python refiner.py config.json [--results results.csv] [--processes n] [--coarse k] [--joint n] [--smoothness w] [--kalman] [--resume]
+The config file is JSON with the keys above, relative paths are taken from the folder of the config file
+"""
+
+import os
+import sys
+import time
+import hashlib
+import glob
+import json
+import argparse
+from concurrent.futures import as_completed, ProcessPoolExecutor
+from multiprocessing import get_context
+from queue import Queue
+from threading import Event, Thread
+
+import numpy as np
+from scipy.optimize import Bounds
+
+from crystallography import cell_volume, reflection_list
+from fitting import (caglioti_bounds, caglioti_start, do_fit, join_phases, joint_fit_function, joint_jacobian, multiphase_fit_function, multiphase_jacobian,
+    newton_step, PROFILE_MODES, smoothness_penalty, split_phases)
+from predictor import KalmanPredictor
+from patterns import DatasetCatalog, frame_source_spec, FrameStack, HDF5Stack, list_hdf5_stacks, load_series, open_frame_source, scan_patterns
+
+HDF5_EXTENSIONS = (".h5", ".hdf5", ".nxs")
+LOOSEN_AFTER = 3 #fits in a row well within volume_precision before the tolerance is loosened
+TOLERANCE_LIMITS = (1e-12, 1e-4) #range the adapted tolerance is kept in
+RECONCILE_TOLERANCE = 1e-6 #relative lattice parameter difference below which a refitted boundary frame agrees with its segment fit
+PROFILE_RECONCILE_TOLERANCE = 1e-1 #median over the peaks of the relative profile parameter difference, refits of a frame from nearby starts scatter by a few percent
+JOINT_REFIT_COST = 3 #residual sum relative to the block's median above which a frame of a joint fit is fitted again on its own
+ANCHOR_STEP = 8 #most frames between the fits of the anchor pass that seeds parallel segments
+RETRY_STRATEGIES = { #retries a failed fit can be given, in the log's words
+    "reseed" : "lattice from the forecast, peaks from the starting profile",
+    "last_good" : "from the last good frame instead of the forecast",
+    "widen_window" : "wider fitting window",
+    "shrink_2theta" : "lower angle peaks only",
+    }
+RETRY_WINDOW_GROWTH = 1.5 #window of the widen_window retry relative to the configured window
+RETRY_PEAK_FRACTION = 0.75 #fraction of each phase's peaks (the lowest angle ones) the shrink_2theta retry fits
+
+DEFAULT_CONFIG = {
+    "files" : [],
+    "dataset" : None,
+    "SG_num" : None,
+    "lattice_params" : None,
+    "wavelength" : None,
+    "poni" : None,
+    "window" : None,
+    "window_points" : None, #data points either side of a peak, worked out from "window" if not given
+    "max_2theta" : None,
+    "profile" : None,
+    "profile_mode" : "peaks",
+    "phases" : None,
+    "max_frames" : None,
+    "processes" : 1,
+    "coarse_step" : None,
+    "joint_frames" : None,
+    "smoothness" : None,
+    "predictor" : None,
+    "max_nfev" : 1000,
+    "max_seconds" : None,
+    "tolerance" : 1e-8,
+    "volume_precision" : None,
+    "retries" : ["reseed", "last_good", "widen_window", "shrink_2theta"],
+    "on_failure" : "quarantine",
+    "quarantine_file" : "seq_quarantine.jsonl",
+    "journal_file" : "seq_journal.jsonl",
+    "resume" : False,
+    "results_file" : "seq_results.csv",
+    }
+
+def poni2wave(poni):#read a wavelength in angstroms from a .poni calibration file
+    with open(poni) as file:
+        wavelength = [i.split()[1] for i in file if i.split()[0] == "Wavelength:"]
+    return float(wavelength[0])*10000000000
+
+def window_points(frame_source, catalog, window):#number of data points in half of a window of 2theta width window
+    if catalog is not None and len(catalog) > 0:#step size from the catalog, no file read
+        return catalog.window_points(window)
+    x_values = frame_source.x if frame_source.x is not None else frame_source.frame(0)[0]#shared axis of a stack
+    data_start = x_values[0]#1st x-value
+    data_end = data_start + window#end point of the data window
+    return int(np.count_nonzero(x_values < data_end)/2)
+
+def settings_hash(settings):#short hash of a JSON-able settings dictionary, a resumed run continues the last journal run with the same hash
+    text = json.dumps(settings, sort_keys = True)
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()[:16]
+
+def read_journal(path):#header and frame lines of a checkpoint journal, lines cut short by a crash are skipped
+    entries = []
+    if path is None or not os.path.exists(path):
+        return entries
+    with open(path) as file:
+        for line in file:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(entry, dict) and "run" in entry:
+                entries.append(entry)
+    return entries
+
+def journal_results(path, settings):#frame results of the last run in the journal with the same settings_hash, by filepath
+    entries = [i for i in read_journal(path) if i["settings_hash"] == settings]
+    runs = [i["run"] for i in entries if "started" in i]
+    if runs == []:
+        return None, {}
+    run = runs[-1]
+    results = {}
+    for entry in entries:
+        if entry["run"] == run and "started" not in entry:
+            results[entry["filepath"]] = entry
+    return run, results
+
+def _no_log(text):
+    pass
+
+def halts(result):#True if a result ends the chain it is in, a failed fit that was not quarantined
+    return not (result["success"] or result.get("quarantined", False))
+
+def retry_statistics(results):#counts of frames fitted first time, recovered by a retry and quarantined, and of each strategy's tries and recoveries
+    statistics = {"frames" : 0, "first_try" : 0, "recovered" : 0, "quarantined" : 0, "failed_attempts" : 0, "strategies" : {}}
+    for result in results:
+        if result.get("resumed", False):
+            continue
+        statistics["frames"] += 1
+        statistics["failed_attempts"] += len(result.get("attempts", []))
+        tried = [i["strategy"] for i in result.get("attempts", []) if i["strategy"] != "first"]
+        if result["success"] and result.get("retry") is not None:
+            statistics["recovered"] += 1
+            tried.append(result["retry"])
+        elif result["success"]:
+            statistics["first_try"] += 1
+        elif result.get("quarantined", False):
+            statistics["quarantined"] += 1
+        for strategy in tried:
+            counts = statistics["strategies"].setdefault(strategy, {"tried" : 0, "recovered" : 0})
+            counts["tried"] += 1
+            counts["recovered"] += int(strategy == result.get("retry"))
+    return statistics
+
+def retry_report(statistics):#retry_statistics as lines of text for the log
+    text = "Frames fitted: "+str(statistics["frames"])+", first time: "+str(statistics["first_try"])+", after a retry: "+str(statistics["recovered"])
+    text += ", quarantined: "+str(statistics["quarantined"])+"\n"
+    for strategy, counts in statistics["strategies"].items():
+        text += "    "+strategy+": recovered "+str(counts["recovered"])+" of "+str(counts["tried"])+" frames tried\n"
+    return text
+
+def seed_state(state, result):#copy of state seeded from a successful result, for continuing a chain from that frame
+    state = dict(state)
+    state["gaussian_params"] = list(result["gaussian_params"])
+    state["lattice_params"] = list(result["lattice_params"])
+    if "caglioti_params" in result:
+        state["caglioti_params"] = list(result["caglioti_params"])
+    if "phases" in result:
+        state["phases"] = [dict(phase, gaussian_params = list(fitted["gaussian_params"]), lattice_params = list(fitted["lattice_params"])) for phase, fitted in zip(state["phases"], result["phases"])]
+    return state
+
+def interpolate_state(state, first, second, weight):#state with the fitted parameters weight of the way from result first to second
+    state = dict(state)
+    for key in ("gaussian_params", "lattice_params", "caglioti_params"):
+        if key in first and key in second:
+            state[key] = [float(i) for i in (1 - weight)*np.asarray(first[key]) + weight*np.asarray(second[key])]
+    if "phases" in first and "phases" in second:
+        state["phases"] = [interpolate_state(phase, i, j, weight) for phase, i, j in zip(state["phases"], first["phases"], second["phases"])]
+    return state
+
+def extrapolate_state(state, first, second, weight):#state seeded from result second, with the lattice parameters carried on along the line from first to second
+    state = seed_state(state, second)
+    lattices = interpolate_state(state, first, second, weight)
+    state["lattice_params"] = lattices["lattice_params"]
+    if "phases" in state:
+        state["phases"] = [dict(phase, lattice_params = i["lattice_params"]) for phase, i in zip(state["phases"], lattices["phases"])]
+    return state
+
+def volume_error(SG_num, fit, lattice):#volume change of the Gauss-Newton step still to go from a least_squares result, the error its tolerance left
+    x = np.asarray(fit.x)
+    return abs(cell_volume(SG_num, (x + newton_step(fit))[lattice]) - cell_volume(SG_num, x[lattice]))
+
+def results_agree(result, other):#True if two fits of a frame found the same lattice and peak profiles, so chains from them carry on the same
+    if not (result["success"] and other["success"]):
+        return False
+    for phase, other_phase in zip([result] + result.get("phases", []), [other] + other.get("phases", [])):
+        lattice = np.asarray(phase["lattice_params"])
+        if not np.all(np.abs(np.asarray(other_phase["lattice_params"])/lattice - 1) <= RECONCILE_TOLERANCE):
+            return False
+        #largest relative difference of each peak's amp, sigma and shift, a few peaks a pattern barely determines
+        #(weak or overlapping ones) wander far between refits, so it is the typical peak that must agree
+        profile = np.reshape(phase["gaussian_params"], (3, -1))
+        difference = np.max(np.abs(np.reshape(other_phase["gaussian_params"], (3, -1)) - profile)/np.abs(profile), axis = 0)
+        if not np.median(difference) <= PROFILE_RECONCILE_TOLERANCE:
+            return False
+    return True
+
+def keep_peaks(state, fraction):#copy of a state that fits only the lowest angle fraction of each phase's peaks (at least one)
+    state = dict(state)
+    if "phases" in state:
+        state["phases"] = [dict(i) for i in state["phases"]]
+    num, keep = state["num_peaks"], max(1, int(state["num_peaks"]*fraction))
+    if "caglioti_params" in state:#amps, then the widths and background shared by all peaks
+        state["caglioti_params"] = state["caglioti_params"][:keep] + state["caglioti_params"][num:]
+    for phase in [state] + state.get("phases", []):
+        num, keep = phase["num_peaks"], max(1, int(phase["num_peaks"]*fraction))
+        phase["gaussian_params"] = [i for block in range(3) for i in phase["gaussian_params"][block*num:block*num+keep]]
+        phase["num_peaks"] = keep
+    return state
+
+def merge_peaks(state, fitted):#take the fitted parameters of state fitted into state, peaks fitted left out keep their values
+    num, keep = state["num_peaks"], fitted["num_peaks"]
+    if "caglioti_params" in fitted:
+        previous = state.get("caglioti_params") or caglioti_start(state["gaussian_params"], num)
+        state["caglioti_params"] = list(fitted["caglioti_params"][:keep]) + list(previous[keep:num]) + list(fitted["caglioti_params"][keep:])
+    merged = []
+    for phase, fitted_phase in zip([state] + state.get("phases", []), [fitted] + fitted.get("phases", [])):
+        num, keep = phase["num_peaks"], fitted_phase["num_peaks"]
+        gaussian_params = list(phase["gaussian_params"])
+        for block in range(3):
+            gaussian_params[block*num:block*num+keep] = fitted_phase["gaussian_params"][block*keep:(block+1)*keep]
+        merged.append({"gaussian_params" : gaussian_params, "lattice_params" : list(fitted_phase["lattice_params"])})
+    state["gaussian_params"], state["lattice_params"] = merged[0]["gaussian_params"], merged[0]["lattice_params"]
+    if len(merged) > 1:
+        state["phases"] = [dict(phase, **i) for phase, i in zip(state["phases"], merged[1:])]
+
+def _fit_segment(config, spec, state, frame_indices):#worker process, fits frame_indices in order from state, stops at a failed fit
+    refiner = SequentialRefiner(config, frame_source = open_frame_source(spec), log = _no_log)
+    refiner.state = state
+    results = []
+    try:
+        for frame_index in frame_indices:
+            result = refiner.fit_frame(frame_index, record = False)
+            results.append(result)
+            if halts(result):
+                break
+    finally:
+        refiner.close()
+    return results
+
+def _fit_fills(config, spec, jobs):#worker process, fits (frame index, starting state) jobs independently of each other
+    refiner = SequentialRefiner(config, frame_source = open_frame_source(spec), log = _no_log)
+    results = []
+    try:
+        for frame_index, state in jobs:
+            results.append(refiner.fit_frame(frame_index, record = False, start = state))
+    finally:
+        refiner.close()
+    return results
+
+def load_config(path):#read a JSON config file, relative paths are taken from the config file's folder
+    with open(path) as file:
+        config = json.load(file)
+    folder = os.path.dirname(os.path.abspath(path))
+    files = config.get("files", [])
+    if isinstance(files, str):#a glob pattern
+        files = sorted(glob.glob(os.path.join(folder, files)))
+    config["files"] = [os.path.join(folder, i) for i in files]
+    for key in ("poni", "journal_file", "quarantine_file", "results_file"):
+        if config.get(key) is not None:
+            config[key] = os.path.join(folder, config[key])
+    return config
+
+def result_row(result):#a successful result as a row of the results .csv, lists are written as space seperated values
+    row = {}
+    row["filename"] = result["filename"]
+    row["filepath"] = result["filepath"]
+    row["LS_gauss (scale sigma shift per peak"] = " ".join(str(i) for i in result["gaussian_params"])
+    row["LS_lattice (variable length depending on symmetry)"] = " ".join(str(i) for i in result["lattice_params"])
+    row["V (A^3)"] = result["volume"]
+    row["P (GPa)"] = None
+    row["T (K)"] = None
+    row["LS cost value"] = result["cost"]
+    for number, phase in enumerate(result.get("phases", []), 2):#further phases of a multi-phase fit
+        row["LS_lattice phase "+str(number)] = " ".join(str(i) for i in phase["lattice_params"])
+        row["V phase "+str(number)+" (A^3)"] = phase["volume"]
+    return row
+
+def write_results(path, rows):#write result rows (dictionaries with the same keys) to a .csv, header from the keys
+    with open(path, mode = "w") as file:
+        for i in list(rows[0].keys()):
+            file.write(str(i)+",")
+        file.write("\n")
+        for dictionary in rows:
+            for value in list(dictionary.values()):
+                file.write(str(value)+",")
+            file.write("\n")
+
+class SequentialRefiner: #runs a sequential fit from a config dictionary
+    def __init__(self, config, frame_source = None, catalog = None, log = None):
+        self.config = dict(DEFAULT_CONFIG)
+        self.config.update(config)
+        self.frame_source = frame_source
+        self.catalog = catalog
+        self.log = log if log is not None else sys.stdout.write
+        self.state = None
+        self.results = []
+        self.quarantined = [] #results of frames that failed every retry, left out of results
+        self.settings_hash = None
+        self.journal = None #open journal file while a run is recording
+        self.run_id = None
+        self.predictor = KalmanPredictor() if self.config["predictor"] == "kalman" else None
+        self.tolerance = float(self.config["tolerance"]) #least_squares ftol and xtol, adapted with volume_precision
+        self.precise_fits = 0 #fits in a row well within volume_precision since the tolerance last changed
+        self.loosest_tolerance = TOLERANCE_LIMITS[1] #tighter than any tolerance that has missed volume_precision
+        self.frames_missed = 0 #quarantined frames since the predictor last observed one, the forecasts step over them
+
+    def open(self):#frame source for the config's files, if one was not passed in
+        if self.frame_source is not None or self.config["files"] == []:
+            return self.frame_source
+        paths = list(self.config["files"])
+        if len(paths) == 1 and paths[0].lower().endswith(".ptstack"):
+            self.frame_source = FrameStack.open(paths[0])
+        elif len(paths) == 1 and paths[0].lower().endswith(HDF5_EXTENSIONS):
+            dataset = self.config["dataset"]
+            if dataset is None:
+                datasets = list_hdf5_stacks(paths[0])
+                if datasets == []:
+                    raise ValueError("No (frames x points) datasets in "+str(paths[0]))
+                dataset = datasets[0]
+            self.frame_source = HDF5Stack(paths[0], dataset)
+        else:
+            scanned = scan_patterns(paths)
+            for entry, x, y in scanned:
+                if not entry["valid"]:
+                    self.log("Skipped unreadable datafile "+entry["name"]+": "+str(entry["error"])+"\n")
+            scanned = [i for i in scanned if i[0]["valid"]]
+            self.catalog = DatasetCatalog([entry for entry, x, y in scanned])
+            self.frame_source = load_series([entry["path"] for entry, x, y in scanned], [(x, y) for entry, x, y in scanned])
+        return self.frame_source
+
+    def close(self):
+        self.close_journal()
+        if self.frame_source is not None:
+            self.frame_source.close()
+
+    @property
+    def wavelength(self):
+        if self.config["wavelength"] is None and self.config["poni"] is not None:
+            self.config["wavelength"] = poni2wave(self.config["poni"])
+        return self.config["wavelength"]
+
+    @property
+    def max_2theta(self):
+        if self.config["max_2theta"] is None:
+            if self.frame_source is None or len(self.frame_source) == 0:
+                raise ValueError("Missing maximum 2theta")
+            if self.catalog is not None and len(self.catalog) > 0:
+                self.config["max_2theta"] = self.catalog.max_2theta()
+            else:
+                x_values = self.frame_source.x if self.frame_source.x is not None else self.frame_source.frame(0)[0]
+                self.config["max_2theta"] = float(x_values.max())
+        return self.config["max_2theta"]
+
+    @property
+    def window_points(self):
+        if self.config["window_points"] is None and self.config["window"] is not None:
+            self.config["window_points"] = window_points(self.frame_source, self.catalog, float(self.config["window"]))
+        return self.config["window_points"]
+
+    def setup(self):#checks the inputs and builds the starting state, raises ValueError if something is missing
+        config = self.config
+        self.open()#a watched folder may start empty, frames can be passed to fit_frame as they arrive
+        lattice_params = config["lattice_params"]
+        if lattice_params == None or any(v == None or v == '' for v in lattice_params) or config["SG_num"] == False or config["SG_num"] == None:
+            raise ValueError("Missing crystallographic parameters")
+        if self.wavelength == None:
+            raise ValueError("Missing wavelength")
+        if config["window"] is None or self.frame_source is None and config["window_points"] is None or not self.window_points:
+            raise ValueError("Fit window not specified")
+        if config["profile_mode"] not in PROFILE_MODES:
+            raise ValueError("Unknown profile mode: "+str(config["profile_mode"]))
+        if int(config["joint_frames"] or 1) > 1 and int(config["coarse_step"] or 1) > 1:
+            raise ValueError("Joint fits can not be used with a coarse step")
+        if int(config["joint_frames"] or 1) > 1 and int(config["processes"] or 1) > 1:
+            raise ValueError("Joint fits can not be used with several processes")
+        for strategy in config["retries"] or []:
+            if strategy not in RETRY_STRATEGIES:
+                raise ValueError("Unknown retry strategy: "+str(strategy))
+        if config["on_failure"] not in ("quarantine", "stop"):
+            raise ValueError("Unknown on_failure: "+str(config["on_failure"]))
+        #do indexing in order to determine number of peaks which is needed to create list of gaussians
+        #constrain max 2theta to be the max 2theta - 1/2 of a data windows width (otherwise a data window may lie outside the data range, breaking the LS)
+        tt_cutoff = self.max_2theta - float(config["window"])/2
+        num_peaks = len(reflection_list(config["SG_num"], lattice_params, tt_cutoff, self.wavelength)["hkl"])
+        #convert the profile (which is just a list of scale, sigma, shift)
+        #into a list of [scale, scale,... sigma, sigma,...  shift, shift,... per number of peaks]
+        raw_gaussian_params = config["profile"]
+        if raw_gaussian_params == None or any(g == 0  for g in raw_gaussian_params):
+            raise ValueError("Missing, or zero value gaussian parameters")
+        amps = [raw_gaussian_params[0]] * num_peaks
+        sigmas = [raw_gaussian_params[1]] * num_peaks
+        shifts = [raw_gaussian_params[2]] * num_peaks
+        #fits are seeded from the previous result, so the state is carried from frame to frame
+        self.state = {}
+        self.state["num_peaks"] = num_peaks
+        self.state["gaussian_params"] = amps + sigmas + shifts
+        self.state["lattice_params"] = [float(i) for i in lattice_params]
+        self.state["counter"] = int(0)
+        if config["phases"]:
+            self.state["phases"] = self.setup_phases(tt_cutoff)
+        if self.predictor is not None:
+            self.predictor.reset()
+        self.frames_missed = 0
+        self.tolerance = float(config["tolerance"])
+        self.precise_fits = 0
+        self.loosest_tolerance = TOLERANCE_LIMITS[1]
+        self.settings_hash = settings_hash(self.settings())
+        return self.state
+
+    def setup_phases(self, tt_cutoff):#starting state of each further phase of a multi-phase fit, raises ValueError if something is missing
+        if self.config["profile_mode"] != "peaks":
+            raise ValueError("Multi-phase fits use the peaks profile mode")
+        phases = []
+        for number, phase in enumerate(self.config["phases"], 2):
+            lattice_params = phase.get("lattice_params")
+            if lattice_params == None or any(v == None or v == '' for v in lattice_params) or phase.get("SG_num") in (None, False):
+                raise ValueError("Missing crystallographic parameters of phase "+str(number))
+            profile = phase.get("profile") or self.config["profile"]
+            if any(g == 0 for g in profile):
+                raise ValueError("Zero value gaussian parameters of phase "+str(number))
+            num_peaks = len(reflection_list(phase["SG_num"], lattice_params, tt_cutoff, self.wavelength)["hkl"])
+            phases.append({
+                "SG_num" : phase["SG_num"],
+                "num_peaks" : num_peaks,
+                "gaussian_params" : [profile[0]]*num_peaks + [profile[1]]*num_peaks + [profile[2]]*num_peaks,
+                "lattice_params" : [float(i) for i in lattice_params],
+                })
+        return phases
+
+    def state_phases(self, state):#every phase of a state, the first phase and then state["phases"], as dictionaries of SG_num, num_peaks, gaussian_params and lattice_params
+        first = {"SG_num" : self.config["SG_num"], "num_peaks" : state["num_peaks"], "gaussian_params" : state["gaussian_params"], "lattice_params" : state["lattice_params"]}
+        return [first] + list(state.get("phases", []))
+
+    def settings(self):#everything the fits depend on, hashed to tell whether a journal belongs to the same fit
+        config = self.config
+        settings = {
+            "SG_num" : config["SG_num"],
+            "lattice_params" : [float(i) for i in config["lattice_params"]],
+            "wavelength" : float(self.wavelength),
+            "max_2theta" : float(self.max_2theta),
+            "window_points" : int(self.window_points),
+            "profile" : [float(i) for i in config["profile"]],
+            "profile_mode" : config["profile_mode"],
+            "tolerance" : float(config["tolerance"]),
+            "volume_precision" : None if config["volume_precision"] is None else float(config["volume_precision"]),
+            "max_nfev" : None if config["max_nfev"] is None else int(config["max_nfev"]),
+            "max_seconds" : None if config["max_seconds"] is None else float(config["max_seconds"]),
+            "predictor" : config["predictor"],
+            "retries" : list(config["retries"] or []),
+            }
+        if int(config["joint_frames"] or 1) > 1:#joint fits with a smoothness penalty find different parameters, only added when set
+            settings["joint"] = [int(config["joint_frames"]), float(config["smoothness"] or 0)]
+        if config["phases"]:#only with phases, so single phase journals keep their hash
+            settings["phases"] = [{"SG_num" : i["SG_num"], "lattice_params" : [float(j) for j in i["lattice_params"]], "profile" : [float(j) for j in i.get("profile") or config["profile"]]} for i in config["phases"]]
+        return settings
+
+    def start_journal(self, resume = False):#open the journal for appending, returns the journaled results of the run being resumed
+        out_file = self.config["journal_file"]
+        resumed = {}
+        self.run_id = None
+        if resume:
+            self.run_id, resumed = journal_results(out_file, self.settings_hash)
+            if self.run_id is None:
+                self.log("No run with the same settings in the journal to resume, starting a new run\n")
+        if out_file is None:
+            return resumed
+        self.close_journal()
+        self.journal = open(out_file, mode = "a+")
+        if self.journal.tell() > 0:#a line cut short by a crash is ended so the next entry starts on its own line
+            self.journal.seek(self.journal.tell()-1)
+            if self.journal.read(1) != "\n":
+                self.journal.write("\n")
+        if self.run_id is None:
+            self.run_id = time.strftime("%Y-%m-%dT%H:%M:%S")+"-"+str(os.getpid())
+            self.write_journal({"run" : self.run_id, "settings_hash" : self.settings_hash, "settings" : self.settings(), "started" : time.time()})
+            self.log("Journal: "+str(out_file)+"\n")
+        else:
+            self.log("Resuming run "+str(self.run_id)+" of journal "+str(out_file)+", "+str(len(resumed))+" frames already fitted\n")
+        return resumed
+
+    def write_journal(self, entry):#append one line to the journal and make sure it is on disk before going on
+        if self.journal is None:
+            return None
+        self.journal.write(json.dumps(entry)+"\n")
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+
+    def close_journal(self):
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+    def fit_frame(self, frame_index, frame_source = None, record = True, start = None):#fits one frame seeded from the state and updates the state, see record
+        #a fit from an explicit start state is not part of the chain, it does not use or update the predictor and only updates start
+        #a failed fit is tried again with each of the retries strategies in turn, a frame that fails them all is quarantined
+        #(logged, set aside with its attempts and left out of the journal so a resumed run fits it again) and the chain carries on
+        state = self.state if start is None else start
+        frame_source = frame_source if frame_source is not None else self.frame_source
+        frame = frame_source.label(frame_index)
+        frame_name = frame_source.names[frame_index]
+        frame_data = frame_source.frame(frame_index)#(x, y) arrays, zero-copy for a frame stack
+        result = {"index" : frame_index, "filename" : frame_name, "filepath" : frame, "success" : False, "message" : ""}
+        attempts = []
+        for strategy in [None] + list(self.config["retries"] or []):
+            retry = self.retry_setup(strategy, state, start is None)
+            if retry is None:#the strategy would repeat an attempt already made
+                continue
+            if strategy is not None:
+                self.log("Retrying "+str(frame)+": "+RETRY_STRATEGIES[strategy]+"\n")
+            attempt_state, forecast, window = retry
+            fitted = self.fit_attempt(attempt_state, frame_data, forecast, window)
+            if fitted["success"]:
+                break
+            self.log("==== ERROR IN LEAST SQUARES ====\n"+str(frame)+": "+str(fitted["message"])+"\n")
+            attempts.append(dict(fitted, strategy = strategy or "first", window_points = window, num_peaks = attempt_state["num_peaks"], start_lattice = list(attempt_state["lattice_params"])))
+        if attempts != []:
+            result["attempts"] = attempts
+        if not fitted["success"]:
+            result["message"] = fitted["message"]
+            if self.config["on_failure"] == "quarantine":
+                result["quarantined"] = True
+                if start is None:
+                    self.frames_missed += 1
+            else:
+                self.log("Considering changing starting parameters, reducing maximum 2theta for indexing, or the fitting window\n")
+            if record:
+                self.record(result)
+            return result
+        if not fitted["converged"]:
+            self.log("==== WARNING ====\n"+str(frame)+": "+str(fitted["message"])+"\nThe best parameters found are kept\n")
+        if strategy is not None:
+            result["retry"] = strategy
+        merge_peaks(state, attempt_state)
+        result.update(fitted)
+        result.update(self.state_fields(state))
+        if start is None:
+            self.observe(result)
+        if record:
+            self.record(result)
+        return result
+
+    def fit_attempt(self, state, frame_data, use_forecast, window_points):#one least squares fit of a frame from state, returns the result fields
+        #state is a copy that takes the fitted parameters, success is False if least_squares raised, stalled or gave a non-finite cost
+        problem = self.fit_problem(state, frame_data, window_points)
+        function, jacobian, bounds, args = problem["function"], problem["jacobian"], problem["bounds"], problem["args"]
+        LS_params = problem["params"]
+        num_lattice = problem["num_lattice"]
+        #the phases' lattice parameters are coupled through shared windows and take the lsmr steps far more unevenly than one lattice,
+        #so a multi-phase fit with no forecast is scaled by its jacobian
+        x_scale = 1.0 if len(problem["phases"]) == 1 else "jac"
+        forecast = self.forecast() if use_forecast else None
+        if forecast is not None and len(forecast[0]) == len(LS_params):#start from the forecast, scaled by its uncertainty
+            LS_params = self.forecast_start(LS_params, forecast, bounds)
+            x_scale = np.where(forecast[1] > 0, forecast[1], 1.0)
+        budget = {"x_scale" : x_scale, "max_nfev" : self.config["max_nfev"], "max_seconds" : self.config["max_seconds"]}
+        tolerance = self.tolerance
+        start_time = time.perf_counter()
+        #do the LS
+        try:
+            LS_out = do_fit(function, LS_params, bounds, args, jacobian, tolerance = tolerance, **budget)
+            nfev, njev = LS_out.nfev, LS_out.njev or 0
+            if LS_out.status > 0 and self.config["volume_precision"] is not None:
+                first_lattice = slice(len(LS_params) - num_lattice, len(LS_params) - num_lattice + len(state["lattice_params"]))
+                refit = lambda x, refit_tolerance: do_fit(function, x, bounds, args, jacobian, tolerance = refit_tolerance, **budget)
+                LS_out, polish_nfev, polish_njev = self.precise_fit(LS_out, refit, first_lattice)
+                nfev, njev = nfev + polish_nfev, njev + polish_njev
+        except Exception as error:
+            return {"success" : False, "message" : str(error)}
+        fitted = {
+            "success" : True,
+            "message" : LS_out.message,
+            "cost" : float(LS_out.cost),
+            "nfev" : int(nfev),
+            "njev" : int(njev),
+            "status" : int(LS_out.status),
+            "converged" : bool(LS_out.status > 0),
+            "tolerance" : tolerance,
+            "elapsed" : time.perf_counter() - start_time,
+            }
+        if LS_params == list(LS_out.x):#LS minimiser has stopped working
+            #the original error was due to a peak position crossing the 2theta indexing limit
+            #the peak would then be ignored but the gaussian parameters would still be sent to the LS function
+            #the LS function was rewritten to constrain the number of gaussian parameters based on the number of peaks
+            fitted.update({"success" : False, "message" : "Refinement returned input values"})
+            return fitted
+        if not np.isfinite(LS_out.cost):
+            fitted.update({"success" : False, "message" : "Non-finite residuals"})
+            return fitted
+        self.take_params(state, LS_out.x, problem)
+        return fitted
+
+    def retry_setup(self, strategy, state, chained):#(starting state copy, use the forecast, window points) of an attempt, None if it repeats an earlier one
+        forecast = chained and self.forecast() is not None
+        if strategy is None:#the first attempt
+            return dict(state), chained, int(self.window_points)
+        if strategy == "reseed":#lattice from the forecast (or the last good frame), peak profiles from the starting profile
+            attempt_state = self.fresh_profiles(state)
+            if forecast:
+                lattice = list(self.forecast()[0][-sum(len(i["lattice_params"]) for i in self.state_phases(state)):])
+                for phase in [attempt_state] + attempt_state.get("phases", []):
+                    phase["lattice_params"], lattice = [float(i) for i in lattice[:len(phase["lattice_params"])]], lattice[len(phase["lattice_params"]):]
+            return attempt_state, False, int(self.window_points)
+        if strategy == "last_good":#the last good frame's parameters as they are, only differs from the first attempt if that used a forecast
+            return (dict(state), False, int(self.window_points)) if forecast else None
+        if strategy == "widen_window":
+            return dict(state), chained, int(round(self.window_points*RETRY_WINDOW_GROWTH))
+        if strategy == "shrink_2theta":#only the lower angle peaks, the forecast is of all of them so it is not used
+            attempt_state = keep_peaks(state, RETRY_PEAK_FRACTION)
+            if all(i["num_peaks"] == j["num_peaks"] for i, j in zip(self.state_phases(state), self.state_phases(attempt_state))):
+                return None
+            return attempt_state, False, int(self.window_points)
+        raise ValueError("Unknown retry strategy: "+str(strategy))
+
+    def fresh_profiles(self, state):#copy of state with every phase's peaks back at its starting profile
+        state = dict(state)
+        profiles = [self.config["profile"]] + [i.get("profile") or self.config["profile"] for i in self.config["phases"] or []]
+        phases = []
+        for phase, profile in zip(self.state_phases(state), profiles):
+            num = phase["num_peaks"]
+            phases.append(dict(phase, gaussian_params = [profile[0]]*num + [profile[1]]*num + [profile[2]]*num, lattice_params = list(phase["lattice_params"])))
+        state["gaussian_params"], state["lattice_params"] = phases[0]["gaussian_params"], phases[0]["lattice_params"]
+        if len(phases) > 1:
+            state["phases"] = phases[1:]
+        state.pop("caglioti_params", None)
+        return state
+
+    def state_fields(self, state):#gaussian_params, lattice_params, volume (and caglioti_params and phases) of a result from the state
+        fields = {"gaussian_params" : state["gaussian_params"], "lattice_params" : state["lattice_params"], "volume" : cell_volume(self.config["SG_num"], state["lattice_params"])}
+        if "caglioti_params" in state:
+            fields["caglioti_params"] = state["caglioti_params"]
+        if state.get("phases"):
+            fields["phases"] = [{"SG_num" : i["SG_num"], "gaussian_params" : i["gaussian_params"], "lattice_params" : i["lattice_params"], "volume" : cell_volume(i["SG_num"], i["lattice_params"])} for i in state["phases"]]
+        return fields
+
+    def fit_block(self, frame_indices):#joint fit of consecutive frames chained from the state, records and returns their results
+        #one least_squares problem over every frame's parameters, the jacobian is block diagonal so the cost grows linearly with the block
+        #each frame starts from the predictor's forecast, or with no predictor from the lattice carried on from the last two fitted frames
+        frame_source = self.frame_source
+        fitted = [result for result in self.results[-2:] if result["success"]]
+        results, problems, LS_params, lower, upper, edges = [], [], [], [], [], [0]
+        for step, frame_index in enumerate(frame_indices, 1):
+            results.append({"index" : frame_index, "filename" : frame_source.names[frame_index], "filepath" : frame_source.label(frame_index), "success" : False, "message" : ""})
+            state = self.state
+            if self.predictor is None and len(fitted) == 2:
+                first, second = fitted
+                state = extrapolate_state(self.state, first, second, (frame_index - first["index"])/(second["index"] - first["index"]))
+            problem = self.fit_problem(state, frame_source.frame(frame_index))
+            params = problem["params"]
+            forecast = self.forecast(step)
+            if forecast is not None and len(forecast[0]) == len(params):
+                params = self.forecast_start(params, forecast, problem["bounds"])
+            problems.append(problem)
+            LS_params += params
+            lower += list(problem["bounds"].lb)
+            upper += list(problem["bounds"].ub)
+            edges.append(len(LS_params))
+        penalty = None
+        if self.config["smoothness"]:
+            #w*(l[f-1] - 2*l[f] + l[f+1])/l for every lattice parameter l of frame f, so a steady ramp costs nothing
+            num_lattice = problems[0]["num_lattice"]
+            lattice_index = [range(i - num_lattice, i) for i in edges[1:]]
+            #the two frames just before the block carry the smoothness over its start, a gap (a frame not fitted) ends the penalty there
+            previous = {result["index"] : result for result in self.results[-2:] if result["success"]}
+            fixed = []
+            for index in (frame_indices[0] - 1, frame_indices[0] - 2):
+                lattice = [j for i in [previous[index]] + previous[index].get("phases", []) for j in i["lattice_params"]] if index in previous else []
+                if len(lattice) != num_lattice:
+                    break
+                fixed.insert(0, lattice)
+            penalty = smoothness_penalty(lattice_index, fixed, LS_params[edges[1]-num_lattice:edges[1]], float(self.config["smoothness"]))
+        args = (tuple((i["function"], i["jacobian"], i["args"]) for i in problems), edges, penalty)
+        max_seconds = self.config["max_seconds"]
+        budget = {"max_nfev" : self.config["max_nfev"], "max_seconds" : None if max_seconds is None else max_seconds*len(frame_indices)}
+        start_time = time.perf_counter()
+        try:
+            #scaled by the jacobian, the frames' lattices take the lsmr steps as unevenly as the phases of a multi-phase fit,
+            #a trial step that overflows a width is simply rejected by the trust region
+            #ftol and xtol compare with the cost and parameters of the whole block, so the tolerance is shared out over its frames
+            with np.errstate(over = "ignore", invalid = "ignore"):
+                LS_out = do_fit(joint_fit_function, LS_params, Bounds(lb = lower, ub = upper), args, joint_jacobian, x_scale = "jac", tolerance = self.tolerance/len(frame_indices), **budget)
+        except Exception as error:
+            LS_out = None
+            message = str(error)
+        if LS_out is not None and not np.isfinite(LS_out.cost):
+            LS_out, message = None, "Non-finite residuals"
+        if LS_out is None:#the block is fitted again frame by frame, with the retries of a single fit
+            self.log("==== ERROR IN LEAST SQUARES ====\nFrames "+str(results[0]["filepath"])+" to "+str(results[-1]["filepath"])+": "+message+"\nFitting the block frame by frame\n")
+            results = []
+            for frame_index in frame_indices:
+                results.append(self.fit_frame(frame_index))
+                if halts(results[-1]):
+                    break
+            return results
+        if LS_out.status <= 0:
+            self.log("==== WARNING ====\nFrames "+str(results[0]["filepath"])+" to "+str(results[-1]["filepath"])+": "+str(LS_out.message)+"\nThe best parameters found are kept\n")
+        elapsed = time.perf_counter() - start_time
+        costs = []
+        for problem, first, last in zip(problems, edges[:-1], edges[1:]):
+            residuals = problem["function"](LS_out.x[first:last], *problem["args"])
+            costs.append(float(0.5*np.dot(residuals, residuals)))
+        #a frame the joint solve left in a wrong minimum has a cost orders of magnitude above its neighbours', it is fitted again on its own
+        #from the frame before it, with the retries and quarantine of a single fit
+        typical = np.median([i for i in costs + [result["cost"] for result in fitted] if np.isfinite(i)] or [np.inf])
+        for number, (result, problem, first, last, cost) in enumerate(zip(results, problems, edges[:-1], edges[1:], costs)):
+            if not cost <= JOINT_REFIT_COST*typical:
+                self.log("==== WARNING ====\n"+str(result["filepath"])+": residual sum of "+str(cost)+" in the joint fit\nRefitting the frame on its own\n")
+                results[number] = self.fit_frame(result["index"])
+                if halts(results[number]):
+                    return results[:number+1]
+                continue
+            self.take_params(self.state, LS_out.x[first:last], problem)
+            result.update(self.state_fields(self.state))
+            result.update({
+                "success" : True,
+                "message" : LS_out.message,
+                "cost" : cost,
+                "nfev" : int(LS_out.nfev),
+                "njev" : int(LS_out.njev or 0),
+                "status" : int(LS_out.status),
+                "converged" : bool(LS_out.status > 0),
+                "tolerance" : self.tolerance,
+                "elapsed" : elapsed/len(results),
+                "joint_frames" : len(results),
+                })
+            self.observe(result)
+            self.record(result)
+        return results
+
+    def fit_problem(self, state, frame_data, window_points = None):#residual function, jacobian, bounds, args and starting parameters of a frame's fit from a state
+        num_peaks = state["num_peaks"]
+        mode = self.config["profile_mode"]
+        function, jacobian, expand = PROFILE_MODES[mode]
+        phases = self.state_phases(state)
+        fit_SG, fit_peaks = self.config["SG_num"], num_peaks
+        if len(phases) > 1:#one fit of every phase, SG_num and num_peaks per phase
+            function, jacobian = multiphase_fit_function, multiphase_jacobian
+            fit_SG, fit_peaks = tuple(i["SG_num"] for i in phases), tuple(i["num_peaks"] for i in phases)
+        LS_params = self.start_params(state)
+        if mode == "caglioti":
+            bounds = caglioti_bounds(num_peaks, len(state["lattice_params"]))
+        else:
+            lower_bounds = [0 for i in LS_params]#hard coded bounds of 0 to +inf for all params
+            upper_bounds = [np.inf for i in LS_params]
+            bounds = Bounds(lb = lower_bounds, ub = upper_bounds)
+        window_points = int(self.window_points if window_points is None else window_points)
+        args = (fit_SG, self.max_2theta, self.wavelength, frame_data, window_points, fit_peaks)
+        return {"function" : function, "jacobian" : jacobian, "expand" : expand, "bounds" : bounds, "args" : args, "params" : LS_params,
+            "phases" : phases, "num_lattice" : sum(len(i["lattice_params"]) for i in phases)}
+
+    def forecast_start(self, LS_params, forecast, bounds):#starting parameters from a predictor forecast
+        #a parameter forecast outside its bounds starts from its last value instead
+        inside = (forecast[0] > bounds.lb) & (forecast[0] < bounds.ub)
+        return [float(i) for i in np.where(inside, forecast[0], LS_params)]
+
+    def take_params(self, state, out_params, problem):#fitted parameters of a frame into the state
+        num_peaks = state["num_peaks"]
+        phases = problem["phases"]
+        if self.config["profile_mode"] == "caglioti":
+            state["caglioti_params"] = list(out_params[:len(out_params)-len(state["lattice_params"])])
+        if problem["expand"] is not None:#per peak scales, sigmas and shifts so the rest of the output is the same as a full fit
+            out_params = problem["expand"](out_params, *problem["args"])
+        if len(phases) > 1:
+            fit_SG, fit_peaks = problem["args"][0], problem["args"][-1]
+            gaussians, lattices = split_phases(out_params, fit_SG, fit_peaks)
+            state["phases"] = [dict(phase, gaussian_params = i, lattice_params = j) for phase, i, j in zip(phases[1:], gaussians[1:], lattices[1:])]
+            out_params = gaussians[0] + lattices[0]
+        state["gaussian_params"] = [float(i) for i in out_params[0:num_peaks*3]]
+        state["lattice_params"] = [float(i) for i in out_params[num_peaks*3:]]
+
+    def precise_fit(self, LS_out, refit, lattice):#converged fit carried on until it holds volume_precision, adapts the tolerance, returns the fit, nfev and njev
+        #lattice is the slice of the fitted parameters holding the (first phase's) lattice parameters, refit(x, tolerance) fits again from x
+        #the error left is the volume change of the Gauss-Newton step still to go, so every frame is checked without further fits,
+        #a fit that misses is polished at tighter tolerances while that moves the volume and shrinks the error, on a rough residual
+        #surface the step is no guide and polishing does neither, the tolerance is then left alone
+        SG_num = self.config["SG_num"]
+        precision = float(self.config["volume_precision"])
+        error = volume_error(SG_num, LS_out, lattice)
+        tolerance, needed, nfev, njev = self.tolerance, None, 0, 0
+        while error > precision and tolerance > TOLERANCE_LIMITS[0]:
+            tolerance = max(float("%.0e" % (tolerance/10)), TOLERANCE_LIMITS[0])
+            polished = refit(LS_out.x, tolerance)
+            nfev, njev = nfev + polished.nfev, njev + (polished.njev or 0)
+            moved = abs(cell_volume(SG_num, polished.x[lattice]) - cell_volume(SG_num, LS_out.x[lattice]))
+            if polished.status <= 0 or polished.cost > LS_out.cost:
+                break
+            LS_out, last_error, error = polished, error, volume_error(SG_num, polished, lattice)
+            if moved < precision/10 or error >= last_error:
+                break
+            needed = tolerance
+        #a loose tolerance leaves a large error in some frames only, so a miss tightens the tolerance at once and it is never loosened
+        #back to a tolerance that missed, and it is only loosened after LOOSEN_AFTER fits in a row within a tenth of volume_precision
+        tolerance = self.tolerance
+        self.precise_fits = self.precise_fits + 1 if needed is None and error < precision/10 else 0
+        if needed is not None:
+            tolerance = needed
+            self.loosest_tolerance = min(self.loosest_tolerance, needed)
+        elif self.precise_fits >= LOOSEN_AFTER:
+            tolerance = min(float("%.0e" % (tolerance*10)), self.loosest_tolerance)
+        if tolerance != self.tolerance:
+            self.precise_fits = 0
+            self.log("Tolerance "+str(tolerance)+" (volume error "+"%.2e" % error+" A^3)\n")
+        self.tolerance = tolerance
+        return LS_out, nfev, njev
+
+    def start_params(self, state):#the state as the starting parameters of the profile mode's fit
+        num_peaks = state["num_peaks"]
+        mode = self.config["profile_mode"]
+        if state.get("phases"):#every phase in one vector, see fitting.join_phases
+            phases = self.state_phases(state)
+            return join_phases([i["gaussian_params"] for i in phases], [i["lattice_params"] for i in phases])
+        if mode == "projected":#scales and shifts solved in closed form, LS sees only sigmas and lattice
+            LS_params = list(state["gaussian_params"][num_peaks:2*num_peaks])
+        elif mode == "caglioti":#Caglioti widths and shared background, carried between frames in their own form
+            LS_params = list(state.get("caglioti_params") or caglioti_start(state["gaussian_params"], num_peaks))
+        else:
+            LS_params = list(state["gaussian_params"])
+        return LS_params + list(state["lattice_params"])
+
+    def forecast(self, steps = 1):#predictor forecast (mean, standard deviation) for the frame steps frames on from the last one fitted, or None
+        if self.predictor is None:
+            return None
+        return self.predictor.predict(steps + self.frames_missed)
+
+    def observe(self, result):#update the predictor with a successful result, sets the result's innovation and outlier flag
+        if self.predictor is None or not result["success"]:
+            return None
+        lattice = slice(-sum(len(i["lattice_params"]) for i in [result] + result.get("phases", [])), None)#every phase's lattice
+        innovation, outlier = self.predictor.update(self.start_params(seed_state(self.state, result)), gated = lattice, steps = 1 + self.frames_missed)
+        self.frames_missed = 0
+        innovation = float(np.max(np.abs(innovation[lattice])))
+        result["innovation"] = innovation
+        result["outlier"] = outlier
+        if result["outlier"]:
+            self.log("==== WARNING ====\nOutlier frame "+str(result["filepath"])+": lattice parameters "+"%.1f" % innovation+" standard deviations from the forecast\n")
+
+    def record(self, result):#log a successful result, append it to the journal and add it to results, a quarantined one goes to the quarantine file
+        if result.get("quarantined", False):
+            self.log("==== WARNING ====\nQuarantined "+str(result["filepath"])+" after "+str(len(result.get("attempts", [])))+" failed attempts, the run carries on from the last good frame\n")
+            if self.config["quarantine_file"] is not None:
+                entry = dict(result)
+                entry.update({"run" : self.run_id, "settings_hash" : self.settings_hash})
+                with open(self.config["quarantine_file"], mode = "a") as file:
+                    file.write(json.dumps(entry)+"\n")
+            self.quarantined.append(result)
+            return None
+        if not result["success"]:
+            return None
+        self.log("Fitted: "+str(result["filepath"])+"\n")
+        self.log("With residual sum of: "+str(result["cost"])+"\n")
+        self.log("Refined gaussian parameters: "+str(result["gaussian_params"])+"\n")
+        self.log("Refined lattice parameters: "+str(result["lattice_params"])+"\n")
+        self.log("Volume = "+str(result["volume"])+"\n")
+        for number, phase in enumerate(result.get("phases", []), 2):
+            self.log("Phase "+str(number)+" lattice parameters: "+str(phase["lattice_params"])+", volume = "+str(phase["volume"])+"\n")
+        entry = dict(result)
+        entry.update({"run" : self.run_id, "settings_hash" : self.settings_hash})
+        self.write_journal(entry)
+        self.state["counter"] += 1
+        self.results.append(result)
+
+    def run(self, frame_indices = None, resume = None):#generator of per frame results, stops after a failed fit that is not quarantined
+        if self.state is None:
+            self.setup()
+        if frame_indices is None:
+            frame_indices = range(len(self.frame_source))[:self.config["max_frames"]]
+        resume = self.config["resume"] if resume is None else resume
+        try:
+            resumed = self.start_journal(resume = resume)
+            frame_indices = list(frame_indices)
+            processes = int(self.config["processes"] or 1)
+            coarse_step = int(self.config["coarse_step"] or 1)
+            if coarse_step > 1:
+                yield from self.run_coarse(frame_indices, coarse_step, processes, resumed)
+                return None
+            #journaled frames at the start of the series are not fitted again, the fit continues from the last of them
+            while frame_indices != [] and self.frame_source.label(frame_indices[0]) in resumed:
+                yield self.take_resumed(frame_indices.pop(0), resumed)
+            joint_frames = int(self.config["joint_frames"] or 1)
+            if joint_frames > 1:
+                #the starts of the blocks need a rate of change, so frames are fitted one by one until there are two to take it from
+                while frame_indices != [] and (self.predictor.frames if self.predictor is not None else len(self.results)) < 2:
+                    result = self.fit_frame(frame_indices.pop(0))
+                    yield result
+                    if halts(result):
+                        return None
+                for first in range(0, len(frame_indices), joint_frames):
+                    results = self.fit_block(frame_indices[first:first+joint_frames])
+                    for result in results:
+                        yield result
+                        if halts(result):
+                            return None
+                return None
+            if processes > 1 and len(frame_indices) >= 2*processes:
+                yield from self.run_parallel(frame_indices, processes)
+                return None
+            for frame_index in frame_indices:
+                if self.frame_source.label(frame_index) in resumed:#journaled after a quarantined frame
+                    yield self.take_resumed(frame_index, resumed)
+                    continue
+                result = self.fit_frame(frame_index)
+                yield result
+                if halts(result):
+                    return
+        finally:
+            self.close_journal()
+            if self.results != [] or self.quarantined != []:
+                self.log(retry_report(retry_statistics(self.results + self.quarantined)))
+
+    def take_resumed(self, frame_index, resumed, chained = True):#journaled result of a frame in place of fitting it
+        result = dict(resumed[self.frame_source.label(frame_index)])
+        result.update({"index" : frame_index, "resumed" : True})
+        if chained:#the next fit continues from it
+            self.state = seed_state(self.state, result)
+            self.observe(result)
+        self.state["counter"] += 1
+        self.results.append(result)
+        return result
+
+    def worker_config(self):#config for worker processes, everything already worked out so they do not touch the catalog or re-read the calibration
+        config = dict(self.config)
+        config.update({"files" : [], "wavelength" : self.wavelength, "max_2theta" : self.max_2theta, "window_points" : self.window_points, "journal_file" : None, "quarantine_file" : None, "resume" : False, "processes" : 1, "tolerance" : self.tolerance})
+        return config
+
+    def run_coarse(self, frame_indices, coarse_step, processes, resumed):#coarse pass then fill-in pass, yielded as fitted, not in frame order
+        #the coarse pass chains every coarse_step-th frame (and the last) so a trace of the whole series comes after about 1/k of the work
+        coarse = frame_indices[::coarse_step]
+        if frame_indices != [] and coarse[-1] != frame_indices[-1]:
+            coarse.append(frame_indices[-1])
+        self.log("Coarse pass: "+str(len(coarse))+" of "+str(len(frame_indices))+" frames\n")
+        coarse_results = {}
+        for frame_index in coarse:
+            if self.frame_source.label(frame_index) in resumed:
+                result = self.take_resumed(frame_index, resumed)
+            else:
+                result = self.fit_frame(frame_index)
+            yield result
+            if halts(result):
+                return None
+            if result["success"]:
+                coarse_results[frame_index] = result
+        #fill-in jobs, each frame starts from the parameters interpolated between the coarse frames either side,
+        #the frames either side of a quarantined coarse frame are filled in from the good coarse frames beyond it
+        jobs = []
+        fitted = [i for i in coarse if i in coarse_results]
+        for first, second in zip(fitted[:-1], fitted[1:]):
+            for position in range(frame_indices.index(first)+1, frame_indices.index(second)):
+                frame_index = frame_indices[position]
+                if frame_index in coarse:
+                    continue
+                if self.frame_source.label(frame_index) in resumed:
+                    yield self.take_resumed(frame_index, resumed, chained = False)
+                    continue
+                weight = (frame_index - first)/(second - first)
+                jobs.append((frame_index, interpolate_state(self.state, coarse_results[first], coarse_results[second], weight)))
+        self.log("Fill-in pass: "+str(len(jobs))+" frames\n")
+        if processes > 1 and len(jobs) >= 2*processes:
+            with ProcessPoolExecutor(max_workers = processes, mp_context = get_context("spawn")) as pool:
+                config = self.worker_config()
+                batches = [jobs[i::4*processes] for i in range(4*processes)]
+                futures = [pool.submit(_fit_fills, config, frame_source_spec(self.frame_source), batch) for batch in batches if batch != []]
+                try:
+                    for future in as_completed(futures):
+                        for result in future.result():
+                            self.record(result)
+                            yield result
+                finally:
+                    for future in futures:
+                        future.cancel()
+        else:
+            for frame_index, start in jobs:
+                yield self.fit_frame(frame_index, start = start)
+        self.results.sort(key = lambda i: i["index"])
+
+    def run_parallel(self, frame_indices, processes):#segments fitted in a process pool, yielded in frame order
+        #each segment chains from an anchor of its first frame, the boundaries are then reconciled so the results match a serial run
+        segments = [[int(j) for j in i] for i in np.array_split(np.asarray(frame_indices), processes) if len(i) > 0]
+        config = self.worker_config()
+        spec = frame_source_spec(self.frame_source)
+        anchors = self.anchor_states(frame_indices, [segment[0] for segment in segments[1:]])
+        starts = [dict(self.state)] + [anchors[segment[0]] for segment in segments[1:]]
+        #spawn rather than fork, the parent may be the GUI
+        with ProcessPoolExecutor(max_workers = processes, mp_context = get_context("spawn")) as pool:
+            futures = [pool.submit(_fit_segment, config, spec, start, segment) for segment, start in zip(segments, starts)]
+            try:
+                yield from self.merge_segments((segment, future.result()) for segment, future in zip(segments, futures))
+            finally:
+                for future in futures:
+                    future.cancel()
+
+    def anchor_states(self, frame_indices, starts):#starting state of each frame of starts (frame indices of frame_indices) from the anchor pass
+        #a serial pass over every ANCHOR_STEP-th frame and the starts, a fraction of the fits of a serial run
+        positions = [frame_indices.index(i) for i in starts]
+        #the first two frames give the extrapolation its rate of change
+        positions = sorted(set(range(0, max(positions, default = 0) + 1, ANCHOR_STEP)) | set(positions) | {0, min(1, len(frame_indices) - 1)})
+        self.log("Anchor pass: "+str(len(positions))+" frames\n")
+        anchors, fitted = {}, []
+        for position in positions:
+            frame_index = frame_indices[position]
+            if len(fitted) >= 2:#carried on from the last two anchors, so the pass keeps up with a ramp
+                first, second = fitted[-2], fitted[-1]
+                start = extrapolate_state(self.state, first, second, (frame_index - first["index"])/(second["index"] - first["index"]))
+            elif fitted != []:
+                start = seed_state(self.state, fitted[-1])
+            else:
+                start = dict(self.state)
+            #a fit from an explicit start leaves the state and the predictor alone and updates start
+            result = self.fit_frame(frame_index, record = False, start = start)
+            if result["success"]:
+                fitted.append(result)
+            anchors[frame_index] = start
+        return anchors
+
+    def merge_segments(self, segment_results):#(segment, results) pairs fitted apart, reconciled, recorded and yielded in frame order
+        previous = None
+        for segment, results in segment_results:
+            refitted = []
+            if previous is not None:
+                refitted, results = self.reconcile(previous, results, segment)
+            #refitted frames have already been through the predictor, the segment's own results are observed here in frame order
+            for result, observed in [(i, True) for i in refitted] + [(i, False) for i in results]:
+                if result["success"]:
+                    self.state = seed_state(self.state, result)
+                    if not observed:
+                        self.observe(result)
+                    previous = result
+                elif result.get("quarantined", False) and not observed:
+                    self.frames_missed += 1
+                self.record(result)
+                yield result
+                if halts(result):
+                    return None
+
+    def reconcile(self, previous, results, segment):#refit the start of a segment chained from the previous segment's last result
+        #returns the refitted results and the segment's own results that stand after them
+        self.state = seed_state(self.state, previous)
+        reconciled = []
+        for position, frame_index in enumerate(segment):
+            result = self.fit_frame(int(frame_index), record = False)
+            reconciled.append(result)
+            if halts(result):
+                break
+            if position < len(results) and results_agree(result, results[position]):
+                #the chain has caught up with the segment's own fit, the rest of the segment stands
+                return reconciled, results[position+1:]
+        return reconciled, []
+
+class RefinerThread(Thread): #runs a SequentialRefiner on a worker thread, results and log lines are posted to events
+    def __init__(self, refiner, frame_indices = None, frame_source = None):
+        Thread.__init__(self, daemon = True)
+        self.refiner = refiner
+        self.frame_indices = frame_indices
+        self.frame_source = frame_source #frames fitted one by one with fit_frame from here if given, carrying on the chain and journal (a watched folder)
+        self.events = Queue()
+        self.running = Event() #cleared while paused
+        self.running.set()
+        self.cancelled = False
+        refiner.log = self.post_log
+
+    def post_log(self, text):
+        self.events.put(("log", text))
+
+    def pause(self):
+        self.running.clear()
+
+    def resume(self):
+        self.running.set()
+
+    def cancel(self):
+        self.cancelled = True
+        self.running.set()
+
+    @property
+    def paused(self):
+        return not self.running.is_set()
+
+    def run(self):
+        if self.frame_source is not None:
+            results = (self.refiner.fit_frame(i, self.frame_source) for i in self.frame_indices)
+        else:
+            results = self.refiner.run(self.frame_indices)
+        try:
+            for result in results:
+                self.events.put(("result", result))
+                if not self.running.is_set():
+                    self.post_log("Paused\n")
+                    self.running.wait()
+                if self.cancelled:
+                    self.post_log("Cancelled after "+str(self.refiner.state["counter"])+" frames\n")
+                    break
+        except Exception as error:#anything the engine raises is reported to the client rather than lost with the thread
+            self.events.put(("error", str(error)))
+            return None
+        finally:
+            results.close()#closes the journal straight away on a cancel
+        self.events.put(("done", None))
+
+def main(argv = None):#command line entry point, python refiner.py config.json [options]
+    parser = argparse.ArgumentParser(description = "Sequential fit of a diffraction series without the GUI")
+    parser.add_argument("config", help = "JSON config file, see refiner.py for the keys")
+    parser.add_argument("--results", help = "results .csv, overrides results_file of the config")
+    parser.add_argument("--processes", type = int, help = "worker processes, overrides processes of the config")
+    parser.add_argument("--coarse", type = int, help = "fit every k-th frame first, then fill in, overrides coarse_step of the config")
+    parser.add_argument("--joint", type = int, help = "fit blocks of n frames as one problem, overrides joint_frames of the config")
+    parser.add_argument("--smoothness", type = float, help = "weight of the lattice smoothness penalty of joint fits, overrides smoothness of the config")
+    parser.add_argument("--kalman", action = "store_true", help = "start each fit from a Kalman forecast of the series, sets predictor of the config to kalman")
+    parser.add_argument("--resume", action = "store_true", help = "continue the last run in the journal instead of starting over")
+    args = parser.parse_args(argv)
+    config = load_config(args.config)
+    if args.results is not None:
+        config["results_file"] = args.results
+    if args.processes is not None:
+        config["processes"] = args.processes
+    if args.coarse is not None:
+        config["coarse_step"] = args.coarse
+    if args.joint is not None:
+        config["joint_frames"] = args.joint
+    if args.smoothness is not None:
+        config["smoothness"] = args.smoothness
+    if args.kalman:
+        config["predictor"] = "kalman"
+    if args.resume:
+        config["resume"] = True
+    refiner = SequentialRefiner(config)
+    try:
+        refiner.setup()
+    except (OSError, ValueError) as error:
+        parser.exit(2, "ptsfit: "+str(error)+"\n")
+    for result in refiner.run():
+        pass
+    rows = [result_row(result) for result in refiner.results]#frame order, coarse to fine runs yield out of order
+    refiner.close()
+    if rows != []:
+        write_results(refiner.config["results_file"], rows)
+        refiner.log("Saved file: "+str(refiner.config["results_file"])+"\n")
+    failed = len(refiner.results) < len(range(len(refiner.frame_source))[:refiner.config["max_frames"]])#a frame failed or was quarantined
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
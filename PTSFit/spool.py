@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+"""
+File based job spool for fitting a series on several machines that share a filesystem
+
+General use:
+
+The spool is a directory every node can reach:
+    job.json : worker config, frame source (patterns.frame_source_spec), starting state, frames and submit id of the refinement
+    todo/ : one .json work unit per block of consecutive frames waiting to be fitted, with the state its first frame starts from
+    leases/ : units being fitted, a unit is claimed by renaming it from todo/ to leases/<unit>@<worker>, which only one worker can do
+    results/ : one .jsonl shard per finished unit, the unit then its results one per line, written to a .part file and renamed into place
+Every unit, and so every shard, carries the submit id of its job
+A worker refreshes the modification time of its lease after every frame, a lease untouched for lease_seconds is expired and
+is renamed back to todo/ by whichever worker finds it, so the units of a node that died are fitted again
+A worker that finds its lease gone stops fitting that unit
+
+submit(refiner, directory, frame_indices, unit_size) writes the job and its units from a refiner that has been set up, the
+starting state of each unit comes from the anchor pass of a parallel run (see refiner.py) that submit fits before writing the units,
+it raises ValueError if the directory is not empty, so the shards of an earlier job can never be gathered with a new one
+work(directory, worker) claims and fits units until there are none left, each unit is a warm-start chain from its starting state,
+as the segments of a parallel run
+gather(refiner, directory) reads the shards, reconciles the unit boundaries with refiner.merge_segments and yields the results in
+frame order, it raises ValueError if any unit is not finished, if a shard is from another submit or if the shards do not cover the
+submitted frames exactly once and in order, spool_status(directory) counts the units in each state
+A frame quarantined by a worker is in its unit's shard and is recorded to the quarantine file by gather, the unit carries on past it
+
+Command line:
+
+python spool.py submit config.json spool_dir [--unit-size n]
+python spool.py work spool_dir [--worker name] [--processes n] [--lease-seconds s]
+python spool.py gather config.json spool_dir [--results results.csv]
+Several work commands can run at once, on any node, --processes starts that many local workers
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import socket
+import argparse
+from multiprocessing import get_context
+
+from patterns import frame_source_spec, open_frame_source
+from refiner import halts, load_config, result_row, retry_report, retry_statistics, SequentialRefiner, write_results
+
+UNIT_SIZE = 50 #frames per work unit
+LEASE_SECONDS = 600 #a lease not refreshed for this long is taken back, longer than the slowest frame
+POLL_SECONDS = 5 #wait between looks for work while other workers hold leases
+
+def _spool_paths(directory):
+    return {name : os.path.join(directory, name) for name in ("todo", "leases", "results")}
+
+def _write_json(path, content):#written to a .part file and renamed, so other nodes never read half a file
+    part = path+"."+socket.gethostname()+"-"+str(os.getpid())+".part"
+    with open(part, mode = "w") as file:
+        file.write(content)
+    os.replace(part, path)
+
+def _unit_name(lease):#unit file name of a lease file name
+    return lease.split("@")[0]
+
+def submit(refiner, directory, frame_indices = None, unit_size = UNIT_SIZE):#write the job and its work units, returns the number of units
+    if refiner.state is None:
+        refiner.setup()
+    if frame_indices is None:
+        frame_indices = range(len(refiner.frame_source))[:refiner.config["max_frames"]]
+    frame_indices = [int(i) for i in frame_indices]
+    if os.path.isdir(directory) and os.listdir(directory) != []:
+        raise ValueError("The spool "+str(directory)+" is not empty, submit to a new directory")
+    paths = _spool_paths(directory)
+    for path in paths.values():
+        os.makedirs(path, exist_ok = True)
+    submit_id = uuid.uuid4().hex
+    job = {"config" : refiner.worker_config(), "source" : frame_source_spec(refiner.frame_source), "state" : refiner.state, "settings_hash" : refiner.settings_hash,
+        "frames" : frame_indices, "submit" : submit_id}
+    _write_json(os.path.join(directory, "job.json"), json.dumps(job))
+    units = [frame_indices[i:i+unit_size] for i in range(0, len(frame_indices), unit_size)]
+    anchors = refiner.anchor_states(frame_indices, [unit[0] for unit in units[1:]]) if len(units) > 1 else {}
+    starts = [refiner.state] + [anchors[unit[0]] for unit in units[1:]]
+    for number, (unit, start) in enumerate(zip(units, starts)):
+        _write_json(os.path.join(paths["todo"], "unit_%05d.json" % number), json.dumps({"unit" : number, "frames" : unit, "state" : start, "submit" : submit_id}))
+    return len(units)
+
+def spool_status(directory):#number of units waiting, leased and finished
+    paths = _spool_paths(directory)
+    count = lambda path, ending: len([i for i in os.listdir(path) if i.endswith(ending)])
+    return {"todo" : count(paths["todo"], ".json"), "leased" : len(os.listdir(paths["leases"])), "done" : count(paths["results"], ".jsonl")}
+
+def reclaim_expired(directory, lease_seconds = LEASE_SECONDS):#rename leases that have not been refreshed back to todo/, returns how many
+    paths = _spool_paths(directory)
+    reclaimed = 0
+    for lease in os.listdir(paths["leases"]):
+        path = os.path.join(paths["leases"], lease)
+        try:
+            if time.time() - os.path.getmtime(path) < lease_seconds:
+                continue
+            os.rename(path, os.path.join(paths["todo"], _unit_name(lease)))
+            reclaimed += 1
+        except OSError:#refreshed, finished or reclaimed by someone else meanwhile
+            continue
+    return reclaimed
+
+def claim(directory, worker):#lease the first waiting unit, returns the lease path or None if there are none
+    paths = _spool_paths(directory)
+    for unit in sorted(os.listdir(paths["todo"])):
+        if not unit.endswith(".json"):
+            continue
+        lease = os.path.join(paths["leases"], unit+"@"+worker)
+        try:
+            os.rename(os.path.join(paths["todo"], unit), lease)
+        except OSError:#claimed by another worker first
+            continue
+        os.utime(lease)#the lease runs from the claim, not from when the unit was written
+        return lease
+    return None
+
+def work(directory, worker = None, log = None, lease_seconds = LEASE_SECONDS):#fit units until the spool is finished, returns the number of units fitted
+    worker = worker if worker is not None else socket.gethostname()+"-"+str(os.getpid())
+    log = log if log is not None else sys.stdout.write
+    with open(os.path.join(directory, "job.json")) as file:
+        job = json.load(file)
+    refiner = SequentialRefiner(job["config"], frame_source = open_frame_source(job["source"]), log = lambda text: None)
+    fitted = 0
+    try:
+        while True:
+            reclaim_expired(directory, lease_seconds)
+            lease = claim(directory, worker)
+            if lease is None:
+                if spool_status(directory)["leased"] == 0:
+                    return fitted
+                time.sleep(POLL_SECONDS)#other workers are busy, their units come back here if they die
+                continue
+            if fit_unit(refiner, job, directory, lease, log):
+                fitted += 1
+    finally:
+        refiner.close()
+
+def fit_unit(refiner, job, directory, lease, log):#fit a leased unit and write its shard, returns False if the lease was lost
+    with open(lease) as file:
+        unit = json.load(file)
+    log(os.path.basename(lease)+": frames "+str(unit["frames"][0])+" to "+str(unit["frames"][-1])+"\n")
+    refiner.state = dict(unit["state"])
+    if refiner.predictor is not None:
+        refiner.predictor.reset()
+    refiner.frames_missed = 0
+    results = []
+    for frame_index in unit["frames"]:
+        result = refiner.fit_frame(frame_index, record = False)
+        results.append(result)
+        try:
+            os.utime(lease)#heartbeat
+        except OSError:
+            log(os.path.basename(lease)+": lease expired and taken back, unit left to its new worker\n")
+            return False
+        if halts(result):
+            break
+    shard = os.path.join(_spool_paths(directory)["results"], "unit_%05d.jsonl" % unit["unit"])
+    _write_json(shard, "".join(json.dumps(i)+"\n" for i in [unit] + results))
+    try:
+        os.remove(lease)
+    except OSError:
+        pass
+    return True
+
+def gather(refiner, directory):#results of all units in frame order with the unit boundaries reconciled, see module docstring
+    paths = _spool_paths(directory)
+    with open(os.path.join(directory, "job.json")) as file:
+        job = json.load(file)
+    if refiner.state is None:
+        refiner.setup()
+    if refiner.settings_hash != job["settings_hash"]:
+        raise ValueError("The spool was submitted with different settings")
+    status = spool_status(directory)
+    if status["todo"] + status["leased"] > 0:
+        raise ValueError(str(status["todo"] + status["leased"])+" work units are not finished")
+    units = []
+    for name in sorted(i for i in os.listdir(paths["results"]) if i.endswith(".jsonl")):
+        with open(os.path.join(paths["results"], name)) as file:
+            lines = [json.loads(line) for line in file]
+        if lines[0].get("submit") != job["submit"]:
+            raise ValueError("The shard "+name+" is from another submit to this spool")
+        units.append((lines[0]["frames"], lines[1:]))
+    if [i for frames, results in units for i in frames] != job["frames"]:
+        raise ValueError("The finished units do not cover the submitted frames once each and in order")
+    refiner.state = dict(job["state"])
+    return refiner.merge_segments(units)
+
+def _work_process(directory, worker, lease_seconds):
+    work(directory, worker, lease_seconds = lease_seconds)
+
+def main(argv = None):#command line entry point, see module docstring
+    parser = argparse.ArgumentParser(description = "Fit a diffraction series on several machines through a shared spool directory")
+    commands = parser.add_subparsers(dest = "command", required = True)
+    command = commands.add_parser("submit", help = "write the work units of a config to a spool")
+    command.add_argument("config")
+    command.add_argument("spool")
+    command.add_argument("--unit-size", type = int, default = UNIT_SIZE, help = "frames per work unit")
+    command = commands.add_parser("work", help = "fit units from a spool until it is finished")
+    command.add_argument("spool")
+    command.add_argument("--worker", help = "worker name, defaults to host-pid")
+    command.add_argument("--processes", type = int, default = 1, help = "local worker processes")
+    command.add_argument("--lease-seconds", type = float, default = LEASE_SECONDS)
+    command = commands.add_parser("gather", help = "reconcile the finished units and write the results")
+    command.add_argument("config")
+    command.add_argument("spool")
+    command.add_argument("--results", help = "results .csv, overrides results_file of the config")
+    args = parser.parse_args(argv)
+    if args.command == "work":
+        if args.processes <= 1:
+            work(args.spool, args.worker, lease_seconds = args.lease_seconds)
+            return 0
+        context = get_context("spawn")
+        name = args.worker if args.worker is not None else socket.gethostname()+"-"+str(os.getpid())
+        processes = [context.Process(target = _work_process, args = (args.spool, name+"-"+str(i), args.lease_seconds)) for i in range(args.processes)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        return 0 if all(i.exitcode == 0 for i in processes) else 1
+    config = load_config(args.config)
+    if args.command == "gather" and args.results is not None:
+        config["results_file"] = args.results
+    refiner = SequentialRefiner(config)
+    try:
+        refiner.setup()
+        if args.command == "submit":
+            units = submit(refiner, args.spool, unit_size = args.unit_size)
+            refiner.log("Submitted "+str(units)+" work units to "+str(args.spool)+"\n")
+            return 0
+        refiner.start_journal()
+        results = list(gather(refiner, args.spool))
+    except (OSError, ValueError) as error:
+        parser.exit(2, "ptsfit: "+str(error)+"\n")
+    finally:
+        refiner.close()
+    rows = [result_row(result) for result in refiner.results]
+    if rows != []:
+        write_results(refiner.config["results_file"], rows)
+        refiner.log("Saved file: "+str(refiner.config["results_file"])+"\n")
+    refiner.log(retry_report(retry_statistics(results)))
+    return 0 if all(i["success"] for i in results) else 1#failed or quarantined frames
+
+if __name__ == "__main__":
+    sys.exit(main())
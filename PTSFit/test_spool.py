@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the job spool (spool.py) with local worker processes on a temporary spool
+
+General use:
+
+python test_spool.py
+runs every test on a synthetic compression ramp of an fcc phase written to a temporary folder and prints each test as it passes,
+the test_ functions can also be collected by pytest
+"""
+
+import os
+import sys
+import json
+import time
+import tempfile
+from multiprocessing import get_context
+
+import numpy as np
+
+import spool
+from refiner import SequentialRefiner
+
+FRAMES = 24 #frames of the synthetic series
+UNIT_SIZE = 8 #frames per work unit
+WORKERS = 3 #local worker processes
+LATTICE_TOLERANCE = 1e-5 #relative lattice parameter difference allowed between a gathered and a serial fit
+
+def make_series(folder, frames = FRAMES, a0 = 3.92, da = -0.0015, wavelength = 0.4):#fcc patterns of a compression ramp, returns the config
+    rng = np.random.default_rng(0)
+    hkl = [(h, k, l) for h in range(6) for k in range(h+1) for l in range(k+1) if (h, k, l) != (0, 0, 0) and len({h % 2, k % 2, l % 2}) == 1]
+    x = np.linspace(2, 25, 2000)
+    files = []
+    for frame in range(frames):
+        a = a0 + da*frame
+        y = np.full_like(x, 50.0)
+        for s in sorted({h*h + k*k + l*l for h, k, l in hkl}):
+            sine = wavelength*np.sqrt(s)/(2*a)
+            if sine < 1:
+                y += 1000*np.exp(-(x - 2*np.degrees(np.arcsin(sine)))**2/(2*0.02**2))
+        y += rng.normal(0, 3, size = x.size)
+        path = os.path.join(folder, "frame_%05d.dat" % frame)
+        np.savetxt(path, np.column_stack((x, y)), fmt = "%.6f")
+        files.append(path)
+    return {"files" : files, "SG_num" : 225, "lattice_params" : [a0 + 0.001], "wavelength" : wavelength, "window" : 0.5,
+        "profile" : [900, 0.025, 45], "max_frames" : None, "journal_file" : None, "quarantine_file" : None}
+
+def new_refiner(config):
+    refiner = SequentialRefiner(config, log = lambda text: None)
+    refiner.setup()
+    return refiner
+
+def submitted(folder):#config of a series and a spool it was submitted to
+    config = make_series(folder)
+    directory = os.path.join(folder, "spool")
+    refiner = new_refiner(config)
+    try:
+        spool.submit(refiner, directory, unit_size = UNIT_SIZE)
+    finally:
+        refiner.close()
+    return config, directory
+
+def _claim_all(directory, worker):
+    leases = []
+    while True:
+        lease = spool.claim(directory, worker)
+        if lease is None:
+            return leases
+        leases.append(os.path.basename(lease))
+
+def test_atomic_claim():#workers racing for the units claim each exactly once
+    with tempfile.TemporaryDirectory() as folder:
+        config, directory = submitted(folder)
+        units = sorted(os.listdir(os.path.join(directory, "todo")))
+        with get_context("spawn").Pool(WORKERS) as pool:
+            claimed = pool.starmap(_claim_all, [(directory, "w"+str(i)) for i in range(WORKERS)])
+        leases = [lease for worker in claimed for lease in worker]
+        assert sorted(spool._unit_name(i) for i in leases) == units
+        assert sorted(leases) == sorted(os.listdir(os.path.join(directory, "leases")))
+
+def test_stale_lease_reclaimed():#the unit of a worker that stopped refreshing its lease goes back to todo/ and is fitted
+    with tempfile.TemporaryDirectory() as folder:
+        config, directory = submitted(folder)
+        lease = spool.claim(directory, "dead")
+        assert spool.reclaim_expired(directory, lease_seconds = 60) == 0
+        os.utime(lease, (time.time() - 120, time.time() - 120))
+        assert spool.reclaim_expired(directory, lease_seconds = 60) == 1
+        assert not os.path.exists(lease)
+        assert spool._unit_name(os.path.basename(lease)) in os.listdir(os.path.join(directory, "todo"))
+        assert spool.work(directory, "alive", log = lambda text: None, lease_seconds = 60) == FRAMES//UNIT_SIZE
+        assert spool.spool_status(directory) == {"todo" : 0, "leased" : 0, "done" : FRAMES//UNIT_SIZE}
+
+def test_lost_lease_dropped():#a worker whose lease is taken back while it fits stops and writes no shard
+    with tempfile.TemporaryDirectory() as folder:
+        config, directory = submitted(folder)
+        lease = spool.claim(directory, "slow")
+        unit = spool._unit_name(os.path.basename(lease))
+        todo = os.path.join(directory, "todo", unit)
+        with open(os.path.join(directory, "job.json")) as file:
+            job = json.load(file)
+        refiner = SequentialRefiner(job["config"], frame_source = spool.open_frame_source(job["source"]), log = lambda text: None)
+        try:
+            #fit_unit logs once it has read the lease, another worker reclaims it then, before the first heartbeat
+            assert not spool.fit_unit(refiner, job, directory, lease, lambda text: os.path.exists(lease) and os.rename(lease, todo))
+        finally:
+            refiner.close()
+        assert os.listdir(os.path.join(directory, "results")) == []
+        assert os.path.exists(todo)
+
+def test_gather_matches_serial():#local workers fit the spool and gather gives the serial results
+    with tempfile.TemporaryDirectory() as folder:
+        config, directory = submitted(folder)
+        context = get_context("spawn")
+        workers = [context.Process(target = spool._work_process, args = (directory, "w"+str(i), 60)) for i in range(WORKERS)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        assert all(i.exitcode == 0 for i in workers)
+        refiner = new_refiner(config)
+        try:
+            gathered = list(spool.gather(refiner, directory))
+        finally:
+            refiner.close()
+        refiner = new_refiner(config)
+        try:
+            serial = list(refiner.run())
+        finally:
+            refiner.close()
+        assert [i["index"] for i in gathered] == [i["index"] for i in serial] == list(range(FRAMES))
+        assert all(i["success"] for i in gathered)
+        for result, other in zip(gathered, serial):
+            assert np.all(np.abs(np.asarray(result["lattice_params"])/np.asarray(other["lattice_params"]) - 1) <= LATTICE_TOLERANCE)
+
+def main():
+    tests = [test_atomic_claim, test_stale_lease_reclaimed, test_lost_lease_dropped, test_gather_matches_serial]
+    for test in tests:
+        test()
+        sys.stdout.write(test.__name__+": ok\n")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())